@@ -0,0 +1,274 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+try:
+    from .config import ASSESSMENT_MAX_SESSIONS, ASSESSMENT_MAX_TURNS, ASSESSMENT_MIN_TURNS, ASSESSMENT_SESSION_TTL_SECONDS
+    from .prompts import CEFR_LEVELS
+except ImportError:
+    from app.config import ASSESSMENT_MAX_SESSIONS, ASSESSMENT_MAX_TURNS, ASSESSMENT_MIN_TURNS, ASSESSMENT_SESSION_TTL_SECONDS
+    from app.prompts import CEFR_LEVELS
+
+# セッションの状態
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+# answer() が返す次の動き
+CONTINUE = "continue"   # 通常どおり LLM に次の質問を出させる
+FINALIZE = "finalize"   # 採点して終える
+DONE = "done"           # 判定済み（採点済みの結果を返す）
+
+SCORE_KEYS = ("grammar", "vocabulary", "fluency", "comprehension")
+# 採点に渡すコーチの発言の上限（質問の部分が分かれば十分）
+COACH_TEXT_LIMIT = 600
+
+# 判定を求める言い方だけのメッセージ（回答の中に「終了」「結果は」等が出てくるだけでは判定しない）
+_RESULT_REQUEST = re.compile(
+    r"^\s*(?:please\s+)?(?:"
+    r"判定(?:して|を(?:お願い|出して|教えて))|結果を(?:教えて|見せて|出して|お願い)|評価して"
+    r"|(?:テストを)?(?:終わりにして|終わらせて|終了して)"
+    r"|(?:give|show|tell) me (?:the|my) (?:result|score|level)s?|what(?:'s| is) my (?:result|score|level)"
+    r"|assess me|finish (?:the )?test"
+    r")\s*(?:ください|下さい|くれ|ほしい|欲しい|します|しますか|please|now)?\s*[。.!！?？]*\s*$",
+    re.IGNORECASE,
+)
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+_CEFR = re.compile(r"\b([ABC][12])\b")
+
+RETAKE_HINT = "もう一度測る時は「📏 実力判定テスト」を押してください。"
+
+
+def wants_result(message: str) -> bool:
+    """ユーザーが判定結果を求めているか（メッセージ全体が判定を求める言い方の時だけ）"""
+    return bool(_RESULT_REQUEST.match(message.strip()))
+
+
+class AssessmentTracker:
+    """
+    ユーザーごとの実力判定の進行（何往復答えたか・採点結果）をサーバー側で持つ。
+    - 判定テストの書き出しで始まり、回答を ASSESSMENT_MAX_TURNS 回受けるか、ASSESSMENT_MIN_TURNS 回以上で
+      ユーザーが判定を求めたら、1回の採点で終える。
+    - 回答は返答を作って保存できた時（record / complete）に数える。クォータ切れや失敗した回答は数えない。
+    - 判定済みのあとに判定モードで話しかけられたら、新しいテストを始める（結果を求められた時だけ判定済みの結果を返す）。
+    - 状態はメモリに置き（LRU＋TTL）、変わるたびに保存先にも書く（リロードや再起動でも続きから）。
+    load / save は同期関数なので、イベントループからは run_blocking 経由で呼ぶ。
+    """
+
+    def __init__(
+        self,
+        load,
+        save,
+        max_turns: int = ASSESSMENT_MAX_TURNS,
+        min_turns: int = ASSESSMENT_MIN_TURNS,
+        ttl: float = ASSESSMENT_SESSION_TTL_SECONDS,
+        max_sessions: int = ASSESSMENT_MAX_SESSIONS,
+    ):
+        self._load = load
+        self._save = save
+        self.max_turns = max_turns
+        self.min_turns = min(min_turns, max_turns)
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()   # user_id -> セッション（無いことが分かっている時は None）
+        self._lock = threading.Lock()
+        self.counters = {"started": 0, "completed": 0, "early_completed": 0, "replayed": 0}
+
+    def _expired(self, session) -> bool:
+        return session is not None and time.time() - session["updated_at"] > self.ttl
+
+    def _put(self, user_id: str, session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def is_loaded(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._sessions
+
+    def load(self, user_id: str):
+        """保存先から読んでメモリに置く（同期）"""
+        try:
+            session = self._load(user_id)
+        except Exception as e:
+            print(f"✖ Assessment Load Error: {e}")
+            session = None
+        with self._lock:
+            # 読んでいる間に始まったセッションがあればそちらを優先する
+            if user_id not in self._sessions:
+                self._put(user_id, session)
+            return self._sessions[user_id]
+
+    def persist(self, user_id: str):
+        """今の状態を保存先に書く（同期）"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return
+            session = json.loads(json.dumps(session))
+        try:
+            self._save(user_id, session)
+        except Exception as e:
+            print(f"✖ Assessment Save Error: {e}")
+
+    def get(self, user_id: str):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if self._expired(session):
+                self._sessions[user_id] = session = None
+            return session
+
+    def start(self, user_id: str, level: str) -> dict:
+        """判定テストを最初から始める"""
+        now = time.time()
+        with self._lock:
+            previous = self._sessions.get(user_id) or {}
+            session = {
+                "level": level, "turns": 0, "status": IN_PROGRESS, "transcript": [], "result": None,
+                # やり直している間も、前回の判定結果は学習状況に出せるように残す
+                "last_result": previous.get("result") or previous.get("last_result"),
+                "started_at": now, "updated_at": now,
+            }
+            self._put(user_id, session)
+            self.counters["started"] += 1
+        return session
+
+    def answer(self, user_id: str, level: str, message: str) -> str:
+        """この回答を受けた時の次の動き（CONTINUE / FINALIZE / DONE）を返す（ここではまだ数えない）"""
+        session = self.get(user_id)
+        if session is not None and session["status"] == COMPLETED:
+            if wants_result(message):
+                with self._lock:
+                    self.counters["replayed"] += 1
+                return DONE
+            # 判定済みのあとに話しかけられたら、新しいテストとして数え直す
+            session = None
+        if session is None:
+            # ボタンを押さずに判定モードで話し始めた時もテストとして数える
+            session = self.start(user_id, level)
+        with self._lock:
+            answered = session["turns"] + 1
+            if answered >= self.max_turns:
+                return FINALIZE
+            if answered >= self.min_turns and wants_result(message):
+                return FINALIZE
+            return CONTINUE
+
+    def record(self, user_id: str, user_message: str, ai_text: str, counted: bool = True):
+        """判定中の1往復を採点用に覚える（返答を保存できた後に呼ぶ。counted=False は書き出し等、回答に数えないもの）"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None or session["status"] != IN_PROGRESS:
+                return
+            if counted:
+                session["turns"] += 1
+            session["transcript"].append({"user": user_message, "coach": ai_text[:COACH_TEXT_LIMIT]})
+            del session["transcript"][:-(self.max_turns + 1)]
+            session["updated_at"] = time.time()
+
+    def complete(self, user_id: str, result: dict):
+        """採点できた最後の回答を数えて判定済みにする"""
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return
+            session["turns"] += 1
+            if session["turns"] < self.max_turns:
+                self.counters["early_completed"] += 1
+            result = {**result, "completed_at": datetime.now(timezone.utc).isoformat()}
+            session.update(status=COMPLETED, result=result, transcript=[], updated_at=time.time())
+            self.counters["completed"] += 1
+
+    def latest_result(self, user_id: str):
+        """いちばん新しい判定結果（判定のやり直し中なら前回のもの）"""
+        session = self.get(user_id) or {}
+        return session.get("result") or session.get("last_result")
+
+    def scoring_prompt(self, user_id: str, final_answer: str) -> str:
+        """採点用の依頼文（これまでの質問と回答＋最後の回答）"""
+        session = self.get(user_id) or {"level": "", "transcript": []}
+        lines = [f"ユーザーの目標レベル: {session['level']}", ""]
+        for turn in session["transcript"]:
+            lines += [f"User: {turn['user']}", f"Coach: {turn['coach']}"]
+        lines.append(f"User: {final_answer}")
+        return "\n".join(lines)
+
+    def state(self, user_id: str) -> dict:
+        """フロントエンドに返す進行状態（会話の中身は含めない）"""
+        session = self.get(user_id)
+        base = {"max_turns": self.max_turns, "min_turns": self.min_turns}
+        if session is None:
+            return {"status": "none", "level": None, "turns": 0, "result": None, **base}
+        return {
+            "status": session["status"], "level": session["level"], "turns": session["turns"],
+            "result": session["result"], **base,
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": sum(1 for s in self._sessions.values() if s is not None),
+                "in_progress": sum(1 for s in self._sessions.values() if s and s["status"] == IN_PROGRESS),
+                **self.counters,
+            }
+
+
+def parse_result(text: str) -> dict:
+    """採点の返答（JSON）を読み取る。壊れていても CEFR レベルだけは拾う"""
+    data = {}
+    match = _JSON_OBJECT.search(text or "")
+    if match:
+        try:
+            data = json.loads(match.group(0))
+        except ValueError:
+            data = {}
+    if not isinstance(data, dict):
+        data = {}
+
+    cefr = str(data.get("cefr", "")).strip().upper()
+    if cefr not in CEFR_LEVELS:
+        found = _CEFR.search(text or "")
+        cefr = found.group(1) if found else None
+
+    scores = {}
+    for key, value in (data.get("scores") or {}).items():
+        if key in SCORE_KEYS:
+            try:
+                scores[key] = max(1, min(5, int(value)))
+            except (TypeError, ValueError):
+                pass
+
+    def text_list(value) -> list:
+        return [str(v) for v in value][:3] if isinstance(value, list) else []
+
+    summary = str(data.get("summary") or "").strip()
+    if not data:
+        summary = (text or "").strip()[:1000]
+    return {
+        "cefr": cefr,
+        "scores": scores,
+        "strengths": text_list(data.get("strengths")),
+        "improvements": text_list(data.get("improvements")),
+        "summary": summary,
+    }
+
+
+SCORE_LABELS = {"grammar": "文法", "vocabulary": "語彙", "fluency": "流暢さ", "comprehension": "理解力"}
+
+
+def format_result(result: dict) -> str:
+    """採点結果をチャットに表示する文章にする"""
+    lines = [f"🎓 **実力判定の結果: CEFR {result.get('cefr') or '判定不能'}**", ""]
+    if result.get("scores"):
+        lines += [f"- {SCORE_LABELS[k]}: {'★' * v}{'☆' * (5 - v)}" for k, v in result["scores"].items()]
+        lines.append("")
+    if result.get("strengths"):
+        lines += ["**【強み】**"] + [f"- {s}" for s in result["strengths"]] + [""]
+    if result.get("improvements"):
+        lines += ["**【伸ばすポイント】**"] + [f"- {s}" for s in result["improvements"]] + [""]
+    if result.get("summary"):
+        lines.append(result["summary"])
+    return "\n".join(lines).strip()
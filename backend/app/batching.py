@@ -0,0 +1,62 @@
+import re
+
+try:
+    from .config import BATCH_CHUNK_CHARS, BATCH_MAX_CHUNKS
+except ImportError:
+    from app.config import BATCH_CHUNK_CHARS, BATCH_MAX_CHUNKS
+
+# 英語は句読点＋空白、日本語は句点の直後、どちらも改行で区切る
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])|\n+")
+
+PART_HEADER = "【Part {index}/{total}】"
+
+
+def split_sentences(text: str) -> list:
+    return [s.strip() for s in _SENTENCE_BOUNDARY.split(text) if s and s.strip()]
+
+
+def _group(sentences: list, max_chars: int) -> list:
+    chunks, current = [], ""
+    for sentence in sentences:
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            # 日本語の文は空白を挟まずにつなぐ
+            separator = "" if not current or current[-1] in "。！？" else " "
+            current = f"{current}{separator}{sentence}"
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def split_into_chunks(text: str, max_chars: int = BATCH_CHUNK_CHARS, max_chunks: int = BATCH_MAX_CHUNKS) -> list:
+    """
+    文章を文単位で区切り、max_chars 前後のかたまりにまとめる（文の途中では切らない）。
+    かたまりが max_chunks を超える時は、1つあたりの文字数を増やしてまとめ直す。
+    """
+    sentences = split_sentences(text)
+    chunks = _group(sentences, max_chars)
+    while len(chunks) > max_chunks:
+        max_chars = max(max_chars + 1, -(-len(text) // max_chunks), int(max_chars * 1.25))
+        chunks = _group(sentences, max_chars)
+    return chunks
+
+
+def chunk_prompt(chunk: str, index: int, total: int) -> str:
+    """1かたまり分の依頼文（前後の部分は別に添削するので、この部分だけを見るよう伝える）"""
+    if total == 1:
+        return chunk
+    return (
+        f"以下はユーザーが送った長い文章の {index}/{total} 番目の部分です。"
+        f"この部分だけを添削してください（質問は不要です）。\n\n{chunk}"
+    )
+
+
+def merge_results(results: list) -> str:
+    """添削結果を元の順番でつなげる"""
+    if len(results) == 1:
+        return results[0]
+    return "\n\n---\n\n".join(
+        f"{PART_HEADER.format(index=i, total=len(results))}\n{text}" for i, text in enumerate(results, 1)
+    )
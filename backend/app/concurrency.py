@@ -0,0 +1,35 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# ブロッキングI/O（Supabaseの同期クライアント等）を逃がすための専用スレッドプール
+# イベントループを止めないように、同期呼び出しは必ずここを通す
+BLOCKING_IO_WORKERS = int(os.environ.get("BLOCKING_IO_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(
+    max_workers=BLOCKING_IO_WORKERS,
+    thread_name_prefix="blocking-io",
+)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """同期関数を上限付きスレッドプールで実行し、結果を await できるようにする"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+_background_tasks = set()
+
+
+def spawn(coro):
+    """結果を待たないバックグラウンド処理を起動する（途中で GC されないよう参照を持っておく）"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def shutdown_executor():
+    """アプリ終了時にスレッドプールを片付ける"""
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -1,5 +1,5 @@
 import os
-import google.generativeai as genai
+import threading
 
 from dotenv import load_dotenv
 
@@ -13,21 +13,205 @@ ADMIN_USER_ID = os.environ.get("ADMIN_USER_ID")
 #MODEL_NAME = 'gemini-2.5-flash'
 MODEL_NAME = 'gemini-flash-latest'
 
+# 上から順に使うモデルの連鎖（先頭が主モデル。遅い時は次のモデルにヘッジし、エラー時は次に回す）
+MODEL_CHAIN = tuple(
+    m.strip() for m in os.environ.get("MODEL_CHAIN", f"{MODEL_NAME},gemini-2.5-flash").split(",") if m.strip()
+)
+
 # Business Rules
 DAILY_LIMIT = 50
 
+# Model Registry（(level, mode) ごとのモデルを使い回す）
+MODEL_REGISTRY_MAX_SIZE = int(os.environ.get("MODEL_REGISTRY_MAX_SIZE", "32"))
+# Gemini のコンテキストキャッシュ（対応モデル・最小トークン数の条件を満たす時だけ有効にする）
+CONTEXT_CACHE_ENABLED = os.environ.get("CONTEXT_CACHE_ENABLED", "false").lower() == "true"
+CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+# キャッシュが切れるこの秒数前に作り直す（切れたキャッシュを指したモデルは呼ぶたびに失敗する）
+CONTEXT_CACHE_REFRESH_SECONDS = int(os.environ.get("CONTEXT_CACHE_REFRESH_SECONDS", "300"))
 
-model = None        
+# Storage（会話履歴の保存先）: "supabase" か、ネットワーク無しで動く "sqlite"
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "supabase")
+STORAGE_SQLITE_PATH = os.environ.get("STORAGE_SQLITE_PATH", "/tmp/english_coach_history.sqlite3")
 
-if API_KEY:
-    try:
-        genai.configure(api_key=API_KEY)
+# Quota（1日の利用回数カウンター）: "memory" はプロセス内のみ、"sqlite" は同じホストのワーカー間で共有
+QUOTA_BACKEND = os.environ.get("QUOTA_BACKEND", "memory")
+QUOTA_SQLITE_PATH = os.environ.get("QUOTA_SQLITE_PATH", "/tmp/english_coach_quota.sqlite3")
 
-        # APIキーの有効性チェック用
-        model = genai.GenerativeModel(model_name=MODEL_NAME)
-        print(f"✅ Gemini ({MODEL_NAME}) initialized")
-    except Exception as e:
-        print(f"❌ Gemini Error: {e}")
-else:
-    print("⚠️ Warning: API KEY not found")
+# History Pool（アクティブなユーザーの直近の会話をメモリに置いておく）
+HISTORY_TURNS = int(os.environ.get("HISTORY_TURNS", "5"))
+HISTORY_POOL_MAX_USERS = int(os.environ.get("HISTORY_POOL_MAX_USERS", "1000"))
+HISTORY_POOL_IDLE_TTL_SECONDS = int(os.environ.get("HISTORY_POOL_IDLE_TTL_SECONDS", "1800"))
+HISTORY_POOL_MAX_BYTES = int(os.environ.get("HISTORY_POOL_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Write-Behind（chat_history への保存を返答後にまとめて書き込む）
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+# 実際のファイルはプロセスごとに別（/tmp/english_coach_spool.<pid>.jsonl）。止まったプロセスの分は次に起動したプロセスが引き取る
+WRITE_BEHIND_SPOOL_PATH = os.environ.get("WRITE_BEHIND_SPOOL_PATH", "/tmp/english_coach_spool.jsonl")
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get("WRITE_BEHIND_MAX_PENDING", "1000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.environ.get("WRITE_BEHIND_BATCH_SIZE", "50"))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL", "0.5"))
+WRITE_BEHIND_MAX_RETRIES = int(os.environ.get("WRITE_BEHIND_MAX_RETRIES", "5"))
+
+# Response Cache（クイックプロンプト等、同じ入力への返答を使い回す）
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", str(6 * 3600)))
+# 1つのキーに貯めておく返答のバリエーション数（同じ返答ばかりにならないように）
+RESPONSE_CACHE_VARIANTS = int(os.environ.get("RESPONSE_CACHE_VARIANTS", "3"))
+
+# フロントエンドのクイックプロンプト（会話の書き出しなので、履歴に関係なく同じキーで使い回す）
+QUICK_PROMPTS = (
+    "現在の英語力を測るための簡単なテストを開始してください。",
+    "CEFR C1レベルを目指す特訓をお願いします。",
+    "英語日記の作成をサポートしてください。",
+    "今日の学習報告をします。",
+    "英文を添削してください。",
+)
+
+# Opener Bank（実力判定の最初の質問を目標レベルごとに作り置きし、LLM を呼ばずに返す。作り置きは保存先の assessment_openers で全コンテナが共有する）
+OPENER_BANK_ENABLED = os.environ.get("OPENER_BANK_ENABLED", "true").lower() == "true"
+# レベルごとに用意しておく質問のバリエーション数
+OPENER_BANK_VARIANTS = int(os.environ.get("OPENER_BANK_VARIANTS", "8"))
+
+# Assessment（実力判定の進行をサーバー側で数え、最後に1回だけ採点する）
+ASSESSMENT_MAX_TURNS = int(os.environ.get("ASSESSMENT_MAX_TURNS", "5"))
+# この回数以上答えていれば、ユーザーが判定を求めた時点で採点する
+ASSESSMENT_MIN_TURNS = int(os.environ.get("ASSESSMENT_MIN_TURNS", "3"))
+ASSESSMENT_SESSION_TTL_SECONDS = int(os.environ.get("ASSESSMENT_SESSION_TTL_SECONDS", str(24 * 3600)))
+ASSESSMENT_MAX_SESSIONS = int(os.environ.get("ASSESSMENT_MAX_SESSIONS", "5000"))
+
+# Learning Stats（ユーザーごと・日ごとの利用集計。保存のたびに足し込み、まとめて書き込む）
+STATS_FLUSH_INTERVAL_SECONDS = float(os.environ.get("STATS_FLUSH_INTERVAL_SECONDS", "2"))
+# 書き込みがこの回数続けて失敗したら、貯まった増分は捨てる（保存先が無い・壊れている時にメモリを増やし続けない）
+STATS_MAX_FLUSH_FAILURES = int(os.environ.get("STATS_MAX_FLUSH_FAILURES", "30"))
+STATS_DEFAULT_DAYS = int(os.environ.get("STATS_DEFAULT_DAYS", "30"))
+STATS_MAX_DAYS = int(os.environ.get("STATS_MAX_DAYS", "365"))
+# 履歴のエクスポートで1回に読む件数（メモリに載るのはこの件数まで）
+EXPORT_PAGE_SIZE = int(os.environ.get("EXPORT_PAGE_SIZE", "500"))
+
+# LLM Gateway（Gemini 呼び出しの流量制御・リトライ・サーキットブレーカー）
+LLM_RATE_PER_MINUTE = float(os.environ.get("LLM_RATE_PER_MINUTE", "60"))
+LLM_BURST = int(os.environ.get("LLM_BURST", "10"))
+LLM_CONCURRENCY_INITIAL = int(os.environ.get("LLM_CONCURRENCY_INITIAL", "8"))
+LLM_CONCURRENCY_MIN = int(os.environ.get("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.environ.get("LLM_CONCURRENCY_MAX", "32"))
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "3"))
+LLM_QUEUE_MAX_WAITERS = int(os.environ.get("LLM_QUEUE_MAX_WAITERS", "100"))
+LLM_QUEUE_DEADLINE_SECONDS = float(os.environ.get("LLM_QUEUE_DEADLINE_SECONDS", "20"))
+# Hedging（主モデルの最初のトークンが遅い時に、次のモデルにも同じ依頼を出して早い方を使う）
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "true").lower() == "true"
+# モードごとの「最初のトークンまで」の目標秒数。ヘッジを出すまでの待ち時間は主モデルの p95 とこの値の小さい方
+LLM_SLO_SECONDS = {
+    "assessment": float(os.environ.get("LLM_SLO_ASSESSMENT", "4")),
+    "level_up": float(os.environ.get("LLM_SLO_LEVEL_UP", "6")),
+    "diary": float(os.environ.get("LLM_SLO_DIARY", "6")),
+    "default": float(os.environ.get("LLM_SLO_DEFAULT", "6")),
+}
+HEDGE_MIN_DELAY_SECONDS = float(os.environ.get("HEDGE_MIN_DELAY_SECONDS", "0.5"))
+# p95 を信用するのに必要な計測数（それまでは SLO の値で待つ）
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_LATENCY_WINDOW = int(os.environ.get("HEDGE_LATENCY_WINDOW", "500"))
+
+# 優先クラス（管理者・有料ユーザー）は待ち行列で重み付きで先に通し、待てる時間も長くする
+LLM_PRIORITY_QUEUE_DEADLINE_SECONDS = float(os.environ.get("LLM_PRIORITY_QUEUE_DEADLINE_SECONDS", "30"))
+LLM_TIER_WEIGHTS = {
+    "priority": int(os.environ.get("LLM_PRIORITY_WEIGHT", "4")),
+    "free": int(os.environ.get("LLM_FREE_WEIGHT", "1")),
+}
+# 優先クラスとして扱うユーザー ID（カンマ区切り。ADMIN_USER_ID は常に優先）
+PRIORITY_USER_IDS = frozenset(u.strip() for u in os.environ.get("PRIORITY_USER_IDS", "").split(",") if u.strip())
+LLM_CALL_TIMEOUT_SECONDS = float(os.environ.get("LLM_CALL_TIMEOUT_SECONDS", "60"))
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("LLM_BREAKER_FAILURE_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+# 復旧確認の1件がこの秒数たっても戻らなければ、次の呼び出しに確認役を譲る（リトライ込みの1回分より長く）
+LLM_BREAKER_PROBE_TIMEOUT_SECONDS = float(
+    os.environ.get("LLM_BREAKER_PROBE_TIMEOUT_SECONDS", str(2 * LLM_CALL_TIMEOUT_SECONDS))
+)
+
+
+# Context Builder（Gemini に送る履歴をモードごとのトークン予算に収める）
+CONTEXT_TOKEN_BUDGETS = {
+    "assessment": int(os.environ.get("CONTEXT_BUDGET_ASSESSMENT", "1500")),
+    "level_up": int(os.environ.get("CONTEXT_BUDGET_LEVEL_UP", "2500")),
+    "diary": int(os.environ.get("CONTEXT_BUDGET_DIARY", "2000")),
+    "default": int(os.environ.get("CONTEXT_BUDGET_DEFAULT", "2000")),
+}
+# 古い会話をまとめたユーザーごとの要約の上限（トークン）
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", "400"))
+SUMMARY_MAX_USERS = int(os.environ.get("SUMMARY_MAX_USERS", "5000"))
+
+# Retrieval Index（過去の会話から今回の発言に近いやりとりを引いて、履歴に添える）
+RETRIEVAL_ENABLED = os.environ.get("RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", "3"))
+# これより似ていない（コサイン類似度が低い）やりとりは添えない
+RETRIEVAL_MIN_SCORE = float(os.environ.get("RETRIEVAL_MIN_SCORE", "0.35"))
+RETRIEVAL_DIM = int(os.environ.get("RETRIEVAL_DIM", "512"))
+RETRIEVAL_MAX_USERS = int(os.environ.get("RETRIEVAL_MAX_USERS", "500"))
+RETRIEVAL_IDLE_TTL_SECONDS = int(os.environ.get("RETRIEVAL_IDLE_TTL_SECONDS", "1800"))
+RETRIEVAL_MAX_TURNS_PER_USER = int(os.environ.get("RETRIEVAL_MAX_TURNS_PER_USER", "2000"))
+# インデックス全体（ベクトル＋要約行）の上限。ユーザー数・往復数の上限だけだと最悪 2GB 近くになるので、ここで抑える
+RETRIEVAL_MAX_BYTES = int(os.environ.get("RETRIEVAL_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# Batch Correction（/chat/batch: 長い文章を分けて並行に添削する）
+BATCH_MAX_PARALLEL = int(os.environ.get("BATCH_MAX_PARALLEL", "4"))
+BATCH_CHUNK_CHARS = int(os.environ.get("BATCH_CHUNK_CHARS", "400"))
+BATCH_MAX_CHUNKS = int(os.environ.get("BATCH_MAX_CHUNKS", "8"))
+BATCH_MAX_INPUT_CHARS = int(os.environ.get("BATCH_MAX_INPUT_CHARS", "8000"))
 
+# Idempotency（同じ送信の二重実行を防ぐ。完了した結果を覚えておく秒数と件数）
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.environ.get("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+# /chat/stream の再送が、実行中の最初の送信の結果を待つ上限
+IDEMPOTENCY_REPLAY_TIMEOUT_SECONDS = float(os.environ.get("IDEMPOTENCY_REPLAY_TIMEOUT_SECONDS", "120"))
+
+# Fast Path（空・長すぎる入力は LLM に渡す前に断り、お礼や相づちだけのメッセージには定型文で答える）
+FAST_PATH_ENABLED = os.environ.get("FAST_PATH_ENABLED", "true").lower() == "true"
+# /chat・/chat/stream で受け付けるメッセージの上限（長い文章は /chat/batch が BATCH_MAX_INPUT_CHARS まで受ける）
+CHAT_MAX_INPUT_CHARS = int(os.environ.get("CHAT_MAX_INPUT_CHARS", "4000"))
+
+# Response Compression（クライアントの Accept-Encoding に合わせて br / gzip で圧縮する）
+COMPRESSION_MIN_BYTES = int(os.environ.get("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get("COMPRESSION_BROTLI_QUALITY", "5"))
+
+# 起動時にモデル一覧を取得するか（ネットワークを使うので通常はオフ。/internal/models でいつでも取得できる）
+MODEL_DISCOVERY_ON_STARTUP = os.environ.get("MODEL_DISCOVERY_ON_STARTUP", "false").lower() == "true"
+
+
+# google.generativeai の import と初期化は重いので、最初に必要になった時に行う
+model = None
+_genai = None
+_genai_lock = threading.Lock()
+
+
+def get_genai():
+    """設定済みの google.generativeai モジュールを返す（初回呼び出し時に import する）"""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                if API_KEY:
+                    genai.configure(api_key=API_KEY)
+                _genai = genai
+    return _genai
+
+
+def get_base_model():
+    """APIキーの有効性チェック用の基本モデル（キーが無ければ None）"""
+    global model
+    if model is None and API_KEY:
+        try:
+            model = get_genai().GenerativeModel(model_name=MODEL_NAME)
+            print(f"✅ Gemini ({MODEL_NAME}) initialized")
+        except Exception as e:
+            print(f"❌ Gemini Error: {e}")
+    return model
+
+
+def gemini_configured() -> bool:
+    return model is not None or bool(API_KEY)
+
+
+if not API_KEY:
+    print("⚠️ Warning: API KEY not found")
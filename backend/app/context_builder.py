@@ -0,0 +1,150 @@
+import re
+import threading
+from collections import OrderedDict
+
+try:
+    from .config import CONTEXT_TOKEN_BUDGETS, SUMMARY_MAX_TOKENS, SUMMARY_MAX_USERS
+except ImportError:
+    from app.config import CONTEXT_TOKEN_BUDGETS, SUMMARY_MAX_TOKENS, SUMMARY_MAX_USERS
+
+SUMMARY_HEADER = "（これまでのコーチングの要約。すでに扱った話題は繰り返さないでください）"
+SUMMARY_ACK = "了解しました。要約を踏まえて続けます。"
+RELATED_HEADER = "（今回の発言に関連しそうな過去のやりとり）"
+
+_ENGLISH_SECTION = re.compile(r"【英語】\s*(.+?)(?:【|$)", re.S)
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s")
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（英数字は4文字で1トークン、日本語などは1文字1トークンとみなす）"""
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def _first_sentence(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    sentence = _SENTENCE_END.split(text, maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit] + "…"
+
+
+def turn_gist(turn: dict) -> tuple:
+    """1往復の要点（ユーザーの発言の冒頭と、コーチの【英語】部分の最初の1文）"""
+    match = _ENGLISH_SECTION.search(turn["ai_response"])
+    coach = match.group(1) if match else turn["ai_response"]
+    return _first_sentence(turn["user_message"], 80), _first_sentence(coach, 120)
+
+
+def compress_turn(turn: dict) -> str:
+    """1往復を1行に縮める"""
+    user, coach = turn_gist(turn)
+    return f"- User: {user} / Coach: {coach}"
+
+
+def _trim_lines(lines: list, max_tokens: int) -> list:
+    # 上限を超えたら古い行から捨てる
+    while lines and sum(estimate_tokens(line) for line in lines) > max_tokens:
+        lines.pop(0)
+    return lines
+
+
+class SummaryStore:
+    """
+    ユーザーごとの「古い会話の要約」を持つ。直近の窓から外れた会話を1行ずつ畳み込んで少しずつ更新する。
+    load(user_id) / save(user_id, summary) は永続化用の同期関数（任意）。
+    """
+
+    def __init__(self, load=None, save=None, max_users: int = SUMMARY_MAX_USERS, max_tokens: int = SUMMARY_MAX_TOKENS):
+        self.load = load
+        self.save = save
+        self.max_users = max_users
+        self.max_tokens = max_tokens
+        self._summaries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cached(self, user_id: str):
+        with self._lock:
+            summary = self._summaries.get(user_id)
+            if summary is not None:
+                self._summaries.move_to_end(user_id)
+            return summary
+
+    def set(self, user_id: str, summary: str):
+        with self._lock:
+            self._summaries[user_id] = summary
+            self._summaries.move_to_end(user_id)
+            while len(self._summaries) > self.max_users:
+                self._summaries.popitem(last=False)
+
+    def load_summary(self, user_id: str) -> str:
+        """メモリに無ければ永続化先から読む（同期。スレッドプールから呼ぶ）"""
+        summary = self.get_cached(user_id)
+        if summary is None:
+            summary = ""
+            if self.load:
+                try:
+                    summary = self.load(user_id) or ""
+                except Exception as e:
+                    print(f"✖ Summary Load Error: {e}")
+            self.set(user_id, summary)
+        return summary
+
+    def fold(self, user_id: str, turn: dict) -> str:
+        """窓から外れた1往復を要約に畳み込み、新しい要約を返す"""
+        current = self.get_cached(user_id) or ""
+        lines = current.splitlines() + [compress_turn(turn)]
+        summary = "\n".join(_trim_lines(lines, self.max_tokens))
+        self.set(user_id, summary)
+        return summary
+
+    def persist(self, user_id: str, summary: str):
+        if self.save:
+            try:
+                self.save(user_id, summary)
+            except Exception as e:
+                print(f"✖ Summary Save Error: {e}")
+
+
+def build_context(turns: list, mode: str, summary: str = "", related: list = ()) -> tuple:
+    """
+    直近の会話を新しい方からトークン予算に入るだけ入れ、入りきらない古い会話は要約行にして先頭に付ける。
+    related: 検索インデックスから引いた関連する過去のやりとり（要約行）。要約と一緒に先頭に付ける。
+    戻り値: (gemini_history, {"context_tokens": 実際に送るトークン数, "tokens_saved": 削れたトークン数})
+    """
+    budget = CONTEXT_TOKEN_BUDGETS.get(mode, CONTEXT_TOKEN_BUDGETS["default"])
+    raw_tokens = sum(estimate_tokens(t["user_message"]) + estimate_tokens(t["ai_response"]) for t in turns)
+    summary_lines = summary.splitlines() if summary else []
+    # 要約にすでに入っている行は重ねて送らない
+    related_lines = [line for line in related if line not in summary_lines]
+
+    kept = []
+    used = sum(estimate_tokens(line) for line in summary_lines + related_lines)
+    for turn in reversed(turns):
+        cost = estimate_tokens(turn["user_message"]) + estimate_tokens(turn["ai_response"])
+        if kept and used + cost > budget:
+            break
+        kept.append(turn)
+        used += cost
+    kept.reverse()
+    # 予算からあふれた会話は、このリクエストだけ要約行として添える
+    overflow = turns[:len(turns) - len(kept)]
+    summary_lines = _trim_lines(summary_lines + [compress_turn(t) for t in overflow], SUMMARY_MAX_TOKENS)
+
+    sections = []
+    if summary_lines:
+        sections.append(SUMMARY_HEADER + "\n" + "\n".join(summary_lines))
+    if related_lines:
+        sections.append(RELATED_HEADER + "\n" + "\n".join(related_lines))
+
+    gemini_history = []
+    if sections:
+        gemini_history.append({"role": "user", "parts": ["\n\n".join(sections)]})
+        gemini_history.append({"role": "model", "parts": [SUMMARY_ACK]})
+    for turn in kept:
+        gemini_history.append({"role": "user", "parts": [turn["user_message"]]})
+        gemini_history.append({"role": "model", "parts": [turn["ai_response"]]})
+
+    context_tokens = sum(estimate_tokens(part) for item in gemini_history for part in item["parts"])
+    return gemini_history, {
+        "context_tokens": context_tokens,
+        "tokens_saved": max(0, raw_tokens - context_tokens),
+    }
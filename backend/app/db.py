@@ -1,8 +1,11 @@
 import os
+import threading
+from typing import TYPE_CHECKING
 
-from supabase import create_client, Client
 from dotenv import load_dotenv
-from datetime import datetime, timezone, timedelta
+
+if TYPE_CHECKING:
+    from supabase import Client
 
 # .envファイルを読み込む
 load_dotenv()
@@ -15,17 +18,30 @@ key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") or os.environ.get("SUPABA
 if not url or not key:
     print("Warning: Supabase credentials not found in .env file")
 
-# クライアントの作成
+# クライアントの作成は最初に使う時まで遅らせる（supabase の import が重く、起動が遅くなるため）
 # ここでエラーが起きても、main.py でキャッチできるように None にしておく
-supabase: Client = None
+supabase: "Client" = None
+_initialized = False
+_lock = threading.Lock()
+
+
+def supabase_configured() -> bool:
+    return supabase is not None or bool(url and key)
 
-try:
-    if url and key:
-        supabase = create_client(url, key)
-        print("✅ Supabase client initialized in db.py")
-except Exception as e:
-    print(f"❌ Failed to initialize Supabase: {e}")
 
 # 外部から呼び出すための関数
-def get_supabase_client() -> Client:
-    return supabase
\ No newline at end of file
+def get_supabase_client() -> "Client":
+    global supabase, _initialized
+    if _initialized:
+        return supabase
+    with _lock:
+        if not _initialized:
+            try:
+                if url and key:
+                    from supabase import create_client
+                    supabase = create_client(url, key)
+                    print("✅ Supabase client initialized in db.py")
+            except Exception as e:
+                print(f"❌ Failed to initialize Supabase: {e}")
+            _initialized = True
+    return supabase
@@ -0,0 +1,139 @@
+import random
+import re
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+try:
+    from .config import CHAT_MAX_INPUT_CHARS
+    from .metrics import FAST_PATH_DECISIONS
+    from .opener_bank import ASSESSMENT_MODE
+    from .response_cache import normalize_message
+except ImportError:
+    from app.config import CHAT_MAX_INPUT_CHARS
+    from app.metrics import FAST_PATH_DECISIONS
+    from app.opener_bank import ASSESSMENT_MODE
+    from app.response_cache import normalize_message
+
+# classify() が返す行き先
+LLM = "llm"             # 通常どおり LLM に渡す
+REJECT = "reject"       # 入力エラーとして返す（LLM もクォータも使わない）
+TEMPLATE = "template"   # 用意した定型文で答える（LLM もクォータも使わない）
+
+# 句読点・絵文字・空白を除いてから比べる（「ありがとう！」「OK 👍」も同じ扱い）
+_SYMBOLS = re.compile(r"[\W_]+")
+
+# 相づち・お礼だけのメッセージ（normalize_message したあと記号を除いた形で持つ）
+ACKNOWLEDGEMENTS = frozenset({
+    "ok", "okay", "ok thanks", "ok thank you", "thanks", "thank you", "thank you so much", "thanks a lot",
+    "thx", "ty", "got it", "i got it", "understood", "noted",
+    "ありがとう", "ありがとうございます", "ありがとうございました", "どうもありがとう", "サンキュー",
+    "了解", "了解です", "了解しました", "りょうかい", "わかりました", "分かりました", "なるほど", "おけ", "おっけー",
+})
+
+# モードごとの返答（コーチの返答と同じ【英語】【日本語】【Coach's Advice】の形にそろえる）
+ACKNOWLEDGEMENT_REPLIES = {
+    "default": (
+        "【英語】You're welcome! Feel free to send me anything you studied today or a sentence you want me to check.\n"
+        "【日本語】どういたしまして！今日の学習内容や、添削してほしい英文があればいつでも送ってください。\n"
+        "【Coach's Advice】お礼は \"Thanks a lot!\" や \"I really appreciate it.\" とも言えます。",
+        "【英語】Glad I could help! What would you like to work on next?\n"
+        "【日本語】お役に立ててうれしいです！次は何に取り組みましょうか？\n"
+        "【Coach's Advice】相づちは \"Got it.\" \"That makes sense.\" など、英語で返してみるのも良い練習です。",
+    ),
+    "level_up": (
+        "【英語】Great! Let's keep the momentum going. Try answering my last question again with a more precise expression.\n"
+        "【日本語】いいですね！この調子でいきましょう。さっきの質問に、もう一段階正確な表現で答え直してみてください。\n"
+        "【Coach's Advice】C1 では \"Understood.\" \"That's a fair point.\" のように、場面に合った相づちを使い分けましょう。",
+    ),
+    "diary": (
+        "【英語】You're welcome! Whenever you're ready, write a few sentences about your day.\n"
+        "【日本語】どういたしまして！準備ができたら、今日の出来事を英語で数文書いてみましょう。\n"
+        "【Coach's Advice】まずは \"Today I ...\" で書き始めると、続きが書きやすくなります。",
+    ),
+}
+
+
+@dataclass
+class Decision:
+    action: str
+    rule: str = ""
+    status_code: int = 0
+    detail: str = ""
+    text: str = ""
+
+
+def empty_message(message: str, mode: str) -> Optional[Decision]:
+    if not message.strip():
+        return Decision(REJECT, status_code=422, detail="メッセージが空です。")
+    return None
+
+
+def too_long(message: str, mode: str) -> Optional[Decision]:
+    if len(message) > CHAT_MAX_INPUT_CHARS:
+        return Decision(
+            REJECT, status_code=413,
+            detail=f"メッセージが長すぎます（{CHAT_MAX_INPUT_CHARS}文字まで）。長い文章は日記・学習報告モードで送ると分けて添削します。",
+        )
+    return None
+
+
+def acknowledgement(message: str, mode: str) -> Optional[Decision]:
+    # 判定テスト中の短い返事は回答として数えるので LLM に任せる
+    if mode == ASSESSMENT_MODE or len(message) > 40:
+        return None
+    if _SYMBOLS.sub(" ", normalize_message(message)).strip() not in ACKNOWLEDGEMENTS:
+        return None
+    replies = ACKNOWLEDGEMENT_REPLIES.get(mode, ACKNOWLEDGEMENT_REPLIES["default"])
+    return Decision(TEMPLATE, text=random.choice(replies))
+
+
+DEFAULT_RULES = (empty_message, too_long, acknowledgement)
+
+
+class FastPathClassifier:
+    """
+    LLM に渡す前に、メッセージを安い規則だけで振り分ける。
+    規則は rule(message, mode) -> Decision | None の関数で、前から順に試して最初に Decision を返したものを使う。
+    どれも当てはまらなければ LLM に渡す。規則ごとの当たり数と、LLM を呼ばずに済んだ数を数える。
+    """
+
+    def __init__(self, rules: tuple = DEFAULT_RULES):
+        self.rules = list(rules)
+        self._lock = threading.Lock()
+        self.counters = {"checked": 0, LLM: 0, REJECT: 0, TEMPLATE: 0}
+        self.rule_hits = {}
+
+    def add_rule(self, rule, first: bool = False):
+        """規則を足す（first=True なら既存の規則より先に試す）"""
+        if first:
+            self.rules.insert(0, rule)
+        else:
+            self.rules.append(rule)
+
+    def classify(self, message: str, mode: str) -> Decision:
+        decision = None
+        for rule in self.rules:
+            decision = rule(message, mode)
+            if decision is not None:
+                decision.rule = decision.rule or rule.__name__
+                break
+        decision = decision or Decision(LLM)
+        with self._lock:
+            self.counters["checked"] += 1
+            self.counters[decision.action] = self.counters.get(decision.action, 0) + 1
+            if decision.rule:
+                self.rule_hits[decision.rule] = self.rule_hits.get(decision.rule, 0) + 1
+        FAST_PATH_DECISIONS.inc(action=decision.action, rule=decision.rule or "none")
+        return decision
+
+    def stats(self) -> dict:
+        with self._lock:
+            checked = self.counters["checked"]
+            avoided = self.counters[REJECT] + self.counters[TEMPLATE]
+            return {
+                **self.counters,
+                "llm_calls_avoided": avoided,
+                "avoided_rate": round(avoided / checked, 3) if checked else 0.0,
+                "rules": dict(self.rule_hits),
+            }
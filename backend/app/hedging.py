@@ -0,0 +1,210 @@
+import asyncio
+import time
+from collections import deque
+
+try:
+    from .config import (
+        MODEL_CHAIN, HEDGE_ENABLED, LLM_SLO_SECONDS, HEDGE_MIN_DELAY_SECONDS, HEDGE_MIN_SAMPLES, HEDGE_LATENCY_WINDOW,
+    )
+    from .llm_gateway import GatewayError
+    from .metrics import LLM_CHAIN_REQUESTS, LLM_FALLBACKS, LLM_HEDGES, LLM_MODEL_SECONDS
+except ImportError:
+    from app.config import (
+        MODEL_CHAIN, HEDGE_ENABLED, LLM_SLO_SECONDS, HEDGE_MIN_DELAY_SECONDS, HEDGE_MIN_SAMPLES, HEDGE_LATENCY_WINDOW,
+    )
+    from app.llm_gateway import GatewayError
+    from app.metrics import LLM_CHAIN_REQUESTS, LLM_FALLBACKS, LLM_HEDGES, LLM_MODEL_SECONDS
+
+
+class LatencyTracker:
+    """
+    (モデル, 種類) ごとの直近 window 件のレイテンシを持ち、パーセンタイルを返す。
+    種類は "response"（返答全体）と "first_token"（ストリームの最初のチャンク）で、長さが全く違うので混ぜない。
+    """
+
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self.window = window
+        self._samples = {}
+
+    def observe(self, model_name: str, kind: str, seconds: float):
+        samples = self._samples.get((model_name, kind))
+        if samples is None:
+            samples = self._samples[(model_name, kind)] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def count(self, model_name: str, kind: str) -> int:
+        return len(self._samples.get((model_name, kind), ()))
+
+    def percentile(self, model_name: str, kind: str, pct: float):
+        samples = sorted(self._samples.get((model_name, kind), ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def stats(self) -> dict:
+        return {
+            f"{model_name}/{kind}": {
+                "samples": len(samples),
+                "p50_ms": round(self.percentile(model_name, kind, 50) * 1000, 1),
+                "p95_ms": round(self.percentile(model_name, kind, 95) * 1000, 1),
+                "p99_ms": round(self.percentile(model_name, kind, 99) * 1000, 1),
+            }
+            for (model_name, kind), samples in self._samples.items() if samples
+        }
+
+
+class ModelChain:
+    """
+    MODEL_CHAIN の先頭から順にモデルを試す。
+    - 主モデルが「p95 と SLO の小さい方」までに最初のトークンを返さなければ、次のモデルにも同じ依頼を出し（ヘッジ）、早い方を使う。負けた方は取り消す。
+    - エラーになったら次のモデルに回す（Gateway が断った場合は、どのモデルでも同じなので回さない。
+      ヘッジだけが断られた時は、まだ走っている主モデルを取り消さずに待つ）。
+    """
+
+    def __init__(
+        self,
+        models: tuple = MODEL_CHAIN,
+        slos: dict = None,
+        hedge_enabled: bool = HEDGE_ENABLED,
+        min_delay: float = HEDGE_MIN_DELAY_SECONDS,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+    ):
+        self.models = tuple(models)
+        self.slos = dict(slos or LLM_SLO_SECONDS)
+        self.hedge_enabled = hedge_enabled and len(self.models) > 1
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker()
+        self.counters = {"requests": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0}
+
+    @property
+    def primary(self) -> str:
+        return self.models[0]
+
+    def hedge_delay(self, mode: str, kind: str = "response") -> float:
+        """主モデルにどれだけ待ってからヘッジを出すか（kind と同じ種類のレイテンシの p95 で決める）"""
+        slo = self.slos.get(mode, self.slos["default"])
+        if self.tracker.count(self.primary, kind) < self.min_samples:
+            return slo
+        return max(self.min_delay, min(slo, self.tracker.percentile(self.primary, kind, 95)))
+
+    async def _attempt(self, start, model_name: str, kind: str):
+        started = time.monotonic()
+        result = await start(model_name)
+        elapsed = time.monotonic() - started
+        self.tracker.observe(model_name, kind, elapsed)
+        LLM_MODEL_SECONDS.observe(elapsed, model=model_name, kind=kind)
+        return result
+
+    async def _race(self, mode: str, start, kind: str, discard=None):
+        """
+        start(model_name) を主モデルから順に走らせ、最初に成功した (結果, モデル名) を返す。
+        discard(結果): 負けたけれど結果を返してしまった試行の後始末（ストリームを閉じる等）
+        """
+        self.counters["requests"] += 1
+        pending = {}
+        next_index = 0
+        hedged = False
+        last_error = None
+        rejected = None
+
+        def launch():
+            nonlocal next_index
+            model_name = self.models[next_index]
+            next_index += 1
+            task = asyncio.ensure_future(self._attempt(start, model_name, kind))
+            pending[task] = (model_name, time.monotonic())
+
+        launch()
+        try:
+            while pending:
+                can_hedge = self.hedge_enabled and not hedged and next_index < len(self.models)
+                done, _ = await asyncio.wait(
+                    pending, timeout=self.hedge_delay(mode, kind) if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # 主モデルが遅いので、次のモデルにも同じ依頼を出す
+                    hedged = True
+                    self.counters["hedges"] += 1
+                    launch()
+                    continue
+                for task in done:
+                    model_name, _ = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        if hedged:
+                            LLM_HEDGES.inc(mode=mode, winner=model_name)
+                            if model_name != self.primary:
+                                self.counters["hedge_wins"] += 1
+                        LLM_CHAIN_REQUESTS.inc(mode=mode, model=model_name)
+                        return task.result(), model_name
+                    if isinstance(error, GatewayError):
+                        # Gateway が断った時はどのモデルでも同じなので次には回さないが、
+                        # まだ走っている試行（遅いだけの主モデル等）があればそちらの結果を待つ
+                        rejected = error
+                        continue
+                    last_error = error
+                    print(f"⚠️ Model {model_name} failed, trying the next model: {error}")
+                    LLM_FALLBACKS.inc(mode=mode, failed_model=model_name)
+                    self.counters["fallbacks"] += 1
+                if not pending and rejected is not None:
+                    raise rejected
+                if not pending and next_index < len(self.models):
+                    launch()
+            raise last_error
+        finally:
+            for task, (model_name, started) in pending.items():
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    if discard:
+                        await discard(task.result())
+                else:
+                    task.cancel()
+                    # 負けて取り消したモデルも「少なくともこれだけ遅かった」として数える（速い結果だけで p95 を見積もらないように）
+                    self.tracker.observe(model_name, kind, time.monotonic() - started)
+
+    async def call(self, mode: str, start):
+        """start(model_name) が返すコルーチンの結果を返す。戻り値: (結果, 使ったモデル名)"""
+        return await self._race(mode, start, "response")
+
+    async def stream(self, mode: str, start):
+        """
+        start(model_name) が返す非同期イテレーターを、最初のチャンクが早く届いたモデルのものに決めて流す。
+        戻り値は (モデル名, チャンク) を順に返す非同期ジェネレーター。
+        """
+        async def first_chunk(model_name: str):
+            iterator = start(model_name).__aiter__()
+            try:
+                return iterator, await iterator.__anext__()
+            except StopAsyncIteration:
+                return iterator, None
+            except BaseException:
+                await _close(iterator)
+                raise
+
+        async def discard(result):
+            await _close(result[0])
+
+        (iterator, chunk), model_name = await self._race(mode, first_chunk, "first_token", discard)
+        try:
+            if chunk is not None:
+                yield model_name, chunk
+                async for chunk in iterator:
+                    yield model_name, chunk
+        finally:
+            await _close(iterator)
+
+    def stats(self) -> dict:
+        requests = self.counters["requests"]
+        return {
+            "models": list(self.models),
+            **self.counters,
+            "hedge_rate": round(self.counters["hedges"] / requests, 3) if requests else 0.0,
+            "latency": self.tracker.stats(),
+        }
+
+
+async def _close(iterator):
+    aclose = getattr(iterator, "aclose", None)
+    if aclose:
+        await aclose()
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+try:
+    from .config import HISTORY_TURNS, HISTORY_POOL_MAX_USERS, HISTORY_POOL_IDLE_TTL_SECONDS, HISTORY_POOL_MAX_BYTES
+except ImportError:
+    from app.config import HISTORY_TURNS, HISTORY_POOL_MAX_USERS, HISTORY_POOL_IDLE_TTL_SECONDS, HISTORY_POOL_MAX_BYTES
+
+
+def _turn_size(turn: dict) -> int:
+    return len(turn["user_message"].encode("utf-8")) + len(turn["ai_response"].encode("utf-8"))
+
+
+class _Entry:
+    __slots__ = ("turns", "size", "last_used")
+
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.size = 0
+        self.last_used = time.monotonic()
+
+
+class HistoryPool:
+    """
+    ユーザーごとに直近 N 往復をリングバッファで持つメモリプール。
+    LRU・アイドル時間・合計バイト数の3つで上限をかけ、ヒットしなかった時だけ DB を読む。
+    """
+
+    def __init__(
+        self,
+        max_turns: int = HISTORY_TURNS,
+        max_users: int = HISTORY_POOL_MAX_USERS,
+        idle_ttl: float = HISTORY_POOL_IDLE_TTL_SECONDS,
+        max_bytes: int = HISTORY_POOL_MAX_BYTES,
+    ):
+        self.max_turns = max_turns
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _drop(self, user_id: str):
+        entry = self._entries.pop(user_id)
+        self._bytes -= entry.size
+        self.evictions += 1
+
+    def _evict(self):
+        now = time.monotonic()
+        # 先頭ほど古いので、期限切れは先頭から順に捨てる
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if now - entry.last_used > self.idle_ttl \
+                    or len(self._entries) > self.max_users \
+                    or self._bytes > self.max_bytes:
+                self._drop(user_id)
+            else:
+                break
+
+    def _push(self, entry: _Entry, turn: dict):
+        """ターンを追加し、リングバッファからあふれた古いターンがあれば返す"""
+        old = None
+        if len(entry.turns) == entry.turns.maxlen:
+            old = entry.turns[0]
+            entry.size -= _turn_size(old)
+            self._bytes -= _turn_size(old)
+        entry.turns.append(turn)
+        entry.size += _turn_size(turn)
+        self._bytes += _turn_size(turn)
+        return old
+
+    def get(self, user_id: str):
+        """直近の会話を古い順に返す（プールに無ければ None）"""
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(user_id)
+            return list(entry.turns)
+
+    def put(self, user_id: str, turns: list):
+        """DB から読んだ直近の会話でプールを埋める"""
+        with self._lock:
+            if user_id in self._entries:
+                self._bytes -= self._entries.pop(user_id).size
+            entry = _Entry(self.max_turns)
+            for turn in turns[-self.max_turns:]:
+                self._push(entry, turn)
+            self._entries[user_id] = entry
+            self._evict()
+
+    def append(self, user_id: str, user_message: str, ai_response: str):
+        """
+        保存した会話をプールにも追加する（プールに居ないユーザーは次回 DB から読む）。
+        直近 N 往復の窓から外れたターンがあれば返す（要約への畳み込み用）。
+        """
+        turn = {"user_message": user_message, "ai_response": ai_response}
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            dropped = self._push(entry, turn)
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(user_id)
+            self._evict()
+            return dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "users": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,141 @@
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+
+try:
+    from .config import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES
+    from .concurrency import spawn
+except ImportError:
+    from app.config import IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES
+    from app.concurrency import spawn
+
+
+class IdempotencyConflictError(Exception):
+    """同じ冪等キーで別の内容が送られてきた"""
+
+
+def _consume(future: asyncio.Future):
+    # 誰も待っていない時に「例外が取り出されなかった」警告を出さないようにする
+    if not future.cancelled():
+        future.exception()
+
+
+class _Entry:
+    __slots__ = ("future", "fingerprint", "expires")
+
+    def __init__(self, future: asyncio.Future, fingerprint: str):
+        self.future = future
+        self.fingerprint = fingerprint
+        self.expires = None   # 完了するまでは期限なし
+
+
+class IdempotencyCache:
+    """
+    クライアントが付けた冪等キーごとに、送信の結果を1つだけ作って共有する（イベントループ内でのみ使う）。
+    実行中の重複は同じ Future に相乗りし、完了済みの重複は ttl 秒間だけ結果をそのまま返す。
+    失敗した送信は覚えておかない（同じキーで再送すればやり直せる）。
+    """
+
+    def __init__(self, ttl: float = IDEMPOTENCY_TTL_SECONDS, max_entries: int = IDEMPOTENCY_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.coalesced = 0
+        self.misses = 0
+        self.conflicts = 0
+
+    @staticmethod
+    def _fingerprint(message: str) -> str:
+        return hashlib.blake2b(message.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _evict(self):
+        # 完了済みのものは完了順（＝期限順）に並んでいるので、先頭から期限切れと上限超過分を捨てる
+        # 実行中のものは捨てない
+        now = time.monotonic()
+        over = len(self._entries) - self.max_entries
+        stale = []
+        for cache_key, entry in self._entries.items():
+            if entry.expires is None:
+                continue
+            if entry.expires >= now and over <= 0:
+                break
+            stale.append(cache_key)
+            over -= 1
+        for cache_key in stale:
+            del self._entries[cache_key]
+
+    def get(self, user_id: str, key: str, message: str):
+        """受け付け済みの送信なら、その結果の Future を返す（実行中でも完了済みでも。未知なら None）"""
+        self._evict()
+        entry = self._entries.get((user_id, key))
+        if entry is None:
+            return None
+        if entry.fingerprint != self._fingerprint(message):
+            self.conflicts += 1
+            raise IdempotencyConflictError("同じ冪等キーで別のメッセージが送信されました。")
+        if entry.future.done():
+            self.hits += 1
+        else:
+            self.coalesced += 1
+        return entry.future
+
+    def claim(self, user_id: str, key: str, message: str) -> asyncio.Future:
+        """新しい送信として登録し、結果を入れる Future を返す（resolve / reject で必ず決着させる）"""
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume)
+        self._entries[(user_id, key)] = _Entry(future, self._fingerprint(message))
+        self.misses += 1
+        return future
+
+    def resolve(self, user_id: str, key: str, result):
+        entry = self._entries.get((user_id, key))
+        if entry is None or entry.future.done():
+            return
+        entry.future.set_result(result)
+        entry.expires = time.monotonic() + self.ttl
+        self._entries.move_to_end((user_id, key))
+
+    def reject(self, user_id: str, key: str, error: BaseException):
+        entry = self._entries.pop((user_id, key), None)
+        if entry is None or entry.future.done():
+            return
+        if isinstance(error, asyncio.CancelledError):
+            entry.future.cancel()
+        else:
+            entry.future.set_exception(error)
+
+    async def _lead(self, user_id: str, key: str, factory):
+        try:
+            result = await factory()
+        except asyncio.CancelledError as e:
+            self.reject(user_id, key, e)
+            raise
+        except Exception as e:
+            # 例外は待っている側（run の呼び出し元）に Future 経由で届く
+            self.reject(user_id, key, e)
+            return
+        self.resolve(user_id, key, result)
+
+    async def run(self, user_id: str, key: str, message: str, factory):
+        """
+        factory() の結果をキーごとに1回だけ作って返す。
+        最初の送信の処理はバックグラウンドで走らせるので、接続が切れても完了して結果が残る。
+        """
+        future = self.get(user_id, key, message)
+        if future is None:
+            future = self.claim(user_id, key, message)
+            spawn(self._lead(user_id, key, factory))
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        in_flight = sum(1 for e in self._entries.values() if not e.future.done())
+        return {
+            "entries": len(self._entries),
+            "in_flight": in_flight,
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+from datetime import date, datetime, timedelta
+
+try:
+    from .config import STATS_FLUSH_INTERVAL_SECONDS, STATS_MAX_FLUSH_FAILURES
+    from .concurrency import run_blocking
+    from .quota import JST
+except ImportError:
+    from app.config import STATS_FLUSH_INTERVAL_SECONDS, STATS_MAX_FLUSH_FAILURES
+    from app.concurrency import run_blocking
+    from app.quota import JST
+
+COUNTER_FIELDS = ("turns", "user_chars", "ai_chars")
+
+
+def jst_day(created_at: str = None) -> str:
+    """会話の時刻（ISO 文字列。省略時は今）が日本時間で何日か"""
+    moment = datetime.fromisoformat(created_at) if created_at else datetime.now(JST)
+    return moment.astimezone(JST).date().isoformat()
+
+
+class LearningStats:
+    """
+    ユーザーごと・日ごとの集計（モード・レベル別の往復数と文字数）を、会話を保存するたびに足し込む。
+    増分はメモリに貯めて flush_interval 秒ごとに add_deltas(rows) でまとめて書くので、
+    保存のたびに集計の書き込みが増えることはない。読む時はまだ書いていない増分も足して返す。
+    書き込みに失敗した増分は次の回に持ち越すが、max_failures 回続けて失敗したら捨てる。
+    """
+
+    def __init__(
+        self,
+        add_deltas,
+        flush_interval: float = STATS_FLUSH_INTERVAL_SECONDS,
+        max_failures: int = STATS_MAX_FLUSH_FAILURES,
+    ):
+        # add_deltas(rows) -> None（同期関数。失敗時は例外を投げる）
+        self.add_deltas = add_deltas
+        self.flush_interval = flush_interval
+        self.max_failures = max_failures
+        self.consecutive_failures = 0
+        self._deltas = {}   # (user_id, day, mode, level) -> {turns, user_chars, ai_chars}
+        self._lock = threading.Lock()
+        self._worker = None
+        self.recorded = 0
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+
+    def record(self, user_id: str, mode: str, level: str, user_message: str, ai_text: str, created_at: str = None):
+        key = (user_id, jst_day(created_at), mode, level or "")
+        with self._lock:
+            delta = self._deltas.setdefault(key, dict.fromkeys(COUNTER_FIELDS, 0))
+            delta["turns"] += 1
+            delta["user_chars"] += len(user_message)
+            delta["ai_chars"] += len(ai_text)
+            self.recorded += 1
+
+    def pending(self, user_id: str) -> list:
+        """まだ書いていないこのユーザーの増分（daily_stats と同じ形の行）"""
+        with self._lock:
+            return [
+                {"day": day, "mode": mode, "level": level, **delta}
+                for (uid, day, mode, level), delta in self._deltas.items() if uid == user_id
+            ]
+
+    def flush(self) -> int:
+        """貯まった増分を書き込む（同期）。失敗したら増分を戻し、次の回に持ち越す（続けて失敗したら捨てる）"""
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return 0
+        rows = [
+            {"user_id": user_id, "day": day, "mode": mode, "level": level, **delta}
+            for (user_id, day, mode, level), delta in deltas.items()
+        ]
+        try:
+            self.add_deltas(rows)
+        except Exception as e:
+            self.failed_flushes += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.max_failures:
+                self.dropped_rows += len(rows)
+                self.consecutive_failures = 0
+                print(
+                    f"✖ Learning Stats Flush Error: {e} "
+                    f"(failed {self.max_failures} times in a row, dropped {len(rows)} rows)"
+                )
+                return 0
+            print(f"✖ Learning Stats Flush Error: {e}")
+            with self._lock:
+                for key, delta in deltas.items():
+                    merged = self._deltas.setdefault(key, dict.fromkeys(COUNTER_FIELDS, 0))
+                    for field in COUNTER_FIELDS:
+                        merged[field] += delta[field]
+            return 0
+        self.consecutive_failures = 0
+        self.flushed_rows += len(rows)
+        return len(rows)
+
+    async def start(self):
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """終了時に残りを書き込む"""
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        await run_blocking(self.flush)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await run_blocking(self.flush)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._deltas)
+        return {
+            "pending_rows": pending,
+            "recorded": self.recorded,
+            "flushed_rows": self.flushed_rows,
+            "failed_flushes": self.failed_flushes,
+            "dropped_rows": self.dropped_rows,
+        }
+
+
+def summarize(rows: list, days: int, today: str = None) -> dict:
+    """日別の集計行（同じ日・モード・レベルの行が複数あってもよい）から学習状況のまとめを作る"""
+    today = today or jst_day()
+    since = (date.fromisoformat(today) - timedelta(days=days - 1)).isoformat()
+    daily = {}
+    by_mode = {}
+    by_level = {}
+    totals = dict.fromkeys(COUNTER_FIELDS, 0)
+    for row in rows:
+        if row["day"] < since:
+            continue
+        day = daily.setdefault(row["day"], {"day": row["day"], "turns": 0, "by_mode": {}})
+        day["turns"] += row["turns"]
+        day["by_mode"][row["mode"]] = day["by_mode"].get(row["mode"], 0) + row["turns"]
+        by_mode[row["mode"]] = by_mode.get(row["mode"], 0) + row["turns"]
+        if row["level"]:
+            by_level[row["level"]] = by_level.get(row["level"], 0) + row["turns"]
+        for field in COUNTER_FIELDS:
+            totals[field] += row[field]
+
+    # 連続学習日数（今日か昨日から遡って、1日でも空いたら止める）
+    streak = 0
+    cursor = date.fromisoformat(today)
+    if today not in daily:
+        cursor -= timedelta(days=1)
+    while cursor.isoformat() in daily:
+        streak += 1
+        cursor -= timedelta(days=1)
+
+    turns = totals["turns"]
+    return {
+        "days": days,
+        "since": since,
+        "total_turns": turns,
+        "today_turns": daily.get(today, {}).get("turns", 0),
+        "active_days": len(daily),
+        "streak_days": streak,
+        "by_mode": by_mode,
+        "by_level": by_level,
+        "avg_user_chars": round(totals["user_chars"] / turns, 1) if turns else 0.0,
+        "avg_ai_chars": round(totals["ai_chars"] / turns, 1) if turns else 0.0,
+        "daily": [daily[day] for day in sorted(daily)],
+    }
@@ -0,0 +1,407 @@
+import asyncio
+import random
+import time
+from functools import lru_cache
+
+try:
+    from .config import (
+        LLM_RATE_PER_MINUTE, LLM_BURST, LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX,
+        LLM_MAX_RETRIES, LLM_QUEUE_MAX_WAITERS, LLM_QUEUE_DEADLINE_SECONDS, LLM_CALL_TIMEOUT_SECONDS,
+        LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS, LLM_BREAKER_PROBE_TIMEOUT_SECONDS,
+        LLM_PRIORITY_QUEUE_DEADLINE_SECONDS,
+    )
+    from .metrics import LLM_QUEUE_WAIT_SECONDS, LLM_SHED
+    from .scheduler import FREE_TIER, PRIORITY_TIER, FairScheduler
+except ImportError:
+    from app.config import (
+        LLM_RATE_PER_MINUTE, LLM_BURST, LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX,
+        LLM_MAX_RETRIES, LLM_QUEUE_MAX_WAITERS, LLM_QUEUE_DEADLINE_SECONDS, LLM_CALL_TIMEOUT_SECONDS,
+        LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS, LLM_BREAKER_PROBE_TIMEOUT_SECONDS,
+        LLM_PRIORITY_QUEUE_DEADLINE_SECONDS,
+    )
+    from app.metrics import LLM_QUEUE_WAIT_SECONDS, LLM_SHED
+    from app.scheduler import FREE_TIER, PRIORITY_TIER, FairScheduler
+
+
+class GatewayError(Exception):
+    """LLM Gateway が呼び出しを断った時の例外"""
+
+
+class GatewayOverloadedError(GatewayError):
+    pass
+
+
+class GatewayTimeoutError(GatewayError):
+    pass
+
+
+class CircuitOpenError(GatewayError):
+    pass
+
+
+@lru_cache(maxsize=None)
+def _google_exceptions():
+    # google.api_core は import が重いので、最初にエラーを判定する時まで読み込まない
+    from google.api_core import exceptions
+    return exceptions
+
+
+def is_rate_limited(e: Exception) -> bool:
+    g = _google_exceptions()
+    return isinstance(e, (g.ResourceExhausted, g.TooManyRequests)) or "429" in str(e)
+
+
+def is_retryable(e: Exception) -> bool:
+    g = _google_exceptions()
+    retryable = (
+        g.ResourceExhausted, g.TooManyRequests, g.ServiceUnavailable,
+        g.InternalServerError, g.DeadlineExceeded, asyncio.TimeoutError,
+    )
+    return isinstance(e, retryable) or any(code in str(e) for code in ("429", "500", "503", "504"))
+
+
+class TokenBucket:
+    """API の回数制限に合わせて、1秒あたり rate 回まで（最大 capacity 回のまとめ撃ち）に抑える"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, deadline: float):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait = (1 - self.tokens) / self.rate
+            if time.monotonic() + wait > deadline:
+                raise GatewayTimeoutError("LLM rate limit wait exceeded the deadline")
+            await asyncio.sleep(wait)
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class AdaptiveLimiter:
+    """AIMD で同時実行数の上限を調整する（成功で少しずつ増やし、429 で半分に減らす）"""
+
+    def __init__(self, initial: int, minimum: int, maximum: int):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, deadline: float):
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self.in_flight < int(self.limit)),
+                    timeout=max(0.0, deadline - time.monotonic()),
+                )
+            except asyncio.TimeoutError:
+                raise GatewayTimeoutError("LLM concurrency wait exceeded the deadline")
+            self.in_flight += 1
+
+    async def release(self, rate_limited: bool = False, succeeded: bool = False):
+        async with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(self.minimum, self.limit / 2)
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """
+    連続で失敗したら一定時間すぐに断り、その後1件だけ試して復旧を確かめる。
+    確認役の1件が結果を出さずに終わった時（キャンセル等）は release_probe() で次の呼び出しに譲り、
+    probe_timeout 秒たっても戻らない確認役も見限って次の呼び出しに譲る。
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float, probe_timeout: float = LLM_BREAKER_PROBE_TIMEOUT_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probe_timeout = probe_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+
+    def allows(self) -> bool:
+        """状態を変えずに、今通せる見込みがあるか（並ぶ前に早めに断るための判定）"""
+        now = time.monotonic()
+        if self.state == "open":
+            return now - self.opened_at >= self.cooldown
+        if self.state == "half_open":
+            return now - self.probe_started_at >= self.probe_timeout
+        return True
+
+    def check(self) -> bool:
+        """通してよいか確かめる。通せなければ CircuitOpenError。この呼び出しが確認役なら True を返す"""
+        if self.state == "closed":
+            return False
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at < self.cooldown:
+            raise CircuitOpenError("LLM circuit breaker is open")
+        if self.state == "half_open" and now - self.probe_started_at < self.probe_timeout:
+            # 確認中の1件が終わるまでは他を通さない
+            raise CircuitOpenError("LLM circuit breaker is probing")
+        self.state = "half_open"
+        self.probe_started_at = now
+        return True
+
+    def release_probe(self):
+        """確認役が成功も失敗も記録せずに終わった。クールダウンは済んでいるので、次の呼び出しがすぐ確認役になる"""
+        if self.state == "half_open":
+            self.state = "open"
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class LLMGateway:
+    """
+    Gemini 呼び出しの前段。公平な待ち行列（上限・期限付き）→ トークンバケット → AIMD の同時実行枠 の順に通し、
+    一時的なエラーはジッター付きの指数バックオフでリトライする。上流が不調な間はサーキットブレーカーで即座に断る。
+    枠が空くたびに FairScheduler が次の1件を選ぶ（優先クラスを重み付きで先に、同じクラス内はユーザーごとに順番に）。
+    """
+
+    def __init__(
+        self,
+        rate_per_minute: float = LLM_RATE_PER_MINUTE,
+        burst: int = LLM_BURST,
+        max_retries: int = LLM_MAX_RETRIES,
+        max_waiters: int = LLM_QUEUE_MAX_WAITERS,
+        queue_deadline: float = LLM_QUEUE_DEADLINE_SECONDS,
+        call_timeout: float = LLM_CALL_TIMEOUT_SECONDS,
+    ):
+        self.bucket = TokenBucket(rate_per_minute / 60.0, burst)
+        self.limiter = AdaptiveLimiter(LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX)
+        self.breaker = CircuitBreaker(LLM_BREAKER_FAILURE_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS)
+        self.max_retries = max_retries
+        self.max_waiters = max_waiters
+        self.queue_deadline = queue_deadline
+        self.call_timeout = call_timeout
+        self.deadlines = {PRIORITY_TIER: LLM_PRIORITY_QUEUE_DEADLINE_SECONDS, FREE_TIER: queue_deadline}
+        self.scheduler = FairScheduler(on_expired=self._expire)
+        self._dispatcher = None
+        self._service_seconds = None   # 1回の呼び出しにかかる時間の移動平均（待ち時間の見積もり用）
+        self.counters = {
+            "calls": 0, "successes": 0, "failures": 0, "retries": 0,
+            "rejected_overload": 0, "rejected_circuit": 0, "rejected_deadline": 0, "shed_predicted": 0,
+        }
+
+    def _expire(self, ticket):
+        self.counters["rejected_deadline"] += 1
+        ticket.future.set_exception(GatewayTimeoutError("LLM queue wait exceeded the deadline"))
+
+    def estimated_wait(self, user_id: str, tier: str) -> float:
+        """今から並んだ場合に枠が回ってくるまでの見積もり秒数"""
+        ahead = self.scheduler.position(user_id, tier)
+        rate = self.bucket.rate
+        if self._service_seconds:
+            rate = min(rate, self.limiter.limit / self._service_seconds)
+        if ahead == 0 and self.limiter.in_flight < int(self.limiter.limit):
+            return 0.0
+        return max(0.0, ahead + 1 - self.bucket.tokens) / rate
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """枠（レートと同時実行数）が空くたびに、スケジューラーが選んだ1件に渡す"""
+        try:
+            while self.scheduler.depth():
+                far = time.monotonic() + 3600
+                await self.bucket.acquire(far)
+                await self.limiter.acquire(far)
+                ticket = self.scheduler.pop()
+                if ticket is None:
+                    # 待っていた人が全員いなくなった
+                    self.bucket.refund()
+                    await self.limiter.release()
+                    continue
+                ticket.future.set_result(None)
+        finally:
+            self._dispatcher = None
+
+    def _reject_circuit(self, tier: str):
+        self.counters["rejected_circuit"] += 1
+        LLM_SHED.inc(tier=tier, reason="circuit_open")
+        raise CircuitOpenError(f"LLM circuit breaker is {'probing' if self.breaker.state == 'half_open' else 'open'}")
+
+    async def _admit(self, deadline: float, user_id: str, tier: str) -> bool:
+        """
+        公平な待ち行列に並び、レートと同時実行数の枠を受け取る。
+        戻り値はこの呼び出しがサーキットブレーカーの確認役かどうか（確認役なら結果を必ず記録するか release_probe する）。
+        """
+        if self.scheduler.depth() >= self.max_waiters:
+            self.counters["rejected_overload"] += 1
+            LLM_SHED.inc(tier=tier, reason="queue_full")
+            raise GatewayOverloadedError("LLM wait queue is full")
+        if not self.breaker.allows():
+            self._reject_circuit(tier)
+        # 期限までに順番が回ってこない見込みなら、並ばせずにすぐ断る
+        if self.estimated_wait(user_id, tier) > deadline - time.monotonic():
+            self.counters["shed_predicted"] += 1
+            LLM_SHED.inc(tier=tier, reason="predicted")
+            raise GatewayOverloadedError("LLM queue cannot meet the deadline")
+
+        ticket = self.scheduler.submit(user_id, tier, deadline)
+        self._ensure_dispatcher()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            if not self._granted(ticket):
+                ticket.future.cancel()
+                self.scheduler.cancel(ticket)
+                self.counters["rejected_deadline"] += 1
+                LLM_SHED.inc(tier=ticket.tier, reason="expired")
+                raise GatewayTimeoutError("LLM queue wait exceeded the deadline")
+        except asyncio.CancelledError:
+            # 待っている間に切断された。枠を受け取った直後なら返す
+            if self._granted(ticket):
+                await self.limiter.release()
+            else:
+                ticket.future.cancel()
+                self.scheduler.cancel(ticket)
+            raise
+        LLM_QUEUE_WAIT_SECONDS.observe(time.monotonic() - ticket.enqueued_at, tier=ticket.tier)
+        # 🌟 確認役は枠を受け取ってから決める（並んでいる間に断られた呼び出しが確認役を使ってしまわないように）
+        try:
+            return self.breaker.check()
+        except CircuitOpenError:
+            self.bucket.refund()
+            await self.limiter.release()
+            self._reject_circuit(ticket.tier)
+
+    @staticmethod
+    def _granted(ticket) -> bool:
+        return ticket.future.done() and not ticket.future.cancelled() and ticket.future.exception() is None
+
+    def _observe_service(self, started: float):
+        elapsed = time.monotonic() - started
+        self._service_seconds = elapsed if self._service_seconds is None else 0.8 * self._service_seconds + 0.2 * elapsed
+
+    async def _backoff(self, attempt: int, retry_deadline: float) -> bool:
+        # Full Jitter: 0〜(0.5秒 × 2^attempt) の間でランダムに待つ
+        delay = random.uniform(0, min(8.0, 0.5 * (2 ** attempt)))
+        if time.monotonic() + delay > retry_deadline:
+            return False
+        self.counters["retries"] += 1
+        await asyncio.sleep(delay)
+        await self.bucket.acquire(retry_deadline)
+        return True
+
+    def _record(self, error: Exception = None) -> bool:
+        if error is None:
+            self.counters["successes"] += 1
+            self.breaker.record_success()
+        elif is_retryable(error):
+            self.counters["failures"] += 1
+            self.breaker.record_failure()
+        else:
+            # 400 等は上流が応答できている証拠なので、ブレーカーは閉じたままにする
+            self.counters["failures"] += 1
+            self.breaker.record_success()
+        return True
+
+    async def _should_retry(self, e: Exception, attempt: int, retry_deadline: float) -> bool:
+        if not is_retryable(e) or attempt >= self.max_retries:
+            return False
+        print(f"🔁 LLM retry {attempt + 1}/{self.max_retries}: {e}")
+        return await self._backoff(attempt + 1, retry_deadline)
+
+    def _deadline(self, tier: str, timeout: float = None) -> float:
+        return time.monotonic() + (timeout or self.deadlines.get(tier, self.queue_deadline))
+
+    async def call(self, factory, timeout: float = None, user_id: str = "", tier: str = FREE_TIER):
+        """factory() が返すコルーチンを実行する（リトライのたびに factory を呼び直す）"""
+        self.counters["calls"] += 1
+        probe = await self._admit(self._deadline(tier, timeout), user_id, tier)
+        started = time.monotonic()
+        retry_deadline = started + self.call_timeout
+        rate_limited = succeeded = recorded = False
+        try:
+            attempt = 0
+            while True:
+                try:
+                    result = await asyncio.wait_for(factory(), timeout=self.call_timeout)
+                except Exception as e:
+                    rate_limited = rate_limited or is_rate_limited(e)
+                    if await self._should_retry(e, attempt, retry_deadline):
+                        attempt += 1
+                        continue
+                    recorded = self._record(e)
+                    raise
+                recorded = self._record()
+                succeeded = True
+                return result
+        finally:
+            if probe and not recorded:
+                # キャンセル・切断・ヘッジで捨てられた確認役は、結果が無いので次の呼び出しに譲る
+                self.breaker.release_probe()
+            self._observe_service(started)
+            await self.limiter.release(rate_limited=rate_limited, succeeded=succeeded)
+
+    async def stream(self, factory, timeout: float = None, user_id: str = "", tier: str = FREE_TIER):
+        """ストリーミング版。最初のチャンクが届く前のエラーだけリトライし、枠は最後まで持ち続ける"""
+        self.counters["calls"] += 1
+        probe = await self._admit(self._deadline(tier, timeout), user_id, tier)
+        started = time.monotonic()
+        retry_deadline = started + self.call_timeout
+        rate_limited = succeeded = recorded = False
+        try:
+            attempt = 0
+            while True:
+                emitted = False
+                try:
+                    response = await asyncio.wait_for(factory(), timeout=self.call_timeout)
+                    async for chunk in response:
+                        emitted = True
+                        yield chunk
+                except Exception as e:
+                    rate_limited = rate_limited or is_rate_limited(e)
+                    if not emitted and await self._should_retry(e, attempt, retry_deadline):
+                        attempt += 1
+                        continue
+                    recorded = self._record(e)
+                    raise
+                recorded = self._record()
+                succeeded = True
+                return
+        finally:
+            if probe and not recorded:
+                # キャンセル・切断・ヘッジで捨てられた確認役は、結果が無いので次の呼び出しに譲る
+                self.breaker.release_probe()
+            self._observe_service(started)
+            await self.limiter.release(rate_limited=rate_limited, succeeded=succeeded)
+
+    def stats(self) -> dict:
+        self.bucket._refill()
+        return {
+            **self.counters,
+            "concurrency_limit": round(self.limiter.limit, 2),
+            "in_flight": self.limiter.in_flight,
+            "waiting": self.scheduler.depth(),
+            "scheduler": self.scheduler.stats(),
+            "tokens": round(self.bucket.tokens, 2),
+            "circuit": self.breaker.state,
+        }
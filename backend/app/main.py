@@ -1,23 +1,92 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import Literal, Optional
+from dataclasses import dataclass
+import asyncio
+import csv
+import io
+import json
 import os
-import google.generativeai as genai
+import time
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
 import traceback
 
 # 設定とプロンプトの読み込み
 try:
-    from .config import ADMIN_USER_ID, MODEL_NAME, model as gemini_base_model
-    from .db import get_supabase_client
-    from .prompts import get_coach_instruction
+    from .config import (
+        ADMIN_USER_ID, DAILY_LIMIT, HISTORY_TURNS, MODEL_NAME, RESPONSE_CACHE_ENABLED, WRITE_BEHIND_ENABLED,
+        MODEL_DISCOVERY_ON_STARTUP, OPENER_BANK_ENABLED, EXPORT_PAGE_SIZE, STATS_DEFAULT_DAYS, STATS_MAX_DAYS, FAST_PATH_ENABLED, IDEMPOTENCY_REPLAY_TIMEOUT_SECONDS, PRIORITY_USER_IDS, BATCH_MAX_INPUT_CHARS, BATCH_MAX_PARALLEL,
+        RETRIEVAL_ENABLED, RETRIEVAL_MAX_TURNS_PER_USER, RETRIEVAL_MIN_SCORE, RETRIEVAL_TOP_K,
+        gemini_configured, get_base_model, get_genai,
+    )
+    from .storage import create_repository
+    from .model_registry import model_registry
+    from .prompts import COACH_LEVELS, COACH_MODES
+    from .concurrency import run_blocking, shutdown_executor, spawn
+    from .quota import QuotaEngine, create_quota_store
+    from .history_pool import HistoryPool
+    from .write_behind import WriteBehindQueue
+    from .response_cache import ResponseCache
+    from .llm_gateway import CircuitOpenError, GatewayError, LLMGateway
+    from .scheduler import FREE_TIER, PRIORITY_TIER
+    from .hedging import ModelChain
+    from .batching import chunk_prompt, merge_results, split_into_chunks
+    from .opener_bank import ASSESSMENT_MODE, ASSESSMENT_OPENER, OpenerBank, is_assessment_opener
+    from .assessment import CONTINUE, DONE, RETAKE_HINT, AssessmentTracker, format_result, parse_result
+    from .fast_path import REJECT, TEMPLATE, FastPathClassifier
+    from .learning_stats import LearningStats, jst_day, summarize
+    from .context_builder import SummaryStore, build_context
+    from .retrieval import RetrievalIndex
+    from .idempotency import IdempotencyCache, IdempotencyConflictError
+    from .metrics import (
+        CONTEXT_TOKENS, CONTEXT_TOKENS_SAVED, MetricsMiddleware, STAGE_SECONDS, record_token_usage, registry as metrics_registry, stage,
+    )
+    from .pagination import (
+        HISTORY_COLUMNS, HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT, compute_etag, decode_cursor, encode_cursor, project_items,
+    )
+    from .responses import CompressionMiddleware, FastJSONResponse
 except ImportError:
-    from app.config import ADMIN_USER_ID, MODEL_NAME, model as gemini_base_model
-    from app.db import get_supabase_client
-    from app.prompts import get_coach_instruction
+    from app.config import (
+        ADMIN_USER_ID, DAILY_LIMIT, HISTORY_TURNS, MODEL_NAME, RESPONSE_CACHE_ENABLED, WRITE_BEHIND_ENABLED,
+        MODEL_DISCOVERY_ON_STARTUP, OPENER_BANK_ENABLED, EXPORT_PAGE_SIZE, STATS_DEFAULT_DAYS, STATS_MAX_DAYS, FAST_PATH_ENABLED, IDEMPOTENCY_REPLAY_TIMEOUT_SECONDS, PRIORITY_USER_IDS, BATCH_MAX_INPUT_CHARS, BATCH_MAX_PARALLEL,
+        RETRIEVAL_ENABLED, RETRIEVAL_MAX_TURNS_PER_USER, RETRIEVAL_MIN_SCORE, RETRIEVAL_TOP_K,
+        gemini_configured, get_base_model, get_genai,
+    )
+    from app.storage import create_repository
+    from app.model_registry import model_registry
+    from app.prompts import COACH_LEVELS, COACH_MODES
+    from app.concurrency import run_blocking, shutdown_executor, spawn
+    from app.quota import QuotaEngine, create_quota_store
+    from app.history_pool import HistoryPool
+    from app.write_behind import WriteBehindQueue
+    from app.response_cache import ResponseCache
+    from app.llm_gateway import CircuitOpenError, GatewayError, LLMGateway
+    from app.scheduler import FREE_TIER, PRIORITY_TIER
+    from app.hedging import ModelChain
+    from app.batching import chunk_prompt, merge_results, split_into_chunks
+    from app.opener_bank import ASSESSMENT_MODE, ASSESSMENT_OPENER, OpenerBank, is_assessment_opener
+    from app.assessment import CONTINUE, DONE, RETAKE_HINT, AssessmentTracker, format_result, parse_result
+    from app.fast_path import REJECT, TEMPLATE, FastPathClassifier
+    from app.learning_stats import LearningStats, jst_day, summarize
+    from app.context_builder import SummaryStore, build_context
+    from app.retrieval import RetrievalIndex
+    from app.idempotency import IdempotencyCache, IdempotencyConflictError
+    from app.metrics import (
+        CONTEXT_TOKENS, CONTEXT_TOKENS_SAVED, MetricsMiddleware, STAGE_SECONDS, record_token_usage, registry as metrics_registry, stage,
+    )
+    from app.pagination import (
+        HISTORY_COLUMNS, HISTORY_DEFAULT_LIMIT, HISTORY_MAX_LIMIT, compute_etag, decode_cursor, encode_cursor, project_items,
+    )
+    from app.responses import CompressionMiddleware, FastJSONResponse
 
-app = FastAPI()
+# 🌟 レスポンスは orjson で書き出す
+app = FastAPI(default_response_class=FastJSONResponse)
+
+# 🌟 会話履歴の保存先（STORAGE_BACKEND で Supabase / SQLite を切り替える）
+storage = create_repository()
 
 # CORS設定
 app.add_middleware(
@@ -26,120 +95,875 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+# Accept-Encoding に合わせて br / gzip で圧縮（ストリーミングはそのまま）
+app.add_middleware(CompressionMiddleware)
+# ステージ別の計測と Server-Timing ヘッダー（圧縮までの時間も total に入る）
+app.add_middleware(MetricsMiddleware)
 
-supabase = get_supabase_client()
+# ==========================================
+# 起動処理（ネットワークや重い import で起動を止めない）
+# ==========================================
+warmup_state = {"ready": False, "error": None}
 
-# 🌟 起動時にモデル一覧を表示（デバッグ用）
-@app.on_event("startup")
-async def list_models():
+async def discover_models() -> list:
+    """generateContent に対応した Google AI のモデル一覧を取得する（ネットワークを使う）"""
+    genai = get_genai()
+    models = await run_blocking(lambda: list(genai.list_models()))
+    return [m.name for m in models if 'generateContent' in m.supported_generation_methods]
+
+async def log_available_models():
     print("--- 🔍 利用可能なGoogle AIモデル一覧 ---")
     try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                print(f"✅ {m.name}")
+        for name in await discover_models():
+            print(f"✅ {name}")
     except Exception as e:
         print(f"❌ モデルリスト取得失敗: {e}")
     print("---------------------------------------")
 
+async def warm_up():
+    """SDK とクライアントの初期化をバックグラウンドで済ませ、終わったら /readyz を ready にする"""
+    try:
+        await run_blocking(storage.available)
+        # 🌟 (level, mode) ごとのモデルを作っておく
+        if gemini_configured():
+            await run_blocking(get_base_model)
+            for model_name in model_chain.models:
+                await run_blocking(model_registry.warm, model_name)
+        # 🌟 実力判定の書き出しの作り置きを保存先から読み、足りない分（指紋が変わった時など）だけ裏で作る
+        if opener_bank:
+            await run_blocking(opener_bank.load)
+            if gemini_configured() and opener_bank.missing():
+                spawn(opener_bank.fill(generate_opener))
+        warmup_state["ready"] = True
+        print("✅ Warm-up finished")
+    except Exception as e:
+        warmup_state["error"] = str(e)
+        print(f"❌ Warm-up Error: {e}")
+
+@app.on_event("startup")
+async def start_warm_up():
+    # 🌟 起動自体は待たせない（完了は /readyz で確認できる）
+    app.state.warm_up_task = asyncio.create_task(warm_up())
+    if MODEL_DISCOVERY_ON_STARTUP:
+        app.state.discovery_task = asyncio.create_task(log_available_models())
+
+# 🌟 起動時に Write-Behind のキューを動かす（前回の未保存分もここで復元）
+@app.on_event("startup")
+async def start_write_behind():
+    if storage.configured() and write_behind:
+        await write_behind.start()
+    if storage.configured():
+        await learning_stats.start()
+
+@app.on_event("shutdown")
+async def shutdown_background_tasks():
+    # 残っている会話を書き切ってからスレッドプールを閉じる
+    if storage.configured() and write_behind:
+        await write_behind.stop()
+    if storage.configured():
+        await learning_stats.stop()
+    shutdown_executor()
+
 # 🌟 ChatRequestを統合（一つにまとめました）
 class ChatRequest(BaseModel):
     message: str
     user_id: str  
-    level: str
-    mode: str = "assessment" 
+    # 🌟 level / mode はモデルの使い回し・メトリクスのラベルに使うので、決まった値だけ受け付ける
+    level: Literal[COACH_LEVELS]
+    mode: Literal[COACH_MODES] = "assessment"
+    # 🌟 送信ごとにフロントエンドが付けるキー（同じキーの再送は1回分として扱う）
+    idempotency_key: Optional[str] = None
 
 @app.get("/")
 def read_root():
-    db_status = "Connected" if supabase else "Disconnected"
+    db_status = "Connected" if storage.available() else "Disconnected"
     return {"status": "ok", "database": db_status}
 
-@app.post("/chat")
-async def chat_endpoint(payload: ChatRequest):
-    if not gemini_base_model:
-        raise HTTPException(status_code=500, detail="Gemini API is not configured")
+@app.get("/healthz")
+def healthz():
+    """生存確認（プロセスが応答できれば OK。外部サービスには触らない）"""
+    return {"status": "ok"}
 
+@app.get("/readyz")
+def readyz():
+    """準備完了確認（SDK とクライアントの初期化が終わるまでは 503）"""
+    if not warmup_state["ready"]:
+        return FastJSONResponse(
+            {"status": "starting", "error": warmup_state["error"]}, status_code=503
+        )
+    return {"status": "ready"}
+
+@app.get("/internal/models")
+async def list_models():
+    """利用可能なモデル一覧（以前は起動時に毎回取得していたもの）"""
     try:
-        # 1. 👑 1日50回制限チェック
-        if payload.user_id != ADMIN_USER_ID and supabase:
-            JST = timezone(timedelta(hours=9), 'JST')
-            now = datetime.now(JST)
-            today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-
-            count_res = supabase.table("chat_history") \
-                .select("id", count="exact") \
-                .eq("user_id", payload.user_id) \
-                .gte("created_at", today_start) \
-                .execute()
-            
-            if count_res.count >= 50:
-                return {
-                    "user_message": payload.message,
-                    "ai_response": "🤖 **コーチからのお知らせ：**\n\n本日の無料枠（50回）を使い切りました！また明日お話ししましょう！"
-                }
-
-        # 2. 🧠 会話履歴（記憶）の取得（直近5往復分）
-        gemini_history = []
-        if supabase:
-            try:
-                hist_res = supabase.table("chat_history") \
-                    .select("user_message", "ai_response") \
-                    .eq("user_id", payload.user_id) \
-                    .order("created_at", desc=False) \
-                    .limit(5).execute()
-                
-                for row in hist_res.data:
-                    gemini_history.append({"role": "user", "parts": [str(row["user_message"])]})
-                    gemini_history.append({"role": "model", "parts": [str(row["ai_response"])]})
-            except Exception as e:
-                print(f"✖ History Fetch Error: {e}")
+        return {"models": await discover_models()}
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"モデルリスト取得失敗: {e}")
 
-        # 3. 🎭 プロンプトとモデルの準備
-        # 🌟 mode を渡して、専用の指示書を取得します
-        instruction = get_coach_instruction(payload.level, payload.mode)
-        dynamic_model = genai.GenerativeModel(
-            model_name=MODEL_NAME, 
-            system_instruction=instruction
+async def count_today_turns(user_id: str, today_start: str) -> int:
+    """当日分の会話数を数える（クォータの種。ユーザーごとに1日1回だけ呼ばれる）"""
+    if not storage.available():
+        return 0
+    count = await run_blocking(storage.count_since, user_id, today_start)
+    # DB にまだ書き込まれていない会話も数に入れる
+    if write_behind:
+        since = datetime.fromisoformat(today_start)
+        count += sum(
+            1 for row in write_behind.pending_rows(user_id)
+            if row.get("counts_quota", True) and datetime.fromisoformat(row["created_at"]) >= since
         )
+    return count
+
+quota_engine = QuotaEngine(create_quota_store(), count_today_turns, limit=DAILY_LIMIT)
+
+async def is_over_daily_limit(user_id: str) -> bool:
+    """1日の利用回数制限チェック（プロセス内カウンターで判定する）"""
+    if user_id == ADMIN_USER_ID:
+        return False
+    return await quota_engine.is_over_limit(user_id)
+
+history_pool = HistoryPool()
+
+# chat_history へのまとめ書きは Write-Behind から呼ばれる
+write_behind = WriteBehindQueue(storage.insert_many) if WRITE_BEHIND_ENABLED else None
+
+def with_pending_rows(user_id: str, rows: list) -> list:
+    """DB から読んだ会話（古い順）の後ろに、まだ書き込まれていない会話を足す（書き込み済みと重複するものは除く）"""
+    if not write_behind:
+        return rows
+    last_saved = datetime.fromisoformat(rows[-1]["created_at"]) if rows else None
+    return rows + [
+        row for row in write_behind.pending_rows(user_id)
+        if last_saved is None or datetime.fromisoformat(row["created_at"]) > last_saved
+    ]
+
+def to_turns(rows: list) -> list:
+    return [{"user_message": str(row["user_message"]), "ai_response": str(row["ai_response"])} for row in rows]
+
+summary_store = SummaryStore(storage.load_summary, storage.save_summary)
+
+def fold_into_summary(user_id: str, turn: dict):
+    """窓から外れたターンを要約に畳み込んで保存する（同期。スレッドプールから呼ぶ）"""
+    summary_store.load_summary(user_id)
+    summary_store.persist(user_id, summary_store.fold(user_id, turn))
+
+retrieval_index = RetrievalIndex() if RETRIEVAL_ENABLED else None
+_rebuilding_indexes = set()
+
+def fetch_turns_for_index(user_id: str) -> list:
+    """検索インデックス用に過去の会話をまとめて読む（古い順）"""
+    return to_turns(with_pending_rows(user_id, storage.latest_turns(user_id, RETRIEVAL_MAX_TURNS_PER_USER)))
+
+async def rebuild_retrieval_index(user_id: str):
+    try:
+        turns = await run_blocking(fetch_turns_for_index, user_id)
+        await run_blocking(retrieval_index.rebuild, user_id, turns)
+    except Exception as e:
+        print(f"✖ Retrieval Index Error: {e}")
+    finally:
+        _rebuilding_indexes.discard(user_id)
+
+def find_related_turns(user_id: str, message: str, exclude_recent: int) -> list:
+    """今回の発言に近い過去のやりとりを引く（インデックスが無ければ裏で作り、今回は何も添えない）"""
+    if not retrieval_index or not storage.available():
+        return []
+    if not retrieval_index.has(user_id):
+        if user_id not in _rebuilding_indexes:
+            _rebuilding_indexes.add(user_id)
+            spawn(rebuild_retrieval_index(user_id))
+        return []
+    with stage("retrieval"):
+        return retrieval_index.query(
+            user_id, message, RETRIEVAL_TOP_K, exclude_recent=exclude_recent, min_score=RETRIEVAL_MIN_SCORE,
+        )
+
+async def fetch_gemini_history(user_id: str, mode: str, message: str) -> list:
+    """会話履歴（記憶）の取得。直近の会話をトークン予算に収め、古い会話は要約と関連するやりとりで渡す"""
+    turns = await fetch_recent_turns(user_id)
+    if not turns:
+        return []
+
+    summary = summary_store.get_cached(user_id)
+    if summary is None:
+        summary = await run_blocking(summary_store.load_summary, user_id)
+    # 直近の会話はそのまま渡すので、検索の対象からは外す
+    related = find_related_turns(user_id, message, exclude_recent=len(turns))
+
+    gemini_history, report = build_context(turns, mode, summary, related)
+    CONTEXT_TOKENS.observe(report["context_tokens"], mode=mode)
+    CONTEXT_TOKENS_SAVED.observe(report["tokens_saved"], mode=mode)
+    return gemini_history
+
+async def fetch_recent_turns(user_id: str) -> list:
+    """直近N往復を古い順に返す（プールに無い時だけ DB を読む）"""
+    turns = history_pool.get(user_id)
+    if turns is None:
+        if not storage.available():
+            return []
+        try:
+            rows = await run_blocking(storage.latest_turns, user_id, HISTORY_TURNS)
+        except Exception as e:
+            print(f"✖ History Fetch Error: {e}")
+            return []
+
+        turns = to_turns(with_pending_rows(user_id, rows)[-HISTORY_TURNS:])
+        history_pool.put(user_id, turns)
+    return turns
+
+learning_stats = LearningStats(storage.add_daily_stats)
+
+async def save_chat_turn(
+    user_id: str, user_message: str, ai_text: str, mode: str = "default", level: str = "", count_quota: bool = True,
+):
+    """会話履歴を保存（Write-Behind が有効ならキューに積んですぐ戻る）。count_quota=False なら利用回数に数えない"""
+    if not storage.available():
+        return
+    data = {
+        "user_id": user_id,
+        "user_message": user_message,
+        "ai_response": ai_text,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        # 定型文の返答は履歴には残すが、クォータの数え直し（count_since）では数えない
+        "counts_quota": count_quota,
+    }
+    try:
+        if write_behind:
+            await write_behind.enqueue(data)
+        else:
+            await run_blocking(storage.insert, data)
+    except Exception as e:
+        print(f"✖ Database Save Error: {e}")
+        return
+    # 受け付けた時点でメモリ上の履歴・学習状況の集計・クォータにも反映する
+    dropped = history_pool.append(user_id, user_message, ai_text)
+    learning_stats.record(user_id, mode, level, user_message, ai_text, data["created_at"])
+    if retrieval_index:
+        retrieval_index.add(user_id, {"user_message": user_message, "ai_response": ai_text})
+    if dropped:
+        # 窓から外れた会話は要約に畳み込む（返答は待たせない）
+        spawn(run_blocking(fold_into_summary, user_id, dropped))
+    if count_quota:
+        await quota_engine.record_turn(user_id)
+
+response_cache = ResponseCache() if RESPONSE_CACHE_ENABLED else None
+llm_gateway = LLMGateway()
+
+def user_tier(user_id: str) -> str:
+    """LLM の待ち行列での優先クラス（管理者・有料ユーザーは優先）"""
+    if user_id == ADMIN_USER_ID or user_id in PRIORITY_USER_IDS:
+        return PRIORITY_TIER
+    return FREE_TIER
+
+# 🌟 作り置きは保存先で全コンテナが共有する（コールドスタートのたびに LLM で作り直さない）
+opener_bank = OpenerBank(storage.load_openers, storage.save_openers) if OPENER_BANK_ENABLED else None
+
+async def generate_opener(level: str) -> str:
+    """作り置き用に、履歴なしで実力判定の最初の質問を作る"""
+    response, _ = await model_chain.call(ASSESSMENT_MODE, lambda model_name: llm_gateway.call(
+        lambda: model_registry.get_model(level, ASSESSMENT_MODE, model_name=model_name)
+            .start_chat(history=[]).send_message_async(ASSESSMENT_OPENER),
+        user_id="opener-bank", tier=FREE_TIER,
+    ))
+    record_token_usage(getattr(response, "usage_metadata", None), ASSESSMENT_MODE, level)
+    return response.text
+
+LIMIT_REACHED_MESSAGE = f"🤖 **コーチからのお知らせ：**\n\n本日の無料枠（{DAILY_LIMIT}回）を使い切りました！また明日お話ししましょう！"
+
+@dataclass
+class PreparedChat:
+    chat_session: object
+    cache_key: str
+    gemini_history: list
+    level: str
+    mode: str
+
+    def session_for(self, model_name: str):
+        """model_name で会話を続けるためのチャットセッション（主モデルなら作っておいたものを使う）"""
+        if model_name == MODEL_NAME:
+            return self.chat_session
+        fallback_model = model_registry.get_model(self.level, self.mode, model_name=model_name)
+        return fallback_model.start_chat(history=self.gemini_history)
+
+model_chain = ModelChain()
+
+async def prepare_chat_session(payload: ChatRequest):
+    """制限チェック・履歴取得・モデル準備をまとめて行う（制限超過時は None を返す）"""
+    # 1. 👑 1日50回制限チェック と 2. 🧠 履歴の取得 を並行して実行
+    over_limit, gemini_history = await asyncio.gather(
+        timed("quota", is_over_daily_limit(payload.user_id)),
+        timed("history", fetch_gemini_history(payload.user_id, payload.mode, payload.message)),
+    )
+    if over_limit:
+        return None
+
+    with stage("model"):
+        # 3. 🎭 プロンプトとモデルの準備
+        # 🌟 (level, mode) ごとに作り置きしたモデルを使い回します
+        dynamic_model = model_registry.get_model(payload.level, payload.mode)
 
         # 4. 💬 記憶を持たせたチャットセッションの開始
-        chat_session = dynamic_model.start_chat(history=gemini_history)
-        response = chat_session.send_message(payload.message)
-        ai_text = response.text
+        cache_key = response_cache.make_key(
+            payload.message, payload.level, payload.mode, MODEL_NAME, gemini_history
+        ) if response_cache else None
+        return PreparedChat(
+            dynamic_model.start_chat(history=gemini_history), cache_key, gemini_history, payload.level, payload.mode
+        )
+
+async def timed(name: str, coro):
+    """コルーチンの実行時間をステージとして記録する"""
+    with stage(name):
+        return await coro
+
+def get_cached_response(prepared: PreparedChat):
+    return response_cache.get(prepared.cache_key) if response_cache else None
+
+def store_cached_response(prepared: PreparedChat, ai_text: str):
+    if response_cache and ai_text:
+        response_cache.put(prepared.cache_key, ai_text)
+
+def format_chat_error(e: Exception) -> str:
+    """エラーメッセージを分かりやすく整形"""
+    err_msg = str(e)
+    if isinstance(e, CircuitOpenError):
+        err_msg = "コーチが混み合っています。少し時間をおいてから再送してください。"
+    elif isinstance(e, GatewayError):
+        err_msg = "ただいまアクセスが集中しています。少し待ってから再送してください。"
+    elif "429" in err_msg:
+        err_msg = "Google APIの回数制限です。少し待ってから再送してください。"
+    elif "404" in err_msg:
+        err_msg = f"モデル '{MODEL_NAME}' が見つかりません。config.pyを確認してください。"
+    return err_msg
+
+def chat_http_error(e: Exception) -> HTTPException:
+    if isinstance(e, HTTPException):
+        return e
+    status_code = 503 if isinstance(e, GatewayError) else 500
+    return HTTPException(status_code=status_code, detail=format_chat_error(e))
+
+assessment_tracker = AssessmentTracker(storage.load_assessment, storage.save_assessment)
+
+async def score_assessment(payload: ChatRequest) -> dict:
+    """判定テストのやりとりを1回の呼び出しで採点し、JSON の結果を返す"""
+    prompt = assessment_tracker.scoring_prompt(payload.user_id, payload.message)
+    response, _ = await model_chain.call(ASSESSMENT_MODE, lambda model_name: llm_gateway.call(
+        lambda: model_registry.get_scoring_model(model_name).start_chat(history=[]).send_message_async(prompt),
+        user_id=payload.user_id, tier=user_tier(payload.user_id),
+    ))
+    record_token_usage(getattr(response, "usage_metadata", None), ASSESSMENT_MODE, payload.level)
+    return parse_result(response.text)
+
+async def answer_assessment(payload: ChatRequest):
+    """
+    判定テストの進行をサーバー側で数える。採点する時・判定済みの時は返答を返し、
+    次の質問を LLM に出させる時は None を返す（書き出しならここでテストを始め直す）。
+    """
+    if payload.mode != ASSESSMENT_MODE:
+        return None
+    user_id = payload.user_id
+    if not assessment_tracker.is_loaded(user_id):
+        await run_blocking(assessment_tracker.load, user_id)
+    if is_assessment_opener(payload.message, payload.mode):
+        assessment_tracker.start(user_id, payload.level)
+        return None
+
+    action = assessment_tracker.answer(user_id, payload.level, payload.message)
+    if action == CONTINUE:
+        return None
+    if action == DONE:
+        # 🌟 判定済みなら保存してある結果を返す（LLM もクォータも使わない）
+        result = assessment_tracker.get(user_id)["result"]
+        return {"user_message": payload.message, "ai_response": f"{format_result(result)}\n\n{RETAKE_HINT}"}
+
+    if await timed("quota", is_over_daily_limit(user_id)):
+        return {"user_message": payload.message, "ai_response": LIMIT_REACHED_MESSAGE}
+    with stage("llm"):
+        result = await score_assessment(payload)
+    ai_text = format_result(result)
+    await timed("save", save_chat_turn(user_id, payload.message, ai_text, payload.mode, payload.level))
+    # 採点結果を保存できてから最後の回答を数えて判定済みにする
+    assessment_tracker.complete(user_id, result)
+    spawn(run_blocking(assessment_tracker.persist, user_id))
+    return {"user_message": payload.message, "ai_response": ai_text}
+
+def track_assessment_turn(payload: ChatRequest, ai_text: str):
+    """判定テスト中の1往復（保存できたもの）を数えて採点用に覚え、保存する。書き出しは回答に数えない"""
+    if payload.mode != ASSESSMENT_MODE or ai_text == LIMIT_REACHED_MESSAGE:
+        return
+    counted = not is_assessment_opener(payload.message, payload.mode)
+    assessment_tracker.record(payload.user_id, payload.message, ai_text, counted=counted)
+    spawn(run_blocking(assessment_tracker.persist, payload.user_id))
+
+def with_assessment_state(payload: ChatRequest, result: dict) -> dict:
+    """判定モードの返答には進行状態を添える（フロントエンドはこれでプログレスバーを出す）"""
+    if payload.mode == ASSESSMENT_MODE:
+        result["assessment"] = assessment_tracker.state(payload.user_id)
+    return result
+
+async def answer_from_opener_bank(payload: ChatRequest):
+    """実力判定の書き出しには作り置きの質問を返す（履歴も LLM も使わない）。作り置きが無ければ None"""
+    if not opener_bank or not is_assessment_opener(payload.message, payload.mode):
+        return None
+    ai_text = opener_bank.pick(payload.level)
+    if ai_text is None:
+        return None
+    if await timed("quota", is_over_daily_limit(payload.user_id)):
+        return {"user_message": payload.message, "ai_response": LIMIT_REACHED_MESSAGE}
+    # 💾 LLM で作った時と同じく1往復として保存・カウントする
+    await timed("save", save_chat_turn(payload.user_id, payload.message, ai_text, payload.mode, payload.level))
+    return {"user_message": payload.message, "ai_response": ai_text}
+
+fast_path = FastPathClassifier() if FAST_PATH_ENABLED else None
+
+def check_fast_path(payload: ChatRequest):
+    """
+    LLM に渡す前の振り分け。空・長すぎる入力は HTTPException にし、
+    定型文で答えられるメッセージならその返答を、それ以外は None を返す
+    """
+    if not fast_path:
+        return None
+    decision = fast_path.classify(payload.message, payload.mode)
+    if decision.action == REJECT:
+        raise HTTPException(status_code=decision.status_code, detail=decision.detail)
+    return decision.text if decision.action == TEMPLATE else None
+
+async def answer_locally(payload: ChatRequest, ai_text: str) -> dict:
+    """定型文の返答（LLM を呼ばないのでクォータにも数えない。会話の流れが切れないよう履歴には残す）"""
+    await timed("save", save_chat_turn(
+        payload.user_id, payload.message, ai_text, payload.mode, payload.level, count_quota=False
+    ))
+    return {"user_message": payload.message, "ai_response": ai_text}
+
+async def run_chat(payload: ChatRequest) -> dict:
+    try:
+        assessed = await answer_assessment(payload)
+        if assessed is not None:
+            return with_assessment_state(payload, assessed)
+
+        opened = await answer_from_opener_bank(payload)
+        if opened is not None:
+            track_assessment_turn(payload, opened["ai_response"])
+            return with_assessment_state(payload, opened)
+
+        prepared = await prepare_chat_session(payload)
+        if prepared is None:
+            return {
+                "user_message": payload.message,
+                "ai_response": LIMIT_REACHED_MESSAGE
+            }
+
+        # 🌟 同じ入力への返答がキャッシュにあれば LLM を呼ばない
+        ai_text = get_cached_response(prepared)
+        if ai_text is None:
+            with stage("llm"):
+                # 🌟 主モデルが遅い・失敗した時は MODEL_CHAIN の次のモデルが答える
+                response, _ = await model_chain.call(payload.mode, lambda model_name: llm_gateway.call(
+                    lambda: prepared.session_for(model_name).send_message_async(payload.message),
+                    user_id=payload.user_id, tier=user_tier(payload.user_id),
+                ))
+            ai_text = response.text
+            record_token_usage(getattr(response, "usage_metadata", None), payload.mode, payload.level)
+            store_cached_response(prepared, ai_text)
         
         # 5. 💾 会話履歴をSupabaseに保存
-        if supabase:
-            try:
-                data ={
-                    "user_id": payload.user_id, 
-                    "user_message": payload.message,
-                    "ai_response": ai_text
-                }
-                supabase.table("chat_history").insert(data).execute()
-            except Exception as e:
-                print(f"✖ Database Save Error: {e}")
-
-        return {
+        await timed("save", save_chat_turn(payload.user_id, payload.message, ai_text, payload.mode, payload.level))
+        track_assessment_turn(payload, ai_text)
+
+        return with_assessment_state(payload, {
             "user_message": payload.message,
             "ai_response": ai_text
-        }
+        })
 
     except Exception as e:
         print(f"✖ Chat Error Traceback:\n{traceback.format_exc()}")
-        # エラーメッセージを分かりやすく整形
-        err_msg = str(e)
-        if "429" in err_msg:
-            err_msg = "Google APIの回数制限です。少し待ってから再送してください。"
-        elif "404" in err_msg:
-            err_msg = f"モデル '{MODEL_NAME}' が見つかりません。config.pyを確認してください。"
-            
-        raise HTTPException(status_code=500, detail=err_msg)
+        raise chat_http_error(e)
+
+idempotency_cache = IdempotencyCache()
+
+async def run_idempotent(payload: ChatRequest, runner) -> dict:
+    """冪等キーがあれば、同じキーの再送は実行中なら同じ処理の結果を待ち、完了済みならその結果を返す"""
+    if not payload.idempotency_key:
+        return await runner(payload)
+    try:
+        return await idempotency_cache.run(
+            payload.user_id, payload.idempotency_key, payload.message, lambda: runner(payload)
+        )
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        raise chat_http_error(e)
+
+@app.post("/chat")
+async def chat_endpoint(payload: ChatRequest):
+    if not gemini_configured():
+        raise HTTPException(status_code=500, detail="Gemini API is not configured")
+    # 🌟 空・長すぎる入力とお礼・相づちは LLM に渡さずにここで返す
+    local_text = check_fast_path(payload)
+    if local_text is not None:
+        return await run_idempotent(payload, lambda p: answer_locally(p, local_text))
+    return await run_idempotent(payload, run_chat)
+
+async def correct_chunk(payload: ChatRequest, prompt: str, limiter: asyncio.Semaphore) -> str:
+    """1かたまり分を添削する（履歴は渡さず、同じ level/mode の指示書だけで見る）"""
+    async with limiter:
+        response, _ = await model_chain.call(payload.mode, lambda model_name: llm_gateway.call(
+            lambda: model_registry.get_model(payload.level, payload.mode, model_name=model_name)
+                .start_chat(history=[]).send_message_async(prompt),
+            user_id=payload.user_id, tier=user_tier(payload.user_id),
+        ))
+    record_token_usage(getattr(response, "usage_metadata", None), payload.mode, payload.level)
+    return response.text
+
+async def run_batch(payload: ChatRequest) -> dict:
+    try:
+        if await timed("quota", is_over_daily_limit(payload.user_id)):
+            return {"user_message": payload.message, "ai_response": LIMIT_REACHED_MESSAGE, "parts": 0}
+
+        chunks = split_into_chunks(payload.message)
+        if not chunks:
+            raise HTTPException(status_code=422, detail="添削する文章が空です。")
+        limiter = asyncio.Semaphore(BATCH_MAX_PARALLEL)
+        with stage("llm"):
+            # 🌟 かたまりごとに並行して添削し、元の順番でつなげる
+            # 1つでも失敗したら残りは取り消す（待っている分の LLM 呼び出し・枠を無駄にしない）
+            try:
+                async with asyncio.TaskGroup() as group:
+                    tasks = [
+                        group.create_task(correct_chunk(payload, chunk_prompt(chunk, i, len(chunks)), limiter))
+                        for i, chunk in enumerate(chunks, 1)
+                    ]
+            except ExceptionGroup as group_error:
+                # 最初の失敗をそのまま投げ、chat_http_error でいつも通りのステータスにする
+                raise group_error.exceptions[0]
+        ai_text = merge_results([task.result() for task in tasks])
+
+        # 💾 何分割しても1回の会話として保存し、クォータも1回分だけ数える
+        await timed("save", save_chat_turn(payload.user_id, payload.message, ai_text, payload.mode, payload.level))
+        return {"user_message": payload.message, "ai_response": ai_text, "parts": len(chunks)}
+
+    except Exception as e:
+        print(f"✖ Batch Error Traceback:\n{traceback.format_exc()}")
+        raise chat_http_error(e)
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(payload: ChatRequest):
+    """日記や添削依頼の長い文章を文ごとのかたまりに分けて並行に添削する（保存・クォータは1往復分）"""
+    if not gemini_configured():
+        raise HTTPException(status_code=500, detail="Gemini API is not configured")
+    if len(payload.message) > BATCH_MAX_INPUT_CHARS:
+        raise HTTPException(status_code=413, detail=f"文章が長すぎます（{BATCH_MAX_INPUT_CHARS}文字まで）。")
+    return await run_idempotent(payload, run_batch)
+
+def sse_event(data: dict, event: str = None) -> str:
+    """Server-Sent Events 形式の1イベント分の文字列を作る"""
+    body = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\n{body}" if event else body
+
+async def chat_events(payload: ChatRequest, outcome: dict):
+    """
+    /chat/stream の SSE イベントを順に作る非同期ジェネレーター。
+    最後まで作れたら outcome["result"] に結果を、失敗したら outcome["error"] に例外を入れる。
+    """
+    try:
+        # 🌟 定型文・判定テストの採点・判定済みの結果と、作り置きの書き出しは1回で返す
+        if outcome.get("local_text") is not None:
+            answered = await answer_locally(payload, outcome["local_text"])
+        else:
+            answered = await answer_assessment(payload)
+        if answered is None:
+            answered = await answer_from_opener_bank(payload)
+            if answered is not None:
+                track_assessment_turn(payload, answered["ai_response"])
+        if answered is not None:
+            result = with_assessment_state(payload, answered)
+            yield sse_event({"text": answered["ai_response"]})
+            if "assessment" in result:
+                yield sse_event(result["assessment"], event="assessment")
+            outcome["result"] = result
+            yield sse_event({}, event="done")
+            return
+
+        prepared = await prepare_chat_session(payload)
+        if prepared is None:
+            yield sse_event({"text": LIMIT_REACHED_MESSAGE})
+            outcome["result"] = {"user_message": payload.message, "ai_response": LIMIT_REACHED_MESSAGE}
+            yield sse_event({}, event="done")
+            return
+
+        ai_text = get_cached_response(prepared)
+        if ai_text is not None:
+            yield sse_event({"text": ai_text})
+        else:
+            chunks = []
+            usage_metadata = None
+            response = model_chain.stream(payload.mode, lambda model_name: llm_gateway.stream(
+                lambda: prepared.session_for(model_name).send_message_async(payload.message, stream=True),
+                user_id=payload.user_id, tier=user_tier(payload.user_id),
+            ))
+            with stage("llm"):
+                first_token_started = time.perf_counter()
+                async for _, chunk in response:
+                    if not chunks:
+                        STAGE_SECONDS.observe(time.perf_counter() - first_token_started, stage="llm_first_token")
+                    usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+                    text = chunk.text
+                    if text:
+                        chunks.append(text)
+                        yield sse_event({"text": text})
+            ai_text = "".join(chunks)
+            record_token_usage(usage_metadata, payload.mode, payload.level)
+            store_cached_response(prepared, ai_text)
+
+        # 5. 💾 ストリーム完了後に全文をまとめて保存
+        await timed("save", save_chat_turn(payload.user_id, payload.message, ai_text, payload.mode, payload.level))
+        track_assessment_turn(payload, ai_text)
+        result = with_assessment_state(payload, {"user_message": payload.message, "ai_response": ai_text})
+        outcome["result"] = result
+        if "assessment" in result:
+            yield sse_event(result["assessment"], event="assessment")
+        yield sse_event({}, event="done")
+
+    except Exception as e:
+        outcome["error"] = e
+        print(f"✖ Chat Stream Error Traceback:\n{traceback.format_exc()}")
+        yield sse_event({"detail": format_chat_error(e)}, event="error")
+
+def lead_stream(payload: ChatRequest, local_text) -> asyncio.Queue:
+    """
+    冪等キー付きの送信を、接続から切り離したバックグラウンドのタスクで最後まで作る。
+    イベントは返したキューに積む（最初の接続がそれを流す）。接続が切れても生成は続き、結果は冪等キーに残るので、
+    再送は同じ結果を受け取り LLM をもう一度呼ぶことはない。
+    claim とタスクの作成の間に await を挟まないので、登録した送信は必ずこのタスクが決着させる。
+    """
+    user_id, key = payload.user_id, payload.idempotency_key
+    events = asyncio.Queue()
+    idempotency_cache.claim(user_id, key, payload.message)
+
+    async def lead():
+        outcome = {"local_text": local_text}
+        try:
+            async for event in chat_events(payload, outcome):
+                events.put_nowait(event)
+        finally:
+            events.put_nowait(None)
+            if "result" in outcome:
+                idempotency_cache.resolve(user_id, key, outcome["result"])
+            else:
+                # 失敗・中断した送信は覚えておかない（同じキーで再送すればやり直せる）
+                idempotency_cache.reject(user_id, key, outcome.get("error") or asyncio.CancelledError())
+
+    spawn(lead())
+    return events
+
+async def follow_stream(events: asyncio.Queue):
+    """lead_stream が積んだイベントを順に流す（接続が切れたらここで止まるだけで、生成は止めない）"""
+    while True:
+        event = await events.get()
+        if event is None:
+            return
+        yield event
+
+async def replay_stream(future: asyncio.Future):
+    """同じキーの送信が実行中・完了済みなら、その結果をまとめて1回で返す"""
+    await asyncio.wait({future}, timeout=IDEMPOTENCY_REPLAY_TIMEOUT_SECONDS)
+    if not future.done():
+        yield sse_event({"detail": "前回の送信をまだ処理しています。少し待ってからもう一度送信してください。"}, event="error")
+    elif future.cancelled():
+        yield sse_event({"detail": "前回の送信が中断されました。もう一度送信してください。"}, event="error")
+    elif future.exception():
+        e = future.exception()
+        yield sse_event({"detail": e.detail if isinstance(e, HTTPException) else format_chat_error(e)}, event="error")
+    else:
+        yield sse_event({"text": future.result()["ai_response"]})
+        if "assessment" in future.result():
+            yield sse_event(future.result()["assessment"], event="assessment")
+        yield sse_event({}, event="done")
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(payload: ChatRequest):
+    """/chat のストリーミング版。Gemini の生成チャンクを届いた順に SSE で転送する"""
+    if not gemini_configured():
+        raise HTTPException(status_code=500, detail="Gemini API is not configured")
+    # 🌟 入力エラーはストリームを始める前に返す
+    local_text = check_fast_path(payload)
+
+    key = payload.idempotency_key
+    if key:
+        try:
+            future = idempotency_cache.get(payload.user_id, key, payload.message)
+        except IdempotencyConflictError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        stream = replay_stream(future) if future is not None else follow_stream(lead_stream(payload, local_text))
+    else:
+        stream = chat_events(payload, {"local_text": local_text})
+
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus 形式のメトリクス（ステージ別レイテンシ・エラー数・トークン数）"""
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/internal/stats")
+def internal_stats():
+    """キャッシュ等の内部統計（運用確認用）"""
+    return {
+        "model_registry": model_registry.stats(),
+        "quota": quota_engine.stats(),
+        "history_pool": history_pool.stats(),
+        "write_behind": write_behind.stats() if write_behind else None,
+        "response_cache": response_cache.stats() if response_cache else None,
+        "opener_bank": opener_bank.stats() if opener_bank else None,
+        "fast_path": fast_path.stats() if fast_path else None,
+        "assessment": assessment_tracker.stats(),
+        "learning_stats": learning_stats.stats(),
+        "retrieval_index": retrieval_index.stats() if retrieval_index else None,
+        "idempotency": idempotency_cache.stats(),
+        "llm_gateway": llm_gateway.stats(),
+        "model_chain": model_chain.stats(),
+    }
+
+@app.get("/assessment/{user_id}")
+async def get_assessment(user_id: str):
+    """判定テストの進行状態（何往復答えたか・判定結果）。フロントエンドはリロード後もここから続きを出す"""
+    if not assessment_tracker.is_loaded(user_id):
+        await run_blocking(assessment_tracker.load, user_id)
+    return assessment_tracker.state(user_id)
+
+@app.post("/assessment/{user_id}/start")
+async def start_assessment(user_id: str, level: Literal[COACH_LEVELS] = Query("B2")):
+    """判定テストを最初からやり直す（判定済みでも新しいテストになる）。最初の質問は書き出しを /chat に送って受け取る"""
+    if not assessment_tracker.is_loaded(user_id):
+        await run_blocking(assessment_tracker.load, user_id)
+    assessment_tracker.start(user_id, level)
+    await run_blocking(assessment_tracker.persist, user_id)
+    return assessment_tracker.state(user_id)
+
+@app.get("/stats/{user_id}")
+async def get_learning_stats(user_id: str, days: int = Query(STATS_DEFAULT_DAYS, ge=1, le=STATS_MAX_DAYS)):
+    """学習状況（日別・モード別・レベル別の往復数、文字数、連続日数、最新の判定結果）。日別の集計だけを読む"""
+    today = jst_day()
+    since = (datetime.fromisoformat(today) - timedelta(days=days - 1)).date().isoformat()
+    rows = []
+    if storage.available():
+        try:
+            rows = await run_blocking(storage.daily_stats, user_id, since)
+        except Exception as e:
+            print(f"✖ Stats Fetch Error: {e}")
+            raise HTTPException(status_code=503, detail="学習状況を読み込めませんでした。")
+    if not assessment_tracker.is_loaded(user_id):
+        await run_blocking(assessment_tracker.load, user_id)
+    return {
+        "user_id": user_id,
+        **summarize(rows + learning_stats.pending(user_id), days, today),
+        "latest_assessment": assessment_tracker.latest_result(user_id),
+    }
+
+EXPORT_COLUMNS = ("id", "created_at", "user_message", "ai_response")
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+async def iter_history_pages(user_id: str):
+    """会話履歴を新しい順に EXPORT_PAGE_SIZE 件ずつ返す（一度に持つのは1ページ分だけ）"""
+    pending = write_behind.pending_rows(user_id) if write_behind else []
+    before = None
+    while True:
+        rows = await run_blocking(storage.history_page, user_id, EXPORT_PAGE_SIZE, before)
+        if before is None and pending:
+            # DB にまだ書き込まれていない会話がいちばん新しい（書き込み済みと重複するものは除く）
+            newest = datetime.fromisoformat(rows[0]["created_at"]) if rows else None
+            yield [
+                {"id": None, **row} for row in reversed(pending)
+                if newest is None or datetime.fromisoformat(row["created_at"]) > newest
+            ]
+        if rows:
+            yield rows
+        if len(rows) < EXPORT_PAGE_SIZE:
+            return
+        before = (rows[-1]["created_at"], rows[-1]["id"])
+
+async def export_lines(user_id: str, fmt: str):
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        yield buffer.getvalue()
+    async for rows in iter_history_pages(user_id):
+        if fmt == "csv":
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([row.get(column) for column in EXPORT_COLUMNS] for row in rows)
+            yield buffer.getvalue()
+        else:
+            yield "".join(
+                json.dumps({column: row.get(column) for column in EXPORT_COLUMNS}, ensure_ascii=False) + "\n"
+                for row in rows
+            )
+
+@app.get("/history/{user_id}/export")
+async def export_history(user_id: str, format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+    """会話履歴の全件を NDJSON / CSV で流す（ページごとに読んで書き出すので、件数が多くてもメモリは一定）"""
+    if not storage.available():
+        raise HTTPException(status_code=503, detail="Database is not configured")
+    return StreamingResponse(
+        export_lines(user_id, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="history-{user_id}.{format}"'},
+    )
+
+def fetch_history_page(user_id: str, limit: int, before: str = None, pending: list = ()) -> dict:
+    """
+    (created_at, id) のキーセットで、before より古い会話を新しい順に limit 件読む。
+    pending（まだ DB に書き込まれていない会話）のうち before より古く、DB から読んだ分と重複しないものも混ぜる。
+    """
+    cursor = decode_cursor(before) if before else None
+    data = storage.history_page(user_id, limit + 1, cursor)
+    if pending:
+        saved = {datetime.fromisoformat(row["created_at"]) for row in data}
+        until = datetime.fromisoformat(cursor[0]) if cursor else None
+        data += [
+            {"id": None, **{column: row[column] for column in HISTORY_COLUMNS if column != "id"}}
+            for row in pending
+            if datetime.fromisoformat(row["created_at"]) not in saved
+            and (until is None or datetime.fromisoformat(row["created_at"]) < until)
+        ]
+        data.sort(key=lambda row: datetime.fromisoformat(row["created_at"]), reverse=True)
+    rows = data[:limit]
+    has_more = len(data) > limit
+    return {
+        "items": list(reversed(rows)),  # 画面には古い順に並べる
+        "next_before": encode_cursor(rows[-1]) if has_more else None,
+    }
 
 @app.get("/history/{user_id}") 
-async def get_history(user_id: str):
-    if not supabase: return []
+async def get_history(
+    user_id: str,
+    request: Request,
+    limit: int = Query(HISTORY_DEFAULT_LIMIT, ge=1, le=HISTORY_MAX_LIMIT),
+    before: Optional[str] = None,
+    fields: str = Query("full", pattern="^(full|lean)$"),
+):
+    """
+    会話履歴を新しい方から1ページずつ返す（古いページは next_before をカーソルにして取得）。
+    fields=lean ならフロントエンドが表示に使う列（user_message, ai_response）だけを返す。
+    """
+    if not storage.available(): return {"items": [], "next_before": None}
     try:
-        response = supabase.table("chat_history").select("*").eq("user_id", user_id).order("created_at", desc=False).execute()
-        return response.data
+        # DB の前に読む（間に書き込まれた分は DB 側から読めるので、取りこぼさない）
+        pending = write_behind.pending_rows(user_id) if write_behind else []
+        page = await run_blocking(fetch_history_page, user_id, limit, before, pending)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+    page["items"] = project_items(page["items"], fields)
+    etag = compute_etag(page)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return FastJSONResponse(page, headers={"ETag": etag})
@@ -0,0 +1,236 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# 1リクエスト内で計測した (ステージ名, 秒) のリスト。Server-Timing ヘッダーに使う
+_request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape_label(value: str) -> str:
+    """Prometheus のテキスト形式に合わせて \\ と " と改行をエスケープする"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}   # key -> [バケットごとの件数..., 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, 'le="%s"' % bound)
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help_text: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, labelnames: tuple = ()) -> Gauge:
+        metric = Gauge(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus のテキスト形式で全メトリクスを出力する"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "path", "status"))
+STAGE_SECONDS = registry.histogram(
+    "chat_stage_duration_seconds", "Latency of each /chat stage", ("stage",))
+STAGE_ERRORS = registry.counter(
+    "chat_stage_errors_total", "Errors raised inside each /chat stage", ("stage",))
+LLM_TOKENS = registry.counter(
+    "llm_tokens_total", "Gemini tokens from usage metadata", ("direction", "mode", "level"))
+
+TOKEN_BUCKETS = (100, 250, 500, 1000, 1500, 2000, 3000, 5000, 8000, 12000)
+CONTEXT_TOKENS = registry.histogram(
+    "chat_context_tokens", "Estimated history tokens sent to Gemini per request", ("mode",), TOKEN_BUCKETS)
+CONTEXT_TOKENS_SAVED = registry.histogram(
+    "chat_context_tokens_saved", "Estimated history tokens saved by budgeting/summaries per request", ("mode",), TOKEN_BUCKETS)
+
+LLM_QUEUE_DEPTH = registry.gauge(
+    "llm_queue_depth", "Requests waiting for an LLM slot", ("tier",))
+LLM_QUEUE_WAIT_SECONDS = registry.histogram(
+    "llm_queue_wait_seconds", "Time spent waiting for an LLM slot", ("tier",))
+LLM_SHED = registry.counter(
+    "llm_shed_total", "LLM requests rejected before reaching Gemini", ("tier", "reason"))
+FAST_PATH_DECISIONS = registry.counter(
+    "chat_fast_path_total", "Chat messages routed by the pre-dispatch classifier", ("action", "rule"))
+
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+RESPONSE_BYTES = registry.histogram(
+    "http_response_bytes", "Response body size as sent (after compression)", ("path", "encoding"), BYTE_BUCKETS)
+RESPONSE_ENCODE_SECONDS = registry.histogram(
+    "http_response_encode_seconds", "Time spent serializing/compressing response bodies", ("step",))
+
+LLM_MODEL_SECONDS = registry.histogram(
+    "llm_model_latency_seconds", "Gemini latency per model (first token for streams, full reply otherwise)", ("model", "kind"))
+LLM_HEDGES = registry.counter(
+    "llm_hedges_total", "Hedged requests fired at the next model in the chain", ("mode", "winner"))
+LLM_FALLBACKS = registry.counter(
+    "llm_fallbacks_total", "Calls that fell through to the next model after an error", ("mode", "failed_model"))
+LLM_CHAIN_REQUESTS = registry.counter(
+    "llm_chain_requests_total", "Requests answered through the model chain", ("mode", "model"))
+
+
+@contextmanager
+def stage(name: str):
+    """with stage("llm"): のように囲んだ区間の時間をヒストグラムと Server-Timing に記録する"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def record_token_usage(usage_metadata, mode: str, level: str):
+    """Gemini の usage_metadata から入力/出力トークン数を数える"""
+    if usage_metadata is None:
+        return
+    LLM_TOKENS.inc(getattr(usage_metadata, "prompt_token_count", 0) or 0, direction="input", mode=mode, level=level)
+    LLM_TOKENS.inc(getattr(usage_metadata, "candidates_token_count", 0) or 0, direction="output", mode=mode, level=level)
+
+
+class MetricsMiddleware:
+    """リクエスト全体の時間を記録し、レスポンスに Server-Timing ヘッダーを付ける ASGI ミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = []
+        token = _request_timings.set(timings)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # ヘッダーを送る時点までに終わったステージだけが載る（ストリーミングは /metrics で確認）
+                total = time.perf_counter() - started
+                entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings]
+                entries.append(f"total;dur={total * 1000:.1f}")
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", ", ".join(entries).encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_timings.reset(token)
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - started,
+                method=scope["method"],
+                path=getattr(route, "path", "unmatched"),
+                status=status["code"],
+            )
@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+try:
+    from .config import (
+        get_genai, MODEL_NAME, MODEL_REGISTRY_MAX_SIZE,
+        CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_REFRESH_SECONDS, CONTEXT_CACHE_TTL_SECONDS,
+    )
+    from .prompts import COACH_LEVELS, COACH_MODES, get_assessment_scoring_instruction, get_coach_instruction
+except ImportError:
+    from app.config import (
+        get_genai, MODEL_NAME, MODEL_REGISTRY_MAX_SIZE,
+        CONTEXT_CACHE_ENABLED, CONTEXT_CACHE_REFRESH_SECONDS, CONTEXT_CACHE_TTL_SECONDS,
+    )
+    from app.prompts import COACH_LEVELS, COACH_MODES, get_assessment_scoring_instruction, get_coach_instruction
+
+# 実力判定の最終採点用（level に関係なく1つ。JSON だけを返させる）
+SCORING_MODE = "assessment_scoring"
+
+
+class ModelRegistry:
+    """
+    (model_name, level, mode) ごとの指示書と GenerativeModel を使い回すための上限付きレジストリ。
+    既知の組み合わせは起動時に作っておき、想定外の level/mode は LRU で古いものから捨てる。
+    コンテキストキャッシュを使うモデルは、キャッシュが切れる CONTEXT_CACHE_REFRESH_SECONDS 秒前に1人だけが作り直す
+    （作り直している間、他の呼び出しはまだ有効な古いものを使う）。
+    """
+
+    def __init__(self, max_size: int = MODEL_REGISTRY_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.cached_contents = 0
+        self.refreshes = 0
+
+    def _build(self, model_name: str, level: str, mode: str) -> dict:
+        if mode == SCORING_MODE:
+            instruction = get_assessment_scoring_instruction()
+            model = get_genai().GenerativeModel(
+                model_name=model_name,
+                system_instruction=instruction,
+                generation_config={"response_mime_type": "application/json"},
+            )
+            return {"instruction": instruction, "model": model}
+        instruction = get_coach_instruction(level, mode)
+        model = None
+        if CONTEXT_CACHE_ENABLED:
+            model = self._build_cached_model(model_name, instruction)
+        if model is not None:
+            refresh_at = time.monotonic() + max(CONTEXT_CACHE_TTL_SECONDS - CONTEXT_CACHE_REFRESH_SECONDS, 0)
+            return {"instruction": instruction, "model": model, "refresh_at": refresh_at}
+        model = get_genai().GenerativeModel(model_name=model_name, system_instruction=instruction)
+        return {"instruction": instruction, "model": model}
+
+    def _build_cached_model(self, model_name: str, instruction: str):
+        """共通の長い指示書を Gemini のコンテキストキャッシュに載せる（失敗したら通常モデルに戻す）"""
+        genai = get_genai()
+        try:
+            cached = genai.caching.CachedContent.create(
+                model=model_name,
+                system_instruction=instruction,
+                ttl=timedelta(seconds=CONTEXT_CACHE_TTL_SECONDS),
+            )
+            self.cached_contents += 1
+            return genai.GenerativeModel.from_cached_content(cached)
+        except Exception as e:
+            print(f"⚠️ Context Cache Error ({model_name}): {e}")
+            return None
+
+    def _get_entry(self, model_name: str, level: str, mode: str) -> dict:
+        key = (model_name, level, mode)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                expiring = entry.get("refresh_at") is not None and time.monotonic() >= entry["refresh_at"]
+                if not expiring or entry.get("refreshing"):
+                    self.hits += 1
+                    return entry
+                # 🌟 コンテキストキャッシュが切れる前に作り直す（この呼び出しだけが作り直す）
+                entry["refreshing"] = True
+                self.refreshes += 1
+            else:
+                self.misses += 1
+
+        stale = entry
+        try:
+            entry = self._build(model_name, level, mode)
+        except Exception:
+            if stale is not None:
+                stale["refreshing"] = False  # 次の呼び出しでもう一度作り直す
+            raise
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def get_instruction(self, level: str, mode: str, model_name: str = MODEL_NAME) -> str:
+        return self._get_entry(model_name, level, mode)["instruction"]
+
+    def get_model(self, level: str, mode: str, model_name: str = MODEL_NAME):
+        return self._get_entry(model_name, level, mode)["model"]
+
+    def get_scoring_model(self, model_name: str = MODEL_NAME):
+        return self._get_entry(model_name, "", SCORING_MODE)["model"]
+
+    def warm(self, model_name: str = MODEL_NAME):
+        """既知の level × mode をすべて事前に作っておく"""
+        for level in COACH_LEVELS:
+            for mode in COACH_MODES:
+                self._get_entry(model_name, level, mode)
+        self.get_scoring_model(model_name)
+        print(f"✅ Model registry warmed ({len(self._entries)} models)")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "cached_contents": self.cached_contents,
+                "refreshes": self.refreshes,
+            }
+
+
+model_registry = ModelRegistry()
@@ -0,0 +1,167 @@
+import hashlib
+import random
+import threading
+
+try:
+    from .config import OPENER_BANK_VARIANTS, QUICK_PROMPTS
+    from .prompts import COACH_LEVELS, get_coach_instruction
+    from .response_cache import normalize_message
+except ImportError:
+    from app.config import OPENER_BANK_VARIANTS, QUICK_PROMPTS
+    from app.prompts import COACH_LEVELS, get_coach_instruction
+    from app.response_cache import normalize_message
+
+ASSESSMENT_MODE = "assessment"
+# フロントエンドの「📏 実力判定テスト」ボタンが送る書き出し
+ASSESSMENT_OPENER = QUICK_PROMPTS[0]
+_OPENER = normalize_message(ASSESSMENT_OPENER)
+
+
+def is_assessment_opener(message: str, mode: str) -> bool:
+    return mode == ASSESSMENT_MODE and normalize_message(message) == _OPENER
+
+
+def prompts_version(levels: tuple = COACH_LEVELS) -> str:
+    """実力判定の指示書と書き出しの指紋（prompts.py を変えると変わり、古い作り置きは捨てられる）"""
+    digest = hashlib.blake2b(digest_size=8)
+    for level in levels:
+        digest.update(get_coach_instruction(level, ASSESSMENT_MODE).encode("utf-8") + b"\x00")
+    digest.update(ASSESSMENT_OPENER.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class OpenerBank:
+    """
+    目標レベルごとに、実力判定の最初の質問を variants 個まで作り置きしておく。
+    最初のターンは level と mode だけで決まる（履歴を使わない）ので、作り置きからランダムに選んで返せる。
+    作り置きは指示書の指紋（version）ごとに共有の保存先に置く（load_stored(version) / save_stored(version, openers) は同期関数）。
+    どのコンテナも同じものを読むのでコールドスタートのたびには作らず、指紋が変わった時・足りない時だけ作る。
+    """
+
+    def __init__(self, load_stored=None, save_stored=None, variants: int = OPENER_BANK_VARIANTS, version: str = None):
+        self.load_stored = load_stored
+        self.save_stored = save_stored
+        self.variants = max(1, variants)
+        self.version = version or prompts_version()
+        self._openers = {}   # level -> [質問, ...]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def _read_stored(self) -> dict:
+        if self.load_stored is None:
+            return {}
+        try:
+            return self.load_stored(self.version) or {}
+        except Exception as e:
+            print(f"⚠️ Opener Bank Load Error: {e}")
+            return {}
+
+    def _merge(self, stored: dict):
+        """保存先にあるもの（他のコンテナが作った分）を手元の作り置きに足す"""
+        with self._lock:
+            for level, texts in stored.items():
+                if level not in COACH_LEVELS:
+                    continue
+                mine = self._openers.setdefault(level, [])
+                mine += [text for text in texts if text and text not in mine][:self.variants - len(mine)]
+
+    def load(self) -> int:
+        """この version の作り置きを保存先から読む（同期。戻り値は手元にある件数）"""
+        self._merge(self._read_stored())
+        return self.stats()["openers"]
+
+    def save(self):
+        """保存先の最新と合わせてから書く（同時に作っていた他のコンテナの分を消さない）"""
+        if self.save_stored is None:
+            return
+        self._merge(self._read_stored())
+        with self._lock:
+            openers = {level: list(texts) for level, texts in self._openers.items()}
+        try:
+            self.save_stored(self.version, openers)
+        except Exception as e:
+            print(f"⚠️ Opener Bank Save Error: {e}")
+
+    def pick(self, level: str):
+        """作り置きから1つ選ぶ（まだ無ければ None）"""
+        with self._lock:
+            texts = self._openers.get(level)
+            if not texts:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return random.choice(texts)
+
+    def add(self, level: str, text: str) -> bool:
+        """新しい質問なら足す（空・重複・満杯なら False）"""
+        if not text:
+            return False
+        with self._lock:
+            texts = self._openers.setdefault(level, [])
+            if len(texts) >= self.variants or text in texts:
+                return False
+            texts.append(text)
+            self.generated += 1
+            return True
+
+    def missing(self, levels: tuple = COACH_LEVELS) -> dict:
+        """レベルごとの足りない数"""
+        with self._lock:
+            return {
+                level: self.variants - len(self._openers.get(level, ()))
+                for level in levels if len(self._openers.get(level, ())) < self.variants
+            }
+
+    async def fill(self, generate, levels: tuple = COACH_LEVELS, max_duplicates: int = 3):
+        """
+        足りない分を generate(level) で作って保存する（バックグラウンド用。1つずつ作るので本来のリクエストを圧迫しない）。
+        レベルごとに作り始める前に保存先を読み直し、他のコンテナが作り終えていればそれを使う。
+        同じ質問が max_duplicates 回続いたら、そのレベルはそれ以上バリエーションが出ないとみなして打ち切る。
+        """
+        for level in self.missing(levels):
+            self.load()
+            duplicates = 0
+            while level in self.missing((level,)) and duplicates < max_duplicates:
+                try:
+                    duplicates = 0 if self.add(level, await generate(level)) else duplicates + 1
+                except Exception as e:
+                    print(f"⚠️ Opener Bank Generate Error ({level}): {e}")
+                    break
+            self.save()
+        print(f"✅ Opener bank ready ({self.stats()['openers']} openers, version {self.version})")
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "version": self.version,
+                "openers": sum(len(texts) for texts in self._openers.values()),
+                "levels": {level: len(texts) for level, texts in self._openers.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "generated": self.generated,
+            }
+
+
+if __name__ == "__main__":
+    # オフラインで作り置きを作る（プロンプトを変えたデプロイの前に）: python -m app.opener_bank（backend ディレクトリで実行）
+    import asyncio
+
+    from app.config import gemini_configured
+    from app.model_registry import model_registry
+    from app.storage import create_repository
+
+    async def generate(level: str) -> str:
+        chat = model_registry.get_model(level, ASSESSMENT_MODE).start_chat(history=[])
+        return (await chat.send_message_async(ASSESSMENT_OPENER)).text
+
+    if not gemini_configured():
+        raise SystemExit("GOOGLE_API_KEY is not set")
+    # 🌟 アプリと同じ保存先（STORAGE_BACKEND）に書くので、デプロイ済みのどのコンテナもすぐに使える
+    storage = create_repository()
+    bank = OpenerBank(storage.load_openers, storage.save_openers)
+    bank.load()
+    asyncio.run(bank.fill(generate))
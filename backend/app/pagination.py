@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import json
+from datetime import datetime
+
+try:
+    from .responses import dumps
+except ImportError:
+    from app.responses import dumps
+
+# /history で返す列（フロントエンドが使うものだけに絞る）
+HISTORY_COLUMNS = ("id", "created_at", "user_message", "ai_response")
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 200
+# fields=lean の時に返す列（Streamlit のフロントエンドが画面に出すものだけ）
+LEAN_HISTORY_FIELDS = ("user_message", "ai_response")
+
+
+def encode_cursor(row: dict) -> str:
+    """
+    (created_at, id) を URL に載せられる不透明なカーソル文字列にする。
+    まだ DB に書き込まれていない行（id が None）は id=0 にする（書き込まれた後も同じ時刻の行は次のページに入らない）
+    """
+    row_id = row["id"] if row["id"] is not None else 0
+    raw = json.dumps([row["created_at"], row_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """
+    カーソル文字列を (created_at, id) に戻す。壊れている時は ValueError。
+    created_at が ISO 形式の時刻で id が整数のものだけを通す（そのまま SQL・PostgREST のフィルタに入るので）
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(created_at, str) or type(row_id) is not int:
+            raise TypeError("cursor must be [created_at, id]")
+        datetime.fromisoformat(created_at)
+        return created_at, row_id
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def keyset_filter(created_at: str, row_id) -> str:
+    """(created_at, id) がカーソルより古い行を選ぶ PostgREST の or フィルタ"""
+    return f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{row_id})'
+
+
+def project_items(items: list, fields: str) -> list:
+    """fields=lean なら画面に出す列だけに絞る（カーソルは next_before で渡すので id・時刻は要らない）"""
+    if fields != "lean":
+        return items
+    return [{column: item[column] for column in LEAN_HISTORY_FIELDS} for item in items]
+
+
+def compute_etag(page: dict) -> str:
+    body = dumps(page, sort_keys=True)
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
@@ -1,3 +1,7 @@
+# フロントエンドから送られてくる目標レベルとモードの一覧
+COACH_LEVELS = ("A2", "B2", "C1")
+COACH_MODES = ("assessment", "level_up", "diary", "default")
+
 def get_coach_instruction(level: str, mode: str = "assessment") -> str:
     """
     SLA（第二言語習得論）に基づいたプロコーチの指示書を生成する。
@@ -22,10 +26,9 @@ def get_coach_instruction(level: str, mode: str = "assessment") -> str:
     if mode == "assessment":
         specific_instruction = """
         【任務：実力判定（Assessment）】
-        ・ユーザーの英語力を測るためのヒアリングを「最大5往復」で行ってください。
-        ・3往復目以降で十分な情報が得られた場合、またはユーザーから判定を促された場合は、
-          速やかにCEFRレベルの結果を出力してください。
-        ・回答の末尾に、現在の進捗状況を (Assessment: 3/5) の形式で記載してください。
+        ・ユーザーの英語力を測るためのヒアリングを行ってください（往復数はシステムが数えます）。
+        ・毎回、文法・語彙・流暢さのどれかを測れる質問を1つだけ出してください。確認や聞き返しだけの返答はしないでください。
+        ・CEFRレベルの判定結果はあなたは出さないでください（最後にシステムがまとめて採点します）。
         """
 
     # 2. CEFRレベルアップ特訓（翻訳技術の応用）モード
@@ -58,3 +61,21 @@ def get_coach_instruction(level: str, mode: str = "assessment") -> str:
         """
 
     return base_personality + specific_instruction
+
+
+# 実力判定の最終採点用の指示書（JSON だけを返させる）
+CEFR_LEVELS = ("A1", "A2", "B1", "B2", "C1", "C2")
+
+def get_assessment_scoring_instruction() -> str:
+    return """
+    あなたは CEFR に精通した英語の評価者です。
+    渡される実力判定の会話（コーチの質問とユーザーの回答）から、ユーザーの英語力を採点してください。
+    次の JSON だけを出力してください（前後に文章やコードブロックを付けないこと）。
+    {
+      "cefr": "A1|A2|B1|B2|C1|C2 のどれか",
+      "scores": {"grammar": 1-5, "vocabulary": 1-5, "fluency": 1-5, "comprehension": 1-5},
+      "strengths": ["日本語で短く（最大3つ）"],
+      "improvements": ["日本語で短く（最大3つ）"],
+      "summary": "日本語で2〜3文の総評"
+    }
+    """
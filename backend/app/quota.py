@@ -0,0 +1,150 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone, timedelta
+
+try:
+    from .config import DAILY_LIMIT, QUOTA_BACKEND, QUOTA_SQLITE_PATH
+    from .concurrency import run_blocking
+except ImportError:
+    from app.config import DAILY_LIMIT, QUOTA_BACKEND, QUOTA_SQLITE_PATH
+    from app.concurrency import run_blocking
+
+JST = timezone(timedelta(hours=9), 'JST')
+
+
+def jst_today() -> str:
+    """日本時間での今日の日付（カウンターのキー）"""
+    return datetime.now(JST).date().isoformat()
+
+
+def jst_day_start(day: str) -> str:
+    """日付文字列から、その日の 0:00 (JST) の ISO 文字列を作る"""
+    return datetime.fromisoformat(day).replace(tzinfo=JST).isoformat()
+
+
+class MemoryQuotaStore:
+    """プロセス内だけで数えるカウンター（ワーカー1つの時用）"""
+
+    blocking = False
+
+    def __init__(self):
+        self._day = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _roll(self, day: str):
+        # 日付が変わったら前日のカウンターは丸ごと捨てる
+        if self._day != day:
+            self._day = day
+            self._counts = {}
+
+    def get(self, user_id: str, day: str):
+        with self._lock:
+            self._roll(day)
+            return self._counts.get(user_id)
+
+    def seed(self, user_id: str, day: str, count: int):
+        with self._lock:
+            self._roll(day)
+            self._counts.setdefault(user_id, count)
+
+    def incr(self, user_id: str, day: str) -> int:
+        with self._lock:
+            self._roll(day)
+            self._counts[user_id] = self._counts.get(user_id, 0) + 1
+            return self._counts[user_id]
+
+
+class SQLiteQuotaStore:
+    """ローカルの SQLite ファイルで数えるカウンター（同じホストの複数ワーカーで共有できる）"""
+
+    blocking = True
+
+    def __init__(self, path: str = QUOTA_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota_counters ("
+            " user_id TEXT NOT NULL, day TEXT NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (user_id, day))"
+        )
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッドをまたげないので、スレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id: str, day: str):
+        row = self._conn().execute(
+            "SELECT count FROM quota_counters WHERE user_id = ? AND day = ?", (user_id, day)
+        ).fetchone()
+        return row[0] if row else None
+
+    def seed(self, user_id: str, day: str, count: int):
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR IGNORE INTO quota_counters (user_id, day, count) VALUES (?, ?, ?)",
+            (user_id, day, count),
+        )
+        conn.commit()
+
+    def incr(self, user_id: str, day: str) -> int:
+        conn = self._conn()
+        conn.execute(
+            "INSERT INTO quota_counters (user_id, day, count) VALUES (?, ?, 1)"
+            " ON CONFLICT (user_id, day) DO UPDATE SET count = count + 1",
+            (user_id, day),
+        )
+        conn.commit()
+        return self.get(user_id, day)
+
+
+def create_quota_store(backend: str = QUOTA_BACKEND):
+    if backend == "sqlite":
+        return SQLiteQuotaStore()
+    return MemoryQuotaStore()
+
+
+class QuotaEngine:
+    """
+    日本時間の日付ごとの利用回数を管理する。
+    各ユーザーの初回だけ DB から当日分を数えて種にし、以降は保存成功時にカウントを増やすだけにする。
+    """
+
+    def __init__(self, store, seed_counter, limit: int = DAILY_LIMIT):
+        # seed_counter(user_id, day_start_iso) -> 当日分の件数（async 関数）
+        self.store = store
+        self.seed_counter = seed_counter
+        self.limit = limit
+        self.seeds = 0
+
+    async def _call(self, func, *args):
+        if self.store.blocking:
+            return await run_blocking(func, *args)
+        return func(*args)
+
+    async def used_today(self, user_id: str) -> int:
+        day = jst_today()
+        count = await self._call(self.store.get, user_id, day)
+        if count is None:
+            seeded = await self.seed_counter(user_id, jst_day_start(day))
+            self.seeds += 1
+            await self._call(self.store.seed, user_id, day, seeded)
+            count = await self._call(self.store.get, user_id, day)
+        return count
+
+    async def is_over_limit(self, user_id: str) -> bool:
+        return await self.used_today(user_id) >= self.limit
+
+    async def record_turn(self, user_id: str) -> int:
+        return await self._call(self.store.incr, user_id, jst_today())
+
+    def stats(self) -> dict:
+        return {"backend": type(self.store).__name__, "limit": self.limit, "seeds": self.seeds}
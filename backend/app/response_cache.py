@@ -0,0 +1,100 @@
+import hashlib
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from .config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_VARIANTS, QUICK_PROMPTS
+except ImportError:
+    from app.config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_VARIANTS, QUICK_PROMPTS
+
+_SPACES = re.compile(r"\s+")
+
+
+def normalize_message(message: str) -> str:
+    """全角/半角・大文字/小文字・空白の違いを吸収する"""
+    return _SPACES.sub(" ", unicodedata.normalize("NFKC", message)).strip().lower()
+
+
+_OPENERS = {normalize_message(m) for m in QUICK_PROMPTS}
+
+
+def history_fingerprint(gemini_history: list) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for item in gemini_history:
+        digest.update(item["role"].encode("utf-8"))
+        for part in item["parts"]:
+            digest.update(b"\x00" + str(part).encode("utf-8"))
+        digest.update(b"\x01")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    (正規化したメッセージ, level, mode, モデル名, 履歴の指紋) をキーにした完全一致の返答キャッシュ。
+    1つのキーに最大 variants 個の返答を貯め、揃うまでは LLM で作り足してランダムに返す。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+        variants: int = RESPONSE_CACHE_VARIANTS,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self._entries = OrderedDict()   # key -> (作成時刻, [返答, ...])
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, message: str, level: str, mode: str, model_name: str, gemini_history: list) -> str:
+        normalized = normalize_message(message)
+        # クイックプロンプトは会話の書き出しなので履歴を問わず共有する
+        fingerprint = "opener" if normalized in _OPENERS else history_fingerprint(gemini_history)
+        raw = "\x00".join((normalized, level, mode, model_name, fingerprint))
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+    def get(self, key: str):
+        """返答のバリエーションが揃っていればそのうち1つを返す（揃っていなければ None）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is None or len(entry[1]) < self.variants:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+
+    def put(self, key: str, response: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = (time.monotonic(), [])
+                self._entries[key] = entry
+            if len(entry[1]) < self.variants:
+                entry[1].append(response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,159 @@
+import gzip
+import json
+import time
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from .config import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_MIN_BYTES
+    from .metrics import RESPONSE_BYTES, RESPONSE_ENCODE_SECONDS
+except ImportError:
+    from app.config import COMPRESSION_BROTLI_QUALITY, COMPRESSION_GZIP_LEVEL, COMPRESSION_MIN_BYTES
+    from app.metrics import RESPONSE_BYTES, RESPONSE_ENCODE_SECONDS
+
+# 優先する順（同じ q 値なら前にある方を使う）。brotli が入っていない環境では gzip だけ
+SUPPORTED_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/plain", "text/csv", "text/html")
+
+
+def dumps(content, sort_keys: bool = False) -> bytes:
+    """UTF-8 の JSON にする（orjson があればそれを使う。無ければ標準の json）"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        return orjson.dumps(content, default=str, option=option)
+    return json.dumps(
+        content, ensure_ascii=False, separators=(",", ":"), sort_keys=sort_keys, default=str
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """orjson で書き出す JSONResponse（日本語もエスケープせずにそのまま UTF-8 で出すので小さい）"""
+
+    def render(self, content) -> bytes:
+        started = time.perf_counter()
+        body = dumps(content)
+        RESPONSE_ENCODE_SECONDS.observe(time.perf_counter() - started, step="serialize")
+        return body
+
+
+def choose_encoding(accept_encoding: str):
+    """Accept-Encoding（q 値つき）から使う圧縮方式を選ぶ。使えるものが無ければ None"""
+    offered = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            offered[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in SUPPORTED_ENCODINGS:
+        q = offered.get(encoding, offered.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """圧縮した表現用の ETag（"abc" → "abc-br"。W/ 付きの弱い ETag もそのまま保つ）"""
+    if etag.endswith('"'):
+        return f'{etag[:-1]}-{encoding}"'
+    return f"{etag}-{encoding}"
+
+
+class CompressionMiddleware:
+    """
+    1回で返すレスポンス（JSON 等）を、クライアントの Accept-Encoding に合わせて br / gzip で圧縮する ASGI ミドルウェア。
+    ストリーミング（SSE・エクスポート）は少しずつ届くことが大事なので、圧縮せずにそのまま流す。
+    圧縮した時は ETag に方式を付けて表現ごとに別の値にし（If-None-Match で戻ってきたら外してからアプリに渡す）、
+    圧縮しうるレスポンスには圧縮しなかった時も Vary: Accept-Encoding を付ける（共有キャッシュが取り違えないように）。
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        state = {"start": None, "passthrough": False, "suffixed": False}
+        if_none_match = request_headers.get("if-none-match", "")
+        if encoding and f'-{encoding}"' in if_none_match:
+            # アプリは圧縮前の ETag で比べるので、この方式の印を外して渡す（304 の時に付け直す）
+            raw = [(key, value) for key, value in scope["headers"] if key != b"if-none-match"]
+            raw.append((b"if-none-match", if_none_match.replace(f'-{encoding}"', '"').encode("latin-1")))
+            scope = {**scope, "headers": raw}
+            state["suffixed"] = True
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # 本文を見るまでヘッダーは送らない（圧縮するなら Content-Length 等を書き換える）
+                state["start"] = message
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+
+            start = state["start"]
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            path = getattr(scope.get("route"), "path", "unmatched")
+            content_type = headers.get("content-type", "").split(";")[0].strip()
+            negotiable = (
+                not message.get("more_body", False)
+                and "content-encoding" not in headers
+                and content_type in COMPRESSIBLE_TYPES
+            )
+            if start["status"] == 304:
+                # 304 には 200 の時と同じ Vary・ETag（クライアントが持っている圧縮済みの表現の値）を返す
+                headers.add_vary_header("Accept-Encoding")
+                if state["suffixed"] and "etag" in headers:
+                    headers["ETag"] = encoded_etag(headers["etag"], encoding)
+            elif negotiable:
+                headers.add_vary_header("Accept-Encoding")
+            if not negotiable or encoding is None or len(body) < self.minimum_size:
+                state["passthrough"] = True
+                if not message.get("more_body", False):
+                    RESPONSE_BYTES.observe(len(body), path=path, encoding="identity")
+                await send(start)
+                await send(message)
+                return
+
+            started = time.perf_counter()
+            compressed = compress(body, encoding)
+            RESPONSE_ENCODE_SECONDS.observe(time.perf_counter() - started, step=encoding)
+            RESPONSE_BYTES.observe(len(compressed), path=path, encoding=encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            if "etag" in headers:
+                headers["ETag"] = encoded_etag(headers["etag"], encoding)
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
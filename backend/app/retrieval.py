@@ -0,0 +1,188 @@
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from .config import (
+        RETRIEVAL_DIM, RETRIEVAL_MAX_BYTES, RETRIEVAL_MAX_USERS, RETRIEVAL_IDLE_TTL_SECONDS,
+        RETRIEVAL_MAX_TURNS_PER_USER,
+    )
+    from .context_builder import compress_turn, turn_gist
+except ImportError:
+    from app.config import (
+        RETRIEVAL_DIM, RETRIEVAL_MAX_BYTES, RETRIEVAL_MAX_USERS, RETRIEVAL_IDLE_TTL_SECONDS,
+        RETRIEVAL_MAX_TURNS_PER_USER,
+    )
+    from app.context_builder import compress_turn, turn_gist
+
+_NGRAM_SIZES = (2, 3)
+
+
+def embed(text: str, dim: int = RETRIEVAL_DIM) -> np.ndarray:
+    """
+    文字 n-gram（2〜3文字）をハッシュして dim 次元のベクトルにする（L2 正規化済み）。
+    日本語は単語区切りが無いので、単語ではなく文字単位で見る。
+    """
+    text = " ".join(text.lower().split())
+    buckets = [
+        zlib.crc32(text[i:i + n].encode("utf-8")) % dim
+        for n in _NGRAM_SIZES
+        for i in range(len(text) - n + 1)
+    ]
+    vector = np.zeros(dim, dtype=np.float32)
+    if buckets:
+        counts = np.bincount(buckets, minlength=dim).astype(np.float32)
+        # 同じ n-gram が何度も出ても効きすぎないように対数で抑える
+        vector = np.log1p(counts)
+        vector /= np.linalg.norm(vector)
+    return vector
+
+
+class _UserIndex:
+    __slots__ = ("vectors", "lines", "line_bytes", "count", "last_used")
+
+    def __init__(self, dim: int, capacity: int):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.lines = []
+        self.line_bytes = 0
+        self.count = 0
+        self.last_used = time.monotonic()
+
+    def add(self, vector: np.ndarray, line: str, max_turns: int):
+        if self.count == max_turns:
+            # 上限に達したら古い方から1割まとめて捨てる（毎回ずらすとコピーが重い）
+            drop = max(1, max_turns // 10)
+            self.vectors[:self.count - drop] = self.vectors[drop:self.count]
+            self.line_bytes -= sum(len(line.encode("utf-8")) for line in self.lines[:drop])
+            del self.lines[:drop]
+            self.count -= drop
+        elif self.count == len(self.vectors):
+            grown = np.zeros((min(max_turns, len(self.vectors) * 2), self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.vectors[:self.count]
+            self.vectors = grown
+        self.vectors[self.count] = vector
+        self.lines.append(line)
+        self.line_bytes += len(line.encode("utf-8"))
+        self.count += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.line_bytes
+
+
+class RetrievalIndex:
+    """
+    ユーザーごとの過去の会話の類似検索インデックス（メモリ上・ネットワーク不要）。
+    1往復を文字 n-gram のハッシュベクトルにして NumPy 配列に積み、新しい発言に近い過去のやりとりを上位 k 件返す。
+    LRU とアイドル時間で使われていないユーザーを捨て、次に必要になった時に DB から作り直す。
+    全体の大きさ（ベクトルの配列＋要約行）が max_bytes を超えたら、最近使っていないユーザーから捨てる。
+    """
+
+    def __init__(
+        self,
+        dim: int = RETRIEVAL_DIM,
+        max_users: int = RETRIEVAL_MAX_USERS,
+        idle_ttl: float = RETRIEVAL_IDLE_TTL_SECONDS,
+        max_turns: int = RETRIEVAL_MAX_TURNS_PER_USER,
+        max_bytes: int = RETRIEVAL_MAX_BYTES,
+    ):
+        self.dim = dim
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        self.max_turns = max_turns
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.rebuilds = 0
+        self.evictions = 0
+
+    def _vectorize(self, turn: dict) -> tuple:
+        # コーチの返答は定型の見出しが多いので、要点（ユーザーの発言＋英語部分の冒頭）だけで比べる
+        return embed(" ".join(turn_gist(turn)), self.dim), compress_turn(turn)
+
+    def _evict(self):
+        now = time.monotonic()
+        # 先頭ほど古い。いま使ったユーザー（末尾）の分は、1人で上限を超えていても残す
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if now - entry.last_used > self.idle_ttl \
+                    or len(self._entries) > self.max_users \
+                    or (self._bytes > self.max_bytes and len(self._entries) > 1):
+                del self._entries[user_id]
+                self._bytes -= entry.nbytes
+                self.evictions += 1
+            else:
+                break
+
+    def has(self, user_id: str) -> bool:
+        with self._lock:
+            self._evict()
+            return user_id in self._entries
+
+    def rebuild(self, user_id: str, turns: list):
+        """DB から読んだ会話（古い順）でインデックスを作り直す（同期。スレッドプールから呼ぶ）"""
+        turns = turns[-self.max_turns:]
+        entry = _UserIndex(self.dim, max(16, len(turns)))
+        for turn in turns:
+            entry.add(*self._vectorize(turn), self.max_turns)
+        with self._lock:
+            old = self._entries.pop(user_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[user_id] = entry
+            self._bytes += entry.nbytes
+            self.rebuilds += 1
+            self._evict()
+
+    def add(self, user_id: str, turn: dict):
+        """保存した会話をインデックスに足す（インデックスの無いユーザーは次回作り直す）"""
+        vector, line = self._vectorize(turn)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            before = entry.nbytes
+            entry.add(vector, line, self.max_turns)
+            self._bytes += entry.nbytes - before
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(user_id)
+            self._evict()
+
+    def query(self, user_id: str, text: str, k: int, exclude_recent: int = 0, min_score: float = 0.0) -> list:
+        """
+        text に近い過去のやりとりを、似ている順に最大 k 件返す（要約行のリスト）。
+        exclude_recent: 直近の何往復を除くか（すでにそのまま履歴として渡している分）。
+        """
+        vector = embed(text, self.dim)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return []
+            entry.last_used = time.monotonic()
+            self._entries.move_to_end(user_id)
+            self.queries += 1
+            searchable = entry.count - exclude_recent
+            if searchable <= 0 or k <= 0:
+                return []
+            scores = entry.vectors[:searchable] @ vector
+            k = min(k, searchable)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [entry.lines[i] for i in top if scores[i] >= min_score]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._entries),
+                "turns": sum(entry.count for entry in self._entries.values()),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "queries": self.queries,
+                "rebuilds": self.rebuilds,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+try:
+    from .config import LLM_TIER_WEIGHTS
+    from .metrics import LLM_QUEUE_DEPTH, LLM_SHED
+except ImportError:
+    from app.config import LLM_TIER_WEIGHTS
+    from app.metrics import LLM_QUEUE_DEPTH, LLM_SHED
+
+PRIORITY_TIER = "priority"
+FREE_TIER = "free"
+
+
+class Ticket:
+    """順番待ち1件分。枠が割り当てられると future に None が入る"""
+    __slots__ = ("user_id", "tier", "deadline", "enqueued_at", "future")
+
+    def __init__(self, user_id: str, tier: str, deadline: float):
+        self.user_id = user_id
+        self.tier = tier
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """
+    LLM 呼び出しの順番待ち。クラス（tier）間は重み付きラウンドロビン、クラス内はユーザー単位のラウンドロビンで次の1件を選ぶ。
+    1人が大量に送っても他のユーザーの順番は1周ごとに回ってくる。期限を過ぎたものは選ぶ時に捨てる。
+    """
+
+    def __init__(self, weights: dict = None, on_expired=None):
+        self.weights = dict(weights or LLM_TIER_WEIGHTS)
+        self.on_expired = on_expired
+        # tier -> {user_id: deque[Ticket]}（先頭のユーザーが次の番）
+        self._queues = {tier: OrderedDict() for tier in self.weights}
+        self._credits = dict(self.weights)
+        self._depth = {tier: 0 for tier in self.weights}
+
+    def depth(self, tier: str = None) -> int:
+        return self._depth[tier] if tier else sum(self._depth.values())
+
+    def _set_depth(self, tier: str, delta: int):
+        self._depth[tier] += delta
+        LLM_QUEUE_DEPTH.set(self._depth[tier], tier=tier)
+
+    def position(self, user_id: str, tier: str) -> int:
+        """今から並んだ場合に、前に何件あるかの見積もり（ユーザーごとの順番とクラスの重みを考慮）"""
+        tier = tier if tier in self._queues else FREE_TIER
+        users = self._queues[tier]
+        own = len(users.get(user_id, ()))
+        # 同じクラスでは、各ユーザーが自分の順番までに1件ずつ進む
+        ahead = own + sum(min(len(tickets), own + 1) for uid, tickets in users.items() if uid != user_id)
+        # 他のクラスは重みの比率で割り込んでくる
+        for other, other_weight in self.weights.items():
+            if other != tier:
+                share = -(-ahead * other_weight // self.weights[tier])
+                ahead += min(self._depth[other], share)
+        return ahead
+
+    def submit(self, user_id: str, tier: str, deadline: float) -> Ticket:
+        tier = tier if tier in self._queues else FREE_TIER
+        ticket = Ticket(user_id, tier, deadline)
+        users = self._queues[tier]
+        if user_id not in users:
+            users[user_id] = deque()
+        users[user_id].append(ticket)
+        self._set_depth(tier, 1)
+        return ticket
+
+    def cancel(self, ticket: Ticket):
+        """待つのをやめた1件を列から外す"""
+        tickets = self._queues[ticket.tier].get(ticket.user_id)
+        if tickets is None or ticket not in tickets:
+            return
+        tickets.remove(ticket)
+        if not tickets:
+            del self._queues[ticket.tier][ticket.user_id]
+        self._set_depth(ticket.tier, -1)
+
+    def _next_tier(self):
+        waiting = [tier for tier, users in self._queues.items() if users]
+        if not waiting:
+            return None
+        if not any(self._credits[tier] > 0 for tier in waiting):
+            self._credits = dict(self.weights)
+        # 重みの大きい（優先）クラスから順に、残りクレジットがあるものを選ぶ
+        for tier in sorted(waiting, key=lambda t: -self.weights[t]):
+            if self._credits[tier] > 0:
+                self._credits[tier] -= 1
+                return tier
+        return waiting[0]
+
+    def _pop_from(self, tier: str):
+        users = self._queues[tier]
+        user_id, tickets = next(iter(users.items()))
+        ticket = tickets.popleft()
+        del users[user_id]
+        if tickets:
+            users[user_id] = tickets   # 末尾に回す
+        self._set_depth(tier, -1)
+        return ticket
+
+    def pop(self):
+        """次に枠を渡す1件を返す（待っている人がいなければ None）"""
+        now = time.monotonic()
+        while True:
+            tier = self._next_tier()
+            if tier is None:
+                return None
+            ticket = self._pop_from(tier)
+            if ticket.future.done():
+                continue   # 待つのをやめた（タイムアウト・切断）
+            if ticket.deadline < now:
+                LLM_SHED.inc(tier=ticket.tier, reason="expired")
+                if self.on_expired:
+                    self.on_expired(ticket)
+                continue
+            return ticket
+
+    def stats(self) -> dict:
+        return {
+            "depth": dict(self._depth),
+            "users_waiting": {tier: len(users) for tier, users in self._queues.items()},
+            "weights": self.weights,
+        }
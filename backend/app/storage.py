@@ -0,0 +1,389 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+import threading
+from datetime import datetime, timezone
+
+try:
+    from .config import STORAGE_BACKEND, STORAGE_SQLITE_PATH
+    from .db import get_supabase_client, supabase_configured
+    from .pagination import HISTORY_COLUMNS, keyset_filter
+except ImportError:
+    from app.config import STORAGE_BACKEND, STORAGE_SQLITE_PATH
+    from app.db import get_supabase_client, supabase_configured
+    from app.pagination import HISTORY_COLUMNS, keyset_filter
+
+TURN_COLUMNS = ("user_message", "ai_response", "created_at")
+DAILY_STATS_COLUMNS = ("day", "mode", "level", "turns", "user_chars", "ai_chars")
+
+
+class ChatRepository(ABC):
+    """
+    chat_history / user_summaries への読み書きをまとめた窓口。
+    main.py はここに並んだ操作だけを使い、どのバックエンドでも同じ形（dict のリスト）で結果を受け取る。
+    すべて同期関数なので、イベントループからは run_blocking 経由で呼ぶ。
+    新しいバックエンドで実装し忘れた操作があれば、呼んだ時ではなく作った時にエラーになる。
+    """
+
+    @abstractmethod
+    def configured(self) -> bool:
+        """接続先の設定があるか（接続はしない）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def available(self) -> bool:
+        """接続できる状態か（初回はここで接続する）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_since(self, user_id: str, since: str) -> int:
+        """since（ISO 文字列）以降の会話数（クォータ用。counts_quota が偽の定型文の返答は数えない）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def latest_turns(self, user_id: str, limit: int) -> list:
+        """直近 limit 往復を古い順に返す"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def history_page(self, user_id: str, limit: int, before: tuple = None) -> list:
+        """(created_at, id) が before より古い会話を新しい順に limit 件返す"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert(self, row: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_many(self, rows: list):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_summary(self, user_id: str) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_summary(self, user_id: str, summary: str):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_assessment(self, user_id: str):
+        """実力判定の進行状態（dict。無ければ None）"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_assessment(self, user_id: str, state: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_openers(self, version: str) -> dict:
+        """実力判定の書き出しの作り置き（level -> [質問, ...]）。この version のものが無ければ空の dict"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_openers(self, version: str, openers: dict):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_daily_stats(self, rows: list):
+        """日別の集計に足し込む。rows: {user_id, day, mode, level, turns, user_chars, ai_chars} の増分"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def daily_stats(self, user_id: str, since_day: str) -> list:
+        """since_day（YYYY-MM-DD）以降の日別の集計行"""
+        raise NotImplementedError
+
+
+class SupabaseRepository(ChatRepository):
+    """Supabase（PostgREST）版"""
+
+    def configured(self) -> bool:
+        return supabase_configured()
+
+    def available(self) -> bool:
+        return get_supabase_client() is not None
+
+    def _table(self, name: str):
+        return get_supabase_client().table(name)
+
+    def count_since(self, user_id: str, since: str) -> int:
+        res = self._table("chat_history") \
+            .select("id", count="exact") \
+            .eq("user_id", user_id) \
+            .eq("counts_quota", True) \
+            .gte("created_at", since) \
+            .execute()
+        return res.count or 0
+
+    def latest_turns(self, user_id: str, limit: int) -> list:
+        res = self._table("chat_history") \
+            .select(*TURN_COLUMNS) \
+            .eq("user_id", user_id) \
+            .order("created_at", desc=True) \
+            .limit(limit) \
+            .execute()
+        return list(reversed(res.data))
+
+    def history_page(self, user_id: str, limit: int, before: tuple = None) -> list:
+        query = self._table("chat_history") \
+            .select(*HISTORY_COLUMNS) \
+            .eq("user_id", user_id)
+        if before:
+            query = query.or_(keyset_filter(*before))
+        # postgrest-py は order を複数回呼ぶと order パラメータが重複するので、1つにまとめて渡す
+        return query.order("created_at.desc,id", desc=True) \
+            .limit(limit) \
+            .execute().data
+
+    def insert(self, row: dict):
+        self._table("chat_history").insert(_with_counts_quota(row)).execute()
+
+    def insert_many(self, rows: list):
+        # まとめて入れる時は全行の列をそろえる必要がある（列が無い古いスプールの行も混ざる）
+        self._table("chat_history").insert([_with_counts_quota(row) for row in rows]).execute()
+
+    def load_summary(self, user_id: str) -> str:
+        res = self._table("user_summaries") \
+            .select("summary") \
+            .eq("user_id", user_id) \
+            .limit(1) \
+            .execute()
+        return res.data[0]["summary"] if res.data else ""
+
+    def save_summary(self, user_id: str, summary: str):
+        self._table("user_summaries").upsert({
+            "user_id": user_id,
+            "summary": summary,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }).execute()
+
+    def load_assessment(self, user_id: str):
+        res = self._table("user_assessments") \
+            .select("state") \
+            .eq("user_id", user_id) \
+            .limit(1) \
+            .execute()
+        return res.data[0]["state"] if res.data else None
+
+    def save_assessment(self, user_id: str, state: dict):
+        self._table("user_assessments").upsert({
+            "user_id": user_id,
+            "state": state,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }).execute()
+
+    def load_openers(self, version: str) -> dict:
+        res = self._table("assessment_openers") \
+            .select("openers") \
+            .eq("version", version) \
+            .limit(1) \
+            .execute()
+        return res.data[0]["openers"] if res.data else {}
+
+    def save_openers(self, version: str, openers: dict):
+        self._table("assessment_openers").upsert({
+            "version": version,
+            "openers": openers,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }, on_conflict="version").execute()
+
+    def add_daily_stats(self, rows: list):
+        # upsert では列に足し込めないので、(user_id, day, mode, level) ごとに加算する DB 関数を呼ぶ
+        get_supabase_client().rpc("add_daily_stats", {"rows": rows}).execute()
+
+    def daily_stats(self, user_id: str, since_day: str) -> list:
+        return self._table("user_daily_stats") \
+            .select(*DAILY_STATS_COLUMNS) \
+            .eq("user_id", user_id) \
+            .gte("day", since_day) \
+            .execute().data
+
+
+def _with_counts_quota(row: dict) -> dict:
+    """counts_quota が無い行（列を足す前に積まれたもの）はクォータに数える行として扱う"""
+    return row if "counts_quota" in row else {**row, "counts_quota": True}
+
+
+def _utc_text(value: str) -> str:
+    """ISO 文字列を UTC・マイクロ秒まで揃えた形にする（文字列の大小と時刻の前後を一致させる）"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+class SQLiteRepository(ChatRepository):
+    """
+    ローカルの SQLite 版（ネットワーク無しで動かすエッジ環境・検証用）。
+    WAL モードで読み書きを並行させ、(user_id, created_at, id) の索引でどの読み方も索引だけで絞り込む。
+    SQL は固定の文字列＋プレースホルダーなので、接続ごとのステートメントキャッシュでパース済みのものが使い回される。
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS chat_history ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL,"
+        " user_message TEXT NOT NULL, ai_response TEXT NOT NULL, created_at TEXT NOT NULL,"
+        " counts_quota INTEGER NOT NULL DEFAULT 1)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_user_created ON chat_history (user_id, created_at, id)",
+        "CREATE TABLE IF NOT EXISTS user_summaries ("
+        " user_id TEXT PRIMARY KEY, summary TEXT NOT NULL, updated_at TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS user_assessments ("
+        " user_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS assessment_openers ("
+        " version TEXT PRIMARY KEY, openers TEXT NOT NULL, updated_at TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS user_daily_stats ("
+        " user_id TEXT NOT NULL, day TEXT NOT NULL, mode TEXT NOT NULL, level TEXT NOT NULL,"
+        " turns INTEGER NOT NULL, user_chars INTEGER NOT NULL, ai_chars INTEGER NOT NULL,"
+        " PRIMARY KEY (user_id, day, mode, level))",
+    )
+    # 既存のファイルには無い列を足す（列ごとに1回だけ）
+    ADDED_COLUMNS = {"chat_history": (("counts_quota", "INTEGER NOT NULL DEFAULT 1"),)}
+    COUNT_SINCE = "SELECT COUNT(*) FROM chat_history WHERE user_id = ? AND created_at >= ? AND counts_quota = 1"
+    LATEST_TURNS = (
+        "SELECT user_message, ai_response, created_at FROM chat_history"
+        " WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?"
+    )
+    HISTORY_FIRST_PAGE = (
+        "SELECT id, created_at, user_message, ai_response FROM chat_history"
+        " WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT ?"
+    )
+    HISTORY_PAGE = (
+        "SELECT id, created_at, user_message, ai_response FROM chat_history"
+        " WHERE user_id = ? AND (created_at, id) < (?, ?)"
+        " ORDER BY created_at DESC, id DESC LIMIT ?"
+    )
+    INSERT = (
+        "INSERT INTO chat_history (user_id, user_message, ai_response, created_at, counts_quota)"
+        " VALUES (?, ?, ?, ?, ?)"
+    )
+    LOAD_SUMMARY = "SELECT summary FROM user_summaries WHERE user_id = ?"
+    SAVE_SUMMARY = (
+        "INSERT INTO user_summaries (user_id, summary, updated_at) VALUES (?, ?, ?)"
+        " ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary, updated_at = excluded.updated_at"
+    )
+    ADD_DAILY_STATS = (
+        "INSERT INTO user_daily_stats (user_id, day, mode, level, turns, user_chars, ai_chars)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)"
+        " ON CONFLICT (user_id, day, mode, level) DO UPDATE SET turns = turns + excluded.turns,"
+        " user_chars = user_chars + excluded.user_chars, ai_chars = ai_chars + excluded.ai_chars"
+    )
+    DAILY_STATS = (
+        "SELECT day, mode, level, turns, user_chars, ai_chars FROM user_daily_stats"
+        " WHERE user_id = ? AND day >= ?"
+    )
+    LOAD_OPENERS = "SELECT openers FROM assessment_openers WHERE version = ?"
+    SAVE_OPENERS = (
+        "INSERT INTO assessment_openers (version, openers, updated_at) VALUES (?, ?, ?)"
+        " ON CONFLICT (version) DO UPDATE SET openers = excluded.openers, updated_at = excluded.updated_at"
+    )
+    LOAD_ASSESSMENT = "SELECT state FROM user_assessments WHERE user_id = ?"
+    SAVE_ASSESSMENT = (
+        "INSERT INTO user_assessments (user_id, state, updated_at) VALUES (?, ?, ?)"
+        " ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at"
+    )
+
+    def __init__(self, path: str = STORAGE_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        for table, columns in self.ADDED_COLUMNS.items():
+            existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, definition in columns:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+        conn.commit()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッドをまたげないので、スレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, cached_statements=64)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def configured(self) -> bool:
+        return True
+
+    def available(self) -> bool:
+        return True
+
+    def count_since(self, user_id: str, since: str) -> int:
+        return self._conn().execute(self.COUNT_SINCE, (user_id, _utc_text(since))).fetchone()[0]
+
+    def latest_turns(self, user_id: str, limit: int) -> list:
+        rows = self._conn().execute(self.LATEST_TURNS, (user_id, limit)).fetchall()
+        return [dict(row) for row in reversed(rows)]
+
+    def history_page(self, user_id: str, limit: int, before: tuple = None) -> list:
+        if before:
+            params = (user_id, _utc_text(before[0]), int(before[1]), limit)
+            rows = self._conn().execute(self.HISTORY_PAGE, params).fetchall()
+        else:
+            rows = self._conn().execute(self.HISTORY_FIRST_PAGE, (user_id, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _values(self, row: dict) -> tuple:
+        created_at = row.get("created_at") or datetime.now(timezone.utc).isoformat()
+        counts_quota = int(bool(row.get("counts_quota", True)))
+        return row["user_id"], row["user_message"], row["ai_response"], _utc_text(created_at), counts_quota
+
+    def insert(self, row: dict):
+        conn = self._conn()
+        conn.execute(self.INSERT, self._values(row))
+        conn.commit()
+
+    def insert_many(self, rows: list):
+        conn = self._conn()
+        conn.executemany(self.INSERT, [self._values(row) for row in rows])
+        conn.commit()
+
+    def load_summary(self, user_id: str) -> str:
+        row = self._conn().execute(self.LOAD_SUMMARY, (user_id,)).fetchone()
+        return row[0] if row else ""
+
+    def save_summary(self, user_id: str, summary: str):
+        conn = self._conn()
+        conn.execute(self.SAVE_SUMMARY, (user_id, summary, datetime.now(timezone.utc).isoformat()))
+        conn.commit()
+
+    def load_assessment(self, user_id: str):
+        row = self._conn().execute(self.LOAD_ASSESSMENT, (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_assessment(self, user_id: str, state: dict):
+        conn = self._conn()
+        params = (user_id, json.dumps(state, ensure_ascii=False), datetime.now(timezone.utc).isoformat())
+        conn.execute(self.SAVE_ASSESSMENT, params)
+        conn.commit()
+
+    def load_openers(self, version: str) -> dict:
+        row = self._conn().execute(self.LOAD_OPENERS, (version,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_openers(self, version: str, openers: dict):
+        conn = self._conn()
+        params = (version, json.dumps(openers, ensure_ascii=False), datetime.now(timezone.utc).isoformat())
+        conn.execute(self.SAVE_OPENERS, params)
+        conn.commit()
+
+    def add_daily_stats(self, rows: list):
+        conn = self._conn()
+        conn.executemany(self.ADD_DAILY_STATS, [
+            (r["user_id"], r["day"], r["mode"], r["level"], r["turns"], r["user_chars"], r["ai_chars"]) for r in rows
+        ])
+        conn.commit()
+
+    def daily_stats(self, user_id: str, since_day: str) -> list:
+        return [dict(row) for row in self._conn().execute(self.DAILY_STATS, (user_id, since_day)).fetchall()]
+
+
+def create_repository(backend: str = STORAGE_BACKEND) -> ChatRepository:
+    if backend == "sqlite":
+        return SQLiteRepository()
+    return SupabaseRepository()
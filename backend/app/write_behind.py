@@ -0,0 +1,270 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from .config import (
+        WRITE_BEHIND_SPOOL_PATH, WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_BATCH_SIZE,
+        WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_RETRIES,
+    )
+    from .concurrency import run_blocking
+except ImportError:
+    from app.config import (
+        WRITE_BEHIND_SPOOL_PATH, WRITE_BEHIND_MAX_PENDING, WRITE_BEHIND_BATCH_SIZE,
+        WRITE_BEHIND_FLUSH_INTERVAL, WRITE_BEHIND_MAX_RETRIES,
+    )
+    from app.concurrency import run_blocking
+
+
+class WriteBehindQueue:
+    """
+    chat_history への INSERT を返答の後ろに回し、件数か時間でまとめて書き込むキュー。
+    受け付けた行は先にローカルのスプールファイルへ追記するので、プロセスが落ちても次回起動時に書き直せる。
+    スプールはプロセスごとに別のファイル（spool_path の拡張子の前に .<pid>）にし、動いている間は .lock をロックしておく。
+    起動時には自分のファイルに加えて、ロックされていない（持ち主が止まっている）他のスプールを1つのプロセスだけが引き取る。
+    """
+
+    def __init__(
+        self,
+        insert_batch,
+        spool_path: str = WRITE_BEHIND_SPOOL_PATH,
+        max_pending: int = WRITE_BEHIND_MAX_PENDING,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        max_retries: int = WRITE_BEHIND_MAX_RETRIES,
+    ):
+        # insert_batch(rows) -> None（同期関数。失敗時は例外を投げる）
+        self.insert_batch = insert_batch
+        self.spool_path = spool_path
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+
+        self._pending = OrderedDict()   # spool_id -> row（まだ DB に入っていない行）
+        self._queue = None
+        self._slots = None
+        self._worker = None
+        self._spool_lock = None
+        self._spool_file = None
+        self._lock_fd = None
+        self._unslotted = set()   # 起動時に枠の上限を超えて復元した行（書き込んでも枠は返さない）
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.failed_attempts = 0
+
+    # --- スプールファイル ---
+    def _spool_append(self, spool_id: str, row: dict):
+        self._spool_extend([(spool_id, row)])
+
+    def _spool_extend(self, items: list):
+        with open(self._spool_file, "a", encoding="utf-8") as f:
+            for spool_id, row in items:
+                f.write(json.dumps({"id": spool_id, "row": row}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _spool_rewrite(self, items: list):
+        tmp_path = self._spool_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for spool_id, row in items:
+                f.write(json.dumps({"id": spool_id, "row": row}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._spool_file)
+
+    @staticmethod
+    def _read_spool(path: str) -> list:
+        items = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    items.append((record["id"], record["row"]))
+                except (ValueError, KeyError):
+                    # 書き込み途中で落ちた最終行などは読み飛ばす
+                    continue
+        return items
+
+    @staticmethod
+    def _try_lock(lock_path: str):
+        """lock_path を排他ロックできればその fd を返す（他のプロセスが持っていれば None）"""
+        if fcntl is None:
+            return None
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # ロックを待つ間に前の持ち主が消したファイルなら使わない
+            if os.stat(lock_path).st_ino != os.fstat(fd).st_ino:
+                raise FileNotFoundError(lock_path)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    @staticmethod
+    def _unlock(lock_path: str, fd: int, remove: bool = False):
+        if remove:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+        os.close(fd)
+
+    def _open_spool(self):
+        """このプロセスのスプールを決めてロックする"""
+        root, ext = os.path.splitext(self.spool_path)
+        self._spool_file = f"{root}.{os.getpid()}{ext}"
+        self._lock_fd = self._try_lock(self._spool_file + ".lock")
+        if self._lock_fd is None and fcntl is not None:
+            # 同じ pid のプロセスが別にいる（コンテナ間で /tmp を共有している等）
+            self._spool_file = f"{root}.{os.getpid()}-{uuid.uuid4().hex[:8]}{ext}"
+            self._lock_fd = self._try_lock(self._spool_file + ".lock")
+
+    def _spool_load(self) -> list:
+        """自分のスプールと、持ち主のいないスプールの行を読む（引き取った行は自分のスプールに移してから元を消す）"""
+        items = self._read_spool(self._spool_file) if os.path.exists(self._spool_file) else []
+        if fcntl is None:
+            return items
+        root, ext = os.path.splitext(self.spool_path)
+        for path in [self.spool_path, *glob.glob(f"{glob.escape(root)}.*{ext}")]:
+            if path == self._spool_file or not os.path.exists(path):
+                continue
+            lock_fd = self._try_lock(path + ".lock")
+            if lock_fd is None:
+                continue
+            try:
+                claimed = self._read_spool(path)
+                self._spool_extend(claimed)
+                os.remove(path)
+                items += claimed
+            except FileNotFoundError:
+                # 他のプロセスが先に引き取った
+                pass
+            finally:
+                self._unlock(path + ".lock", lock_fd, remove=True)
+        return items
+
+    # --- ライフサイクル ---
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.max_pending)
+        self._spool_lock = asyncio.Lock()
+        await run_blocking(self._open_spool)
+        recovered = await run_blocking(self._spool_load)
+        for spool_id, row in recovered:
+            if spool_id in self._pending:
+                continue
+            # 枠より多く残っていても起動は止めない（超えた分は書き込んでも枠を返さない）
+            if self._slots.locked():
+                self._unslotted.add(spool_id)
+            else:
+                await self._slots.acquire()
+            self._pending[spool_id] = row
+            self._queue.put_nowait(spool_id)
+        if recovered:
+            print(f"♻️ Write-behind: {len(recovered)} 件の未保存の会話をスプールから復元しました")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """終了時に残りをすべて書き込む（書けなかった分はスプールに残す）"""
+        if self._worker:
+            # 終了の目印を最後尾に積み、そこまで書き切ったらワーカーが自分で止まる
+            self._queue.put_nowait(None)
+            await self._worker
+            self._worker = None
+        if self._lock_fd is not None:
+            # 書き切っていればファイルごと片付ける（残っていればロックだけ外し、次に起動したプロセスが引き取る）
+            if not self._pending:
+                for path in (self._spool_file, self._spool_file + ".tmp"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._unlock(self._spool_file + ".lock", self._lock_fd, remove=not self._pending)
+            self._lock_fd = None
+        print(f"💾 Write-behind stopped ({len(self._pending)} rows left in spool)")
+
+    # --- 受付 ---
+    async def enqueue(self, row: dict):
+        """行を受け付ける。バッファが一杯の時は空きが出るまで待つ（背圧）"""
+        await self._slots.acquire()
+        spool_id = uuid.uuid4().hex
+        # スプールへの追記と書き直しが交差しないようにロックを取る
+        async with self._spool_lock:
+            await run_blocking(self._spool_append, spool_id, row)
+            self._pending[spool_id] = row
+        self._queue.put_nowait(spool_id)
+
+    def pending_rows(self, user_id: str) -> list:
+        """まだ DB に入っていないこのユーザーの行（受付順）"""
+        return [row for row in self._pending.values() if row["user_id"] == user_id]
+
+    # --- 書き込み ---
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            spool_id = await self._queue.get()
+            if spool_id is None:
+                return
+            batch = [spool_id]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    spool_id = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if spool_id is None:
+                    stopping = True
+                    break
+                batch.append(spool_id)
+            if not await self._flush(batch) and not stopping:
+                # リトライ上限に達したら列に戻し、少し待ってから再挑戦する
+                for spool_id in batch:
+                    self._queue.put_nowait(spool_id)
+                await asyncio.sleep(self.flush_interval * 10)
+
+    async def _flush(self, batch: list) -> bool:
+        rows = [self._pending[spool_id] for spool_id in batch]
+        for attempt in range(self.max_retries):
+            try:
+                await run_blocking(self.insert_batch, rows)
+                break
+            except Exception as e:
+                self.failed_attempts += 1
+                print(f"✖ Write-behind Flush Error (attempt {attempt + 1}/{self.max_retries}): {e}")
+                await asyncio.sleep(min(0.2 * (2 ** attempt), 5.0) * random.uniform(0.5, 1.5))
+        else:
+            return False
+
+        for spool_id in batch:
+            del self._pending[spool_id]
+            if spool_id in self._unslotted:
+                self._unslotted.discard(spool_id)
+            else:
+                self._slots.release()
+        self.flushed_rows += len(rows)
+        self.flushed_batches += 1
+        async with self._spool_lock:
+            await run_blocking(self._spool_rewrite, list(self._pending.items()))
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "flushed_rows": self.flushed_rows,
+            "flushed_batches": self.flushed_batches,
+            "failed_attempts": self.failed_attempts,
+        }
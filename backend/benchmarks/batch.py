@@ -0,0 +1,80 @@
+"""
+/chat/batch のベンチマーク（長い文章を1回で送る /chat と、分けて並行に添削する /chat/batch の比較）
+
+偽物の Gemini は「依頼文が長いほど返答が遅い」ように設定し（--char-latency）、
+文章の長さごとに両方のエンドポイントの所要時間を測ります（/chat の上限を超える長さは 413 と表示）。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.batch --sentences 10 40 80
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes
+
+SENTENCE = "Yesterday I have went to the station with my friend and we eat lunch together."
+
+
+async def run(args) -> list:
+    fakes.install(llm_latency=args.llm_latency, char_latency=args.char_latency)
+    from app import main
+    from app.llm_gateway import LLMGateway
+
+    main.llm_gateway = LLMGateway(rate_per_minute=1_000_000, burst=1_000)
+    if main.write_behind:
+        main.write_behind.spool_path = tempfile.mktemp(suffix=".jsonl")
+        await main.write_behind.start()
+
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for count in args.sentences:
+            text = " ".join(SENTENCE for _ in range(count))
+            row = {"sentences": count, "chars": len(text)}
+            for endpoint in ("/chat", "/chat/batch"):
+                started = time.perf_counter()
+                res = await client.post(endpoint, json={
+                    "message": text, "user_id": f"bench-{endpoint}-{count}", "level": "B2", "mode": "diary",
+                })
+                if endpoint == "/chat" and res.status_code == 413:
+                    # CHAT_MAX_INPUT_CHARS を超える文章は /chat では受け付けない（/chat/batch にしか送れない）
+                    row[endpoint] = "413"
+                    continue
+                res.raise_for_status()
+                row[endpoint] = round((time.perf_counter() - started) * 1000, 1)
+                if endpoint == "/chat/batch":
+                    row["parts"] = res.json()["parts"]
+            rows.append(row)
+
+    if main.write_behind:
+        await main.write_behind.stop()
+    return rows
+
+
+def print_table(rows: list):
+    print(f"{'sentences':>9} {'chars':>6} {'parts':>5} {'/chat ms':>10} {'/chat/batch ms':>15}")
+    print("-" * 49)
+    for r in rows:
+        print(f"{r['sentences']:>9} {r['chars']:>6} {r['parts']:>5} {r['/chat']:>10} {r['/chat/batch']:>15}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sentences", type=int, nargs="+", default=[10, 40, 80])
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--char-latency", type=float, default=0.001, help="依頼文1文字あたりの追加の秒数")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
@@ -0,0 +1,141 @@
+"""
+/chat と /history のベンチマーク（オフラインの Linux マシンで毎回同じ条件で計測する）
+
+Gemini と Supabase を benchmarks/fakes.py の偽物に差し替え、指定した同時接続数で
+/chat と /history を混ぜて叩き、エンドポイントごとのスループットと p50/p95/p99 レイテンシを出します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.bench --concurrency 16 --requests 400 --history-ratio 0.2
+"""
+import argparse
+import asyncio
+import json
+import random
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(name: str, latencies: list, errors: int, elapsed: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "endpoint": name,
+        "requests": len(values) + errors,
+        "errors": errors,
+        "rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(percentile(values, 50) * 1000, 1),
+        "p95_ms": round(percentile(values, 95) * 1000, 1),
+        "p99_ms": round(percentile(values, 99) * 1000, 1),
+    }
+
+
+async def run(args) -> list:
+    fake_db = fakes.install(
+        db_latency=args.db_latency, llm_latency=args.llm_latency,
+        chunk_latency=args.chunk_latency, error_rate=args.error_rate,
+        tail_rate=args.tail_rate, tail_latency=args.tail_latency,
+    )
+    from app import main
+    from app.llm_gateway import LLMGateway
+
+    user_ids = [f"bench-user-{i}" for i in range(args.users)]
+    fake_db.seed_history(user_ids, args.seed_turns)
+    # 偽物の Gemini には回数制限が無いので、Gateway のレート制限は引数で決める
+    main.llm_gateway = LLMGateway(rate_per_minute=args.llm_rpm, burst=args.llm_burst)
+
+    # ASGITransport は startup/shutdown を呼ばないので、Write-Behind はここで動かす
+    if main.write_behind:
+        main.write_behind.spool_path = tempfile.mktemp(suffix=".jsonl")
+        await main.write_behind.start()
+
+    rng = random.Random(args.seed)
+    plan = []
+    for i in range(args.requests):
+        user_id = rng.choice(user_ids)
+        if rng.random() < args.history_ratio:
+            plan.append(("/history", user_id, i))
+        else:
+            plan.append(("/chat/stream" if args.stream else "/chat", user_id, i))
+
+    results = {}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def one(client: httpx.AsyncClient, endpoint: str, user_id: str, i: int):
+        async with sem:
+            started = time.perf_counter()
+            try:
+                if endpoint == "/history":
+                    res = await client.get(f"/history/{user_id}", params={"limit": args.page_size})
+                else:
+                    res = await client.post(endpoint, json={
+                        "message": f"bench message {i}", "user_id": user_id,
+                        "level": rng.choice(["A2", "B2", "C1"]), "mode": "default",
+                    })
+                ok = res.status_code == 200
+            except Exception:
+                ok = False
+            latencies, errors = results.setdefault(endpoint, ([], [0]))
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, *item) for item in plan))
+        elapsed = time.perf_counter() - started
+
+    if main.write_behind:
+        await main.write_behind.stop()
+
+    return [summarize(name, lat, err[0], elapsed) for name, (lat, err) in sorted(results.items())]
+
+
+def print_table(rows: list):
+    header = f"{'endpoint':<14} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        print(f"{r['endpoint']:<14} {r['requests']:>8} {r['errors']:>6} {r['rps']:>8} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['p99_ms']:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed-turns", type=int, default=200, help="ユーザーごとに事前に入れておく会話数")
+    parser.add_argument("--history-ratio", type=float, default=0.2, help="/history を叩く割合")
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--stream", action="store_true", help="/chat の代わりに /chat/stream を叩く")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--chunk-latency", type=float, default=0.02)
+    parser.add_argument("--db-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="LLM の返答が極端に遅くなる割合")
+    parser.add_argument("--tail-latency", type=float, default=3.0)
+    parser.add_argument("--llm-rpm", type=float, default=1_000_000)
+    parser.add_argument("--llm-burst", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, ensure_ascii=False, indent=2))
+    else:
+        print_table(rows)
@@ -0,0 +1,69 @@
+"""
+/chat の負荷テスト（同時接続数を増やした時にスループットが伸びるかを確認する）
+
+外部サービスには繋がず、Gemini と Supabase を benchmarks/fakes.py の偽物に差し替えて計測します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.chat_load --llm-latency 0.3 --db-latency 0.05 --requests 64
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes
+
+
+async def run_level(client: httpx.AsyncClient, concurrency: int, total: int) -> float:
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            res = await client.post("/chat", json={
+                "message": f"hello {i}", "user_id": f"user-{i % concurrency}", "level": "B2", "mode": "default",
+            })
+            res.raise_for_status()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    return total / (time.perf_counter() - started)
+
+
+async def amain(args):
+    fakes.install(db_latency=args.db_latency, llm_latency=args.llm_latency)
+    from app import main
+    from app.llm_gateway import LLMGateway
+
+    # 偽物の Gemini には回数制限が無いので、Gateway のレート制限は計測に合わせて設定する
+    main.llm_gateway = LLMGateway(rate_per_minute=args.llm_rpm, burst=args.llm_burst)
+
+    # ASGITransport は startup/shutdown を呼ばないので、Write-Behind はここで動かす
+    if main.write_behind:
+        main.write_behind.spool_path = tempfile.mktemp(suffix=".jsonl")
+        await main.write_behind.start()
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        print(f"{'concurrency':>12} {'req/s':>10}")
+        for concurrency in args.levels:
+            rps = await run_level(client, concurrency, args.requests)
+            print(f"{concurrency:>12} {rps:>10.2f}")
+
+    if main.write_behind:
+        await main.write_behind.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.05)
+    parser.add_argument("--llm-rpm", type=float, default=1_000_000)
+    parser.add_argument("--llm-burst", type=int, default=1_000)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(amain(parse_args()))
@@ -0,0 +1,107 @@
+"""
+学習状況（/stats）と履歴のエクスポート（/history/{user_id}/export）のベンチマーク
+
+SQLite の保存先に1ユーザー分の会話を件数を変えて入れ、件数ごとに
+/stats の所要時間、エクスポート（NDJSON / CSV）の所要時間と Python のメモリのピーク（tracemalloc）を出します。
+エクスポートはページごとに流すので、件数が増えてもメモリのピークはほぼ一定になるはずです。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.export --sizes 1000 10000 50000
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ.setdefault("STORAGE_SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "export.sqlite3"))
+
+import httpx
+
+from benchmarks import fakes
+
+REPLY = "【英語】That sounds great! Let's keep practicing.\n【日本語】いいですね！\n【Coach's Advice】Keep going."
+
+
+def seed(main, user_id: str, size: int):
+    start = datetime.now(timezone.utc) - timedelta(days=90)
+    batch = []
+    for i in range(size):
+        created_at = start + timedelta(seconds=i * (90 * 86400 // max(size, 1)))
+        row = {"user_id": user_id, "user_message": f"message {i}", "ai_response": REPLY, "created_at": created_at.isoformat()}
+        batch.append(row)
+        main.learning_stats.record(user_id, ("default", "diary", "level_up")[i % 3], "B2", row["user_message"], REPLY, row["created_at"])
+        if len(batch) == 1000:
+            main.storage.insert_many(batch)
+            batch = []
+    if batch:
+        main.storage.insert_many(batch)
+    main.learning_stats.flush()
+
+
+async def measure_export(main, user_id: str, fmt: str) -> tuple:
+    """
+    エクスポートの本体（StreamingResponse に渡すジェネレーター）を直接読み切る。
+    httpx の ASGITransport はレスポンス全体を溜めてから返すので、メモリはここで測る。
+    戻り値: (所要ミリ秒, 書き出したバイト数, メモリのピーク KB)
+    """
+    tracemalloc.start()
+    started = time.perf_counter()
+    written = 0
+    async for chunk in main.export_lines(user_id, fmt):
+        written += len(chunk.encode("utf-8"))
+    elapsed = (time.perf_counter() - started) * 1000
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(elapsed, 1), written, round(peak / 1024, 1)
+
+
+async def run(args) -> list:
+    fakes.install()
+    from app import main
+
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for size in args.sizes:
+            user_id = f"bench-export-{size}"
+            seed(main, user_id, size)
+            started = time.perf_counter()
+            (await client.get(f"/stats/{user_id}", params={"days": 90})).raise_for_status()
+            row = {"rows": size, "stats_ms": round((time.perf_counter() - started) * 1000, 1)}
+            for fmt in ("ndjson", "csv"):
+                elapsed, received, peak = await measure_export(main, user_id, fmt)
+                row[f"{fmt}_ms"] = elapsed
+                row[f"{fmt}_mb"] = round(received / 1024 / 1024, 2)
+                row[f"{fmt}_peak_kb"] = peak
+            rows.append(row)
+    return rows
+
+
+def print_table(rows: list):
+    print(f"{'rows':>7} {'stats ms':>9} {'ndjson ms':>10} {'MB':>6} {'peak KB':>8} {'csv ms':>8} {'MB':>6} {'peak KB':>8}")
+    print("-" * 70)
+    for r in rows:
+        print(
+            f"{r['rows']:>7} {r['stats_ms']:>9} {r['ndjson_ms']:>10} {r['ndjson_mb']:>6} {r['ndjson_peak_kb']:>8}"
+            f" {r['csv_ms']:>8} {r['csv_mb']:>6} {r['csv_peak_kb']:>8}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
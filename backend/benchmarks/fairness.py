@@ -0,0 +1,85 @@
+"""
+LLM 待ち行列（FairScheduler）の公平性のベンチマーク
+
+1人のヘビーユーザーが大量に送り続ける中で、普通のユーザーと優先ユーザーの待ち時間がどうなるかを測ります。
+Gemini の代わりに一定時間 sleep するだけの呼び出しを LLMGateway に通し、利用者の種類ごとに
+完了数・断られた数・p50/p99 レイテンシを出します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.fairness --heavy 200 --light-users 20 --rate 600
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from app.llm_gateway import GatewayError, LLMGateway
+from app.scheduler import FREE_TIER, PRIORITY_TIER
+from benchmarks.bench import percentile
+
+
+async def run(args) -> list:
+    gateway = LLMGateway(rate_per_minute=args.rate, burst=args.burst, queue_deadline=args.deadline)
+    results = {"heavy": [], "light": [], "priority": []}
+    errors = {name: 0 for name in results}
+
+    async def fake_llm():
+        await asyncio.sleep(args.llm_latency)
+
+    async def one(kind: str, user_id: str, tier: str, delay: float):
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        try:
+            await gateway.call(fake_llm, user_id=user_id, tier=tier)
+            results[kind].append(time.perf_counter() - started)
+        except GatewayError:
+            errors[kind] += 1
+
+    rng = random.Random(args.seed)
+    tasks = [one("heavy", "heavy-user", FREE_TIER, rng.uniform(0, 0.5)) for _ in range(args.heavy)]
+    tasks += [one("light", f"light-{i}", FREE_TIER, rng.uniform(0, args.duration)) for i in range(args.light_users)]
+    tasks += [one("priority", f"priority-{i}", PRIORITY_TIER, rng.uniform(0, args.duration)) for i in range(args.priority_users)]
+    await asyncio.gather(*tasks)
+
+    rows = []
+    for kind, latencies in results.items():
+        values = sorted(latencies)
+        rows.append({
+            "users": kind,
+            "completed": len(values),
+            "rejected": errors[kind],
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        })
+    return rows
+
+
+def print_table(rows: list):
+    print(f"{'users':<10} {'completed':>9} {'rejected':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    print("-" * 47)
+    for row in rows:
+        print(f"{row['users']:<10} {row['completed']:>9} {row['rejected']:>8} {row['p50_ms']:>8} {row['p99_ms']:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--heavy", type=int, default=200, help="ヘビーユーザーが一度に送るリクエスト数")
+    parser.add_argument("--light-users", type=int, default=20)
+    parser.add_argument("--priority-users", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=5.0, help="普通・優先ユーザーが送ってくる期間（秒）")
+    parser.add_argument("--rate", type=float, default=600, help="LLM の回数制限（回/分）")
+    parser.add_argument("--burst", type=int, default=5)
+    parser.add_argument("--deadline", type=float, default=5.0, help="待ち行列の期限（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
@@ -0,0 +1,289 @@
+"""
+ベンチマーク用の偽物（オフラインで動く Gemini と Supabase の代役）
+
+- FakeSupabase: main.py が使う postgrest のクエリチェーンだけを実装したメモリ上のテーブル
+- FakeGenerativeModel: 遅延・ストリーミング・エラー注入を設定できる Gemini の代役
+install() で app 側の config.model / db.get_supabase_client() / genai.GenerativeModel を差し替えます。
+"""
+import asyncio
+import itertools
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core import exceptions as google_exceptions
+
+
+# ==========================================
+# Supabase（postgrest）の代役
+# ==========================================
+_KEYSET = re.compile(r'^(\w+)\.lt\."([^"]+)",and\(\1\.eq\."\2",(\w+)\.lt\.(.+)\)$')
+
+
+def _comparable(value):
+    """タイムゾーン付きの ISO 文字列は datetime にしてから比べる（Postgres の timestamptz と同じ）"""
+    if isinstance(value, str) and "T" in value:
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    return value
+
+
+class FakeQuery:
+    def __init__(self, store, table: str):
+        self.store = store
+        self.table = table
+        self.filters = []
+        self.orders = []
+        self.limit_n = None
+        self.count_mode = None
+        self.columns = None
+        self.insert_rows = None
+        self.upsert_key = False
+
+    def select(self, *columns, count=None):
+        self.columns = None if columns in ((), ("*",)) else columns
+        self.count_mode = count
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: _comparable(row.get(column)) >= _comparable(value))
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: _comparable(row.get(column)) < _comparable(value))
+        return self
+
+    def or_(self, expression):
+        # main.py のキーセットページング用のフィルタだけを解釈する
+        match = _KEYSET.match(expression)
+        if not match:
+            raise ValueError(f"FakeQuery cannot parse or_ filter: {expression}")
+        column, value, tie_column, tie_value = match.groups()
+        value = _comparable(value)
+        tie_value = int(tie_value) if tie_value.isdigit() else tie_value
+        self.filters.append(lambda row: _comparable(row[column]) < value or (
+            _comparable(row[column]) == value and row[tie_column] < tie_value
+        ))
+        return self
+
+    def order(self, column, desc=False, **kwargs):
+        # "created_at.desc,id" のように複数列がまとめて渡されることがある
+        specs = f"{column}{'.desc' if desc else ''}".split(",")
+        for spec in specs:
+            name, _, direction = spec.partition(".")
+            self.orders.append((name, direction == "desc"))
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def insert(self, data):
+        self.insert_rows = data if isinstance(data, list) else [data]
+        return self
+
+    def upsert(self, data, on_conflict: str = ""):
+        self.insert_rows = data if isinstance(data, list) else [data]
+        self.upsert_key = on_conflict or None
+        return self
+
+    def execute(self):
+        time.sleep(self.store.latency)  # 本物と同じく呼び出したスレッドをブロックする
+        if self.insert_rows is not None:
+            if self.upsert_key is not False:
+                return SimpleNamespace(data=self.store.upsert(self.table, self.insert_rows, self.upsert_key), count=None)
+            return SimpleNamespace(data=self.store.insert(self.table, self.insert_rows), count=None)
+
+        rows = [row for row in self.store.rows(self.table) if all(f(row) for f in self.filters)]
+        count = len(rows) if self.count_mode else None
+        for column, desc in reversed(self.orders):
+            rows.sort(key=lambda row: _comparable(row.get(column)), reverse=desc)
+        if self.limit_n is not None:
+            rows = rows[:self.limit_n]
+        if self.columns:
+            rows = [{c: row.get(c) for c in self.columns} for row in rows]
+        return SimpleNamespace(data=rows, count=count)
+
+
+class FakeSupabase:
+    """テーブルごとに行のリストを持つだけのメモリ上の Supabase"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._tables = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict):
+        """DB 関数の呼び出し（add_daily_stats だけ実装）"""
+        if name != "add_daily_stats":
+            raise ValueError(f"FakeSupabase has no function: {name}")
+        return SimpleNamespace(execute=lambda: SimpleNamespace(data=self.add_daily_stats(params["rows"]), count=None))
+
+    def add_daily_stats(self, rows: list) -> list:
+        keys = ("user_id", "day", "mode", "level")
+        with self._lock:
+            table = self._tables.setdefault("user_daily_stats", [])
+            for row in rows:
+                existing = next((r for r in table if all(r[k] == row[k] for k in keys)), None)
+                if existing is None:
+                    table.append(dict(row))
+                else:
+                    for field in ("turns", "user_chars", "ai_chars"):
+                        existing[field] += row[field]
+        return rows
+
+    def rows(self, table: str) -> list:
+        with self._lock:
+            return list(self._tables.get(table, []))
+
+    def insert(self, table: str, rows: list) -> list:
+        inserted = []
+        with self._lock:
+            for row in rows:
+                row = dict(row)
+                row.setdefault("id", next(self._ids))
+                row.setdefault("created_at", datetime.now(timezone.utc).isoformat())
+                if table == "chat_history":
+                    row.setdefault("counts_quota", True)  # 本物の列の既定値と同じ
+                self._tables.setdefault(table, []).append(row)
+                inserted.append(row)
+        return inserted
+
+    def upsert(self, table: str, rows: list, key: str = None) -> list:
+        """key（省略時は id、無ければ user_id）が同じ行を置き換える"""
+        with self._lock:
+            existing = self._tables.setdefault(table, [])
+            for row in rows:
+                column = key or ("id" if "id" in row else "user_id")
+                existing[:] = [r for r in existing if r.get(column) != row.get(column)]
+                existing.append(dict(row))
+        return rows
+
+    def seed_history(self, user_ids, turns_per_user: int, reply_chars: int = 600):
+        """ベンチマーク前に各ユーザーの過去の会話を作っておく"""
+        base = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+        rows = []
+        for user_id in user_ids:
+            for i in range(turns_per_user):
+                rows.append({
+                    "user_id": user_id,
+                    "user_message": f"past message {i}",
+                    "ai_response": "【英語】" + "x" * reply_chars,
+                    "created_at": datetime.fromtimestamp(base + i * 60, timezone.utc).isoformat(),
+                })
+        self.insert("chat_history", rows)
+
+
+# ==========================================
+# Gemini の代役
+# ==========================================
+class FakeLLMSettings:
+    """FakeGenerativeModel の振る舞い（全インスタンス共通）"""
+    latency = 0.3           # 最初のトークンまでの秒数
+    chunk_latency = 0.02    # ストリーミング時のチャンク間隔
+    chunks = 8
+    error_rate = 0.0        # この確率で 429 / 503 を投げる
+    tail_rate = 0.0         # この確率で最初のトークンが tail_latency 秒まで遅れる（ヘッジの効果を見る用）
+    tail_latency = 3.0
+    char_latency = 0.0      # 依頼文1文字あたりの追加の秒数（添削の返答は入力が長いほど遅い）
+    reply = "【英語】That sounds great!\n【日本語】いいですね！\n【Coach's Advice】Keep going."
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // 4,
+            total_token_count=prompt_tokens + len(text) // 4,
+        )
+
+
+class FakeStream:
+    def __init__(self, text: str, prompt_tokens: int):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+
+    async def __aiter__(self):
+        settings = FakeLLMSettings
+        size = max(1, len(self.text) // settings.chunks)
+        for i in range(0, len(self.text), size):
+            if i:
+                await asyncio.sleep(settings.chunk_latency)
+            # 本物と同じく、最後のチャンクにだけ usage_metadata が付く
+            last = i + size >= len(self.text)
+            usage = FakeResponse(self.text, self.prompt_tokens).usage_metadata if last else None
+            yield SimpleNamespace(text=self.text[i:i + size], usage_metadata=usage)
+
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, content, stream=False, **kwargs):
+        settings = FakeLLMSettings
+        slow = random.random() < settings.tail_rate
+        await asyncio.sleep((settings.tail_latency if slow else settings.latency) + len(str(content)) * settings.char_latency)
+        if random.random() < settings.error_rate:
+            raise random.choice([
+                google_exceptions.ResourceExhausted("429 fake quota exceeded"),
+                google_exceptions.ServiceUnavailable("503 fake upstream unavailable"),
+            ])
+        prompt_chars = len(self.model.system_instruction or "") + len(str(content)) + sum(
+            len(str(part)) for item in self.history for part in item["parts"]
+        )
+        text = settings.reply
+        if stream:
+            return FakeStream(text, prompt_chars // 4)
+        return FakeResponse(text, prompt_chars // 4)
+
+
+class FakeGenerativeModel:
+    def __init__(self, model_name=None, system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+# ==========================================
+# 差し替え
+# ==========================================
+def install(db_latency: float = 0.0, llm_latency: float = 0.3, chunk_latency: float = 0.02,
+            error_rate: float = 0.0, tail_rate: float = 0.0, tail_latency: float = 3.0,
+            char_latency: float = 0.0) -> FakeSupabase:
+    """app 側の Gemini と Supabase を偽物に差し替え、偽の Supabase を返す"""
+    import google.generativeai as genai
+    from app import config, db, main
+
+    FakeLLMSettings.latency = llm_latency
+    FakeLLMSettings.chunk_latency = chunk_latency
+    FakeLLMSettings.error_rate = error_rate
+    FakeLLMSettings.tail_rate = tail_rate
+    FakeLLMSettings.tail_latency = tail_latency
+    FakeLLMSettings.char_latency = char_latency
+
+    fake_db = FakeSupabase(latency=db_latency)
+    db.supabase = fake_db
+    db._initialized = True
+
+    genai.GenerativeModel = FakeGenerativeModel
+    config._genai = genai
+    config.model = FakeGenerativeModel(model_name=config.MODEL_NAME)
+    main.model_registry._entries.clear()
+    return fake_db
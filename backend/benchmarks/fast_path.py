@@ -0,0 +1,101 @@
+"""
+LLM に渡す前の振り分け（Fast Path）のベンチマーク
+
+お礼・相づち・空のメッセージ・普通の英文を混ぜた送信を、振り分けなし（すべて LLM に渡す）と振り分けありで
+それぞれ --requests 回ずつ /chat に送り、p50/p99 と LLM の呼び出し回数を比べます。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.fast_path --requests 100 --llm-latency 1.0
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes
+from benchmarks.bench import percentile
+
+# 半分がお礼・相づち・空送信（効果が見えやすいように実際の利用より多め）
+MESSAGES = (
+    "I went to the office by train and read an English book.",
+    "ありがとうございます！",
+    "Could you check this sentence? I have been to Tokyo last year.",
+    "OK 👍",
+    "Yesterday I have a meeting with my boss about the new project.",
+    "Thanks!",
+    "What is the difference between 'affect' and 'effect'?",
+    "",
+)
+
+
+async def run(args) -> list:
+    fakes.install(llm_latency=args.llm_latency)
+    from app import main
+    from app.fast_path import FastPathClassifier
+    from app.llm_gateway import LLMGateway
+
+    main.llm_gateway = LLMGateway(rate_per_minute=1_000_000, burst=1_000)
+    # 返答キャッシュがあると2回目以降は LLM を呼ばないので、振り分けの効果だけを見るために外す
+    main.response_cache = None
+    if main.write_behind:
+        main.write_behind.spool_path = tempfile.mktemp(suffix=".jsonl")
+        await main.write_behind.start()
+
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, classifier in (("llm only", None), ("fast path", FastPathClassifier())):
+            main.fast_path = classifier
+            llm_calls = main.llm_gateway.counters["calls"]
+            latencies = []
+            statuses = {}
+            for i in range(args.requests):
+                user_id = f"bench-{name}-{i % 10}"
+                started = time.perf_counter()
+                res = await client.post("/chat", json={
+                    "message": MESSAGES[i % len(MESSAGES)], "user_id": user_id, "level": "B2", "mode": "default",
+                })
+                latencies.append(time.perf_counter() - started)
+                statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+            latencies.sort()
+            rows.append({
+                "mode": name,
+                "requests": args.requests,
+                "llm_calls": main.llm_gateway.counters["calls"] - llm_calls,
+                "statuses": statuses,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            })
+
+    if main.write_behind:
+        await main.write_behind.stop()
+    return rows
+
+
+def print_table(rows: list):
+    print(f"{'mode':<10} {'requests':>8} {'llm calls':>9} {'p50 ms':>9} {'p99 ms':>9}  statuses")
+    print("-" * 65)
+    for r in rows:
+        print(
+            f"{r['mode']:<10} {r['requests']:>8} {r['llm_calls']:>9}"
+            f" {r['p50_ms']:>9} {r['p99_ms']:>9}  {r['statuses']}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
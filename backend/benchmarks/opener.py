@@ -0,0 +1,91 @@
+"""
+実力判定の書き出し（Opener Bank）のベンチマーク
+
+「📏 実力判定テスト」ボタンの送信を、作り置きなし（毎回 LLM で生成）と作り置きありで
+それぞれ --requests 回ずつ /chat に送り、p50/p99 と LLM の呼び出し回数を比べます。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.opener --requests 50 --llm-latency 1.0
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import fakes
+from benchmarks.bench import percentile
+
+
+async def run(args) -> list:
+    fakes.install(llm_latency=args.llm_latency)
+    from app import main
+    from app.llm_gateway import LLMGateway
+    from app.opener_bank import ASSESSMENT_OPENER, OpenerBank
+
+    main.llm_gateway = LLMGateway(rate_per_minute=1_000_000, burst=1_000)
+    # 返答キャッシュがあると2回目以降は LLM を呼ばないので、作り置きの効果だけを見るために外す
+    main.response_cache = None
+    if main.write_behind:
+        main.write_behind.spool_path = tempfile.mktemp(suffix=".jsonl")
+        await main.write_behind.start()
+
+    # 偽物の Gemini は毎回同じ返答なので、作り置きはレベルごとに1つになる
+    bank = OpenerBank(main.storage.load_openers, main.storage.save_openers)
+    fill_started = time.perf_counter()
+    await bank.fill(main.generate_opener)
+    fill_seconds = time.perf_counter() - fill_started
+
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for name, opener_bank in (("llm", None), ("opener_bank", bank)):
+            main.opener_bank = opener_bank
+            llm_calls = main.llm_gateway.counters["calls"]
+            latencies = []
+            for i in range(args.requests):
+                started = time.perf_counter()
+                res = await client.post("/chat", json={
+                    "message": ASSESSMENT_OPENER, "user_id": f"bench-{name}-{i}", "level": "B2", "mode": "assessment",
+                })
+                res.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            latencies.sort()
+            rows.append({
+                "source": name,
+                "requests": args.requests,
+                "llm_calls": main.llm_gateway.counters["calls"] - llm_calls,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            })
+    rows.append({"source": "fill (background)", "requests": 0, "llm_calls": bank.stats()["generated"],
+                 "p50_ms": round(fill_seconds * 1000, 1), "p99_ms": round(fill_seconds * 1000, 1)})
+
+    if main.write_behind:
+        await main.write_behind.stop()
+    return rows
+
+
+def print_table(rows: list):
+    print(f"{'source':<18} {'requests':>8} {'llm calls':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    print("-" * 57)
+    for r in rows:
+        print(f"{r['source']:<18} {r['requests']:>8} {r['llm_calls']:>9} {r['p50_ms']:>9} {r['p99_ms']:>9}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
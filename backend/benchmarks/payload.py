@@ -0,0 +1,147 @@
+"""
+/history のレスポンスの大きさと書き出し時間のベンチマーク
+
+日本語と英語が混ざった会話を1ページ分（件数を変えて）作り、full（全列）と lean（発言と返答だけ）それぞれについて
+- JSON の書き出し時間（標準の json と orjson）と大きさ
+- gzip / br で圧縮した時の大きさと圧縮時間
+を出します。最後に実際のアプリに Accept-Encoding を変えて /history を取りに行き、転送されるバイト数を確かめます。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.payload --sizes 20 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ.setdefault("STORAGE_SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "payload.sqlite3"))
+
+import httpx
+
+from benchmarks import fakes
+
+REPLY = (
+    "【英語】That sounds like a wonderful weekend! What did you enjoy the most about the trip to Kyoto?\n"
+    "【日本語】素敵な週末ですね！京都への旅行で一番楽しかったことは何ですか？\n"
+    "【Coach's Advice】「I went to Kyoto with my family」は自然です。"
+    "「enjoyed」の後には目的語が必要なので「I enjoyed it very much」としましょう。"
+)
+MESSAGE = "Last weekend I went to Kyoto with my family and I enjoyed very much. 抹茶のお菓子も食べました。"
+
+
+def make_page(size: int, fields: str) -> dict:
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    items = []
+    for i in range(size):
+        item = {
+            "id": 100000 + i,
+            "user_id": "bench-payload-user",
+            "user_message": f"{MESSAGE} ({i})",
+            "ai_response": REPLY,
+            "created_at": (start + timedelta(minutes=i)).isoformat(),
+        }
+        if fields == "lean":
+            item = {"user_message": item["user_message"], "ai_response": item["ai_response"]}
+        items.append(item)
+    return {"items": items, "next_before": "MjAyNi0xMC0xN1QwMDowMDowMCswMDowMHwxMDAwMDA", "has_more": True}
+
+
+def timed(fn, repeat: int):
+    """repeat 回の平均ミリ秒と最後の戻り値"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return round((time.perf_counter() - started) * 1000 / repeat, 3), result
+
+
+def measure_encoding(size: int, fields: str, repeat: int) -> dict:
+    from app.responses import SUPPORTED_ENCODINGS, compress, dumps
+
+    page = make_page(size, fields)
+    json_ms, _ = timed(lambda: json.dumps(page).encode("utf-8"), repeat)
+    orjson_ms, body = timed(lambda: dumps(page), repeat)
+    row = {"rows": size, "fields": fields, "json_ms": json_ms, "orjson_ms": orjson_ms, "raw_kb": round(len(body) / 1024, 1)}
+    for encoding in ("gzip", "br"):
+        if encoding not in SUPPORTED_ENCODINGS:
+            row[f"{encoding}_kb"] = row[f"{encoding}_ms"] = None
+            continue
+        elapsed, compressed = timed(lambda: compress(body, encoding), repeat)
+        row[f"{encoding}_kb"] = round(len(compressed) / 1024, 1)
+        row[f"{encoding}_ms"] = elapsed
+    return row
+
+
+async def measure_transfer(main, size: int) -> list:
+    """実際のアプリから /history を取り、Accept-Encoding ごとの転送バイト数を見る"""
+    user_id = f"bench-payload-{size}"
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    main.storage.insert_many([
+        {
+            "user_id": user_id, "user_message": f"{MESSAGE} ({i})", "ai_response": REPLY,
+            "created_at": (start + timedelta(minutes=i)).isoformat(),
+        }
+        for i in range(size)
+    ])
+    rows = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for fields in ("full", "lean"):
+            for accept in ("identity", "gzip", "br"):
+                resp = await client.get(
+                    f"/history/{user_id}", params={"limit": size, "fields": fields},
+                    headers={"Accept-Encoding": accept},
+                )
+                resp.raise_for_status()
+                rows.append({
+                    "rows": size, "fields": fields, "accept": accept,
+                    "content_encoding": resp.headers.get("content-encoding", "identity"),
+                    "wire_kb": round(int(resp.headers["content-length"]) / 1024, 1),
+                    "items": len(resp.json()["items"]),
+                })
+    return rows
+
+
+async def run(args) -> dict:
+    fakes.install()
+    from app import main
+
+    encoding = [measure_encoding(size, fields, args.repeat) for size in args.sizes for fields in ("full", "lean")]
+    transfer = []
+    for size in args.sizes:
+        transfer += await measure_transfer(main, min(size, 200))
+    return {"encoding": encoding, "transfer": transfer}
+
+
+def print_tables(result: dict):
+    print(f"{'rows':>5} {'fields':>6} {'json ms':>8} {'orjson ms':>10} {'raw KB':>7} {'gzip KB':>8} {'gzip ms':>8} {'br KB':>6} {'br ms':>6}")
+    print("-" * 75)
+    for r in result["encoding"]:
+        print(
+            f"{r['rows']:>5} {r['fields']:>6} {r['json_ms']:>8} {r['orjson_ms']:>10} {r['raw_kb']:>7}"
+            f" {str(r['gzip_kb']):>8} {str(r['gzip_ms']):>8} {str(r['br_kb']):>6} {str(r['br_ms']):>6}"
+        )
+    print()
+    print(f"{'rows':>5} {'fields':>6} {'accept':>9} {'encoding':>9} {'wire KB':>8}")
+    print("-" * 42)
+    for r in result["transfer"]:
+        print(f"{r['rows']:>5} {r['fields']:>6} {r['accept']:>9} {r['content_encoding']:>9} {r['wire_kb']:>8}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 200])
+    parser.add_argument("--repeat", type=int, default=50, help="書き出し・圧縮を何回繰り返して平均するか")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_tables(result)
@@ -0,0 +1,85 @@
+"""
+検索インデックス（app/retrieval.py）のベンチマーク（履歴の件数ごとの検索レイテンシを測る）
+
+1ユーザー分の過去の会話を件数を変えて作り、インデックスの作り直しにかかる時間と、
+新しい発言1件あたりの検索時間（p50/p95/p99）、ベクトルのメモリ量を出します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.retrieval --sizes 100 1000 5000 20000 --queries 500
+"""
+import argparse
+import json
+import random
+import time
+
+from app.retrieval import RetrievalIndex
+from benchmarks.bench import percentile
+
+TOPICS = (
+    "travel", "cooking", "job interview", "presentation", "meeting", "movie", "weekend plans",
+    "hobby", "family", "weather", "shopping", "restaurant", "business email", "exam", "music",
+)
+PHRASES = (
+    "I want to talk about {t}.", "Could you check my sentence about {t}?", "昨日は{t}について考えました。",
+    "How do I say this about {t} naturally?", "{t}の話をしたいです。", "Yesterday I had a {t} and it was fun.",
+)
+
+
+def make_turn(rng: random.Random) -> dict:
+    topic = rng.choice(TOPICS)
+    message = " ".join(rng.choice(PHRASES).format(t=topic) for _ in range(rng.randint(1, 3)))
+    return {
+        "user_message": message,
+        "ai_response": f"【英語】Let's practice talking about {topic}. Tell me more!\n【日本語】{topic}について練習しましょう。",
+    }
+
+
+def run(size: int, queries: int, k: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    turns = [make_turn(rng) for _ in range(size)]
+    index = RetrievalIndex(max_turns=size)
+
+    started = time.perf_counter()
+    index.rebuild("bench-user", turns)
+    rebuild_seconds = time.perf_counter() - started
+
+    messages = [make_turn(rng)["user_message"] for _ in range(queries)]
+    latencies = []
+    for message in messages:
+        started = time.perf_counter()
+        index.query("bench-user", message, k, exclude_recent=5)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return {
+        "turns": size,
+        "rebuild_ms": round(rebuild_seconds * 1000, 1),
+        "query_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "query_p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "query_p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "index_kib": round(index.stats()["bytes"] / 1024, 1),
+    }
+
+
+def print_table(rows: list):
+    header = ("turns", "rebuild_ms", "query_p50_ms", "query_p95_ms", "query_p99_ms", "index_kib")
+    print(" | ".join(f"{h:>12}" for h in header))
+    for row in rows:
+        print(" | ".join(f"{row[h]:>12}" for h in header))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000, 20000])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = [run(size, args.queries, args.top_k, args.seed) for size in args.sizes]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
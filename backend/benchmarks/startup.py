@@ -0,0 +1,82 @@
+"""
+起動時間のベンチマーク（スケール・フロム・ゼロでどれだけ早く応答できるかを測る）
+
+1. 新しいプロセスで app.main を import するのにかかる時間
+2. uvicorn を起動してから /healthz と /readyz が 200 を返すまでの時間
+を複数回測って中央値を出します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.startup --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import app.main; print(time.perf_counter() - t)"
+
+
+def measure_import() -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], capture_output=True, text=True, check=True,
+    )
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url: str, started: float, timeout: float) -> float:
+    while time.perf_counter() - started < timeout:
+        try:
+            if httpx.get(url, timeout=0.5).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.01)
+    return float("nan")
+
+
+def measure_server(timeout: float) -> tuple:
+    port = free_port()
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=os.environ.copy(),
+    )
+    try:
+        healthy = wait_for(f"http://127.0.0.1:{port}/healthz", started, timeout)
+        ready = wait_for(f"http://127.0.0.1:{port}/readyz", started, timeout)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return healthy, ready
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    imports, healthz, readyz = [], [], []
+    for _ in range(args.runs):
+        imports.append(measure_import())
+        h, r = measure_server(args.timeout)
+        healthz.append(h)
+        readyz.append(r)
+
+    print(f"{'metric':<22} {'median ms':>10} {'max ms':>10}")
+    for name, values in (("import app.main", imports), ("time to /healthz", healthz), ("time to /readyz", readyz)):
+        print(f"{name:<22} {statistics.median(values) * 1000:>10.1f} {max(values) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
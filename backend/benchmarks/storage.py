@@ -0,0 +1,112 @@
+"""
+保存先（app/storage.py の ChatRepository）の操作ごとのマイクロベンチマーク
+
+SQLite 版に会話を --rows 件入れてから、クォータ集計・直近 N 件・履歴ページ（先頭／深い位置）・
+1件書き込み・まとめ書きをそれぞれ --repeat 回ずつ実行し、1回あたりの p50/p99 を出します。
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.storage --rows 100000 --users 100
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+from app.storage import SQLiteRepository
+from benchmarks.bench import percentile
+
+
+def seed(repo: SQLiteRepository, rows: int, users: int, rng: random.Random):
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    batch = []
+    for i in range(rows):
+        batch.append({
+            "user_id": f"user-{rng.randrange(users)}",
+            "user_message": f"message {i}",
+            "ai_response": f"response {i}",
+            "created_at": (start + timedelta(seconds=i * 25)).isoformat(),
+        })
+        if len(batch) == 1000:
+            repo.insert_many(batch)
+            batch = []
+    if batch:
+        repo.insert_many(batch)
+
+
+def measure(fn, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {"p50_us": round(percentile(samples, 50) * 1e6, 1), "p99_us": round(percentile(samples, 99) * 1e6, 1)}
+
+
+def run(args) -> list:
+    rng = random.Random(args.seed)
+    path = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    repo = SQLiteRepository(path)
+    seed(repo, args.rows, args.users, rng)
+
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
+    user = lambda: f"user-{rng.randrange(args.users)}"
+
+    def deep_page():
+        # 1人分の履歴を半分ほどめくった位置から読む
+        user_id = user()
+        rows = repo.history_page(user_id, args.rows // args.users // 2)
+        before = (rows[-1]["created_at"], rows[-1]["id"]) if rows else None
+        started = time.perf_counter()
+        repo.history_page(user_id, 20, before)
+        return time.perf_counter() - started
+
+    def row(i: int = 0) -> dict:
+        return {"user_id": user(), "user_message": f"bench {i}", "ai_response": "ok",
+                "created_at": datetime.now(timezone.utc).isoformat()}
+
+    results = [
+        {"operation": "count_since", **measure(lambda: repo.count_since(user(), today), args.repeat)},
+        {"operation": "latest_turns(10)", **measure(lambda: repo.latest_turns(user(), 10), args.repeat)},
+        {"operation": "history_page(20)", **measure(lambda: repo.history_page(user(), 20), args.repeat)},
+    ]
+    deep = sorted(deep_page() for _ in range(args.repeat))
+    results.append({
+        "operation": "history_page(20, deep)",
+        "p50_us": round(percentile(deep, 50) * 1e6, 1), "p99_us": round(percentile(deep, 99) * 1e6, 1),
+    })
+    results.append({"operation": "insert", **measure(lambda: repo.insert(row()), args.repeat)})
+    results.append({
+        "operation": f"insert_many({args.batch})",
+        **measure(lambda: repo.insert_many([row(i) for i in range(args.batch)]), max(1, args.repeat // 10)),
+    })
+    return results
+
+
+def print_table(rows: list):
+    print(f"{'operation':<26} {'p50 us':>10} {'p99 us':>10}")
+    print("-" * 48)
+    for r in rows:
+        print(f"{r['operation']:<26} {r['p50_us']:>10} {r['p99_us']:>10}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000, help="最初に入れておく会話の件数")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=500, help="操作ごとの実行回数")
+    parser.add_argument("--batch", type=int, default=50, help="まとめ書き1回あたりの件数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = run(args)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_table(rows)
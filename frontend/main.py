@@ -1,6 +1,15 @@
 import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
 
 from supabase import create_client, ClientOptions
 from dotenv import load_dotenv
@@ -9,15 +18,6 @@ load_dotenv()
 
 from ui_components import apply_custom_css, display_fixed_ad, display_main_header
 
-# 🌟 判定テストの回答数を管理する変数を追加
-if "assessment_count" not in st.session_state:
-    st.session_state.assessment_count = 0
-
-# 判定テストの最大回数を定義
-MAX_ASSESSMENT_QUESTIONS = 5
-
-
-
 # ==========================================
 # 1. 初期設定とUIパーツの定義
 # ==========================================
@@ -70,6 +70,181 @@ def init_supabase():
 
 supabase = init_supabase()
 
+# --- バックエンドとの通信（接続を使い回す） ---
+HTTP_POOL_SIZE = 20
+# (接続のタイムアウト, 読み込みのタイムアウト) 秒。ストリーミングは次のチャンクまでの待ち時間になる
+HTTP_TIMEOUT = (3.05, 30)
+CHAT_TIMEOUT = (3.05, 90)
+
+@st.cache_resource
+def get_http_session():
+    """
+    全セッションで共有する requests.Session（キープアライブで TCP 接続を使い回す）。
+    接続できなかった時と 502/504 は少し待って再送する（/chat 系は冪等キー付きなので二重にはならない）。
+    brotli が入っていれば br、無ければ gzip の圧縮レスポンスを受け取る（展開は urllib3 が行う）。
+    """
+    retry = Retry(
+        total=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 504),
+        allowed_methods=frozenset({"GET", "POST"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http = get_http_session()
+
+# --- 会話履歴をページ単位で読み込む ---
+HISTORY_PAGE_SIZE = 20
+
+def fetch_history_page(user_id, before=None):
+    """最新（または before より古い）1ページ分の履歴と、次のページのカーソルを返す"""
+    # 画面に出すのは発言と返答だけなので、その列だけ返してもらう
+    params = {"limit": HISTORY_PAGE_SIZE, "fields": "lean"}
+    if before:
+        params["before"] = before
+    resp = http.get(f"{BACKEND_BASE_URL}/history/{user_id}", params=params, timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    page = resp.json()
+    return page.get("items", []), page.get("next_before")
+
+def history_to_messages(items):
+    messages = []
+    for item in items:
+        messages.append({"role": "user", "content": item["user_message"]})
+        messages.append({"role": "assistant", "content": item["ai_response"]})
+    return messages
+
+# --- 読み込んだ履歴をユーザーごとに持っておく（再読み込みやタブを開き直した時に取りに行かない） ---
+HISTORY_CACHE_TTL_SECONDS = 300
+HISTORY_CACHE_MAX_USERS = 500
+
+class HistoryCache:
+    """
+    user_id -> {"messages": [...], "cursor": 次のページのカーソル, "loaded_at": 読み込んだ時刻}
+    messages は送信のたびに後ろへ足していくので、一度読んだページはもう読み直さない。
+    別の端末からの書き込みを拾えるよう、新しいセッションでは TTL を過ぎたものだけ読み直す。
+    同じユーザーの複数のセッション（タブ）で共有するので、load はコピーを返し、書き換えは append / prepend でロックを取って行う。
+    """
+
+    def __init__(self, ttl=HISTORY_CACHE_TTL_SECONDS, max_users=HISTORY_CACHE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # Streamlit はセッションごとに別スレッドで動く
+
+    def load(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and time.monotonic() - entry["loaded_at"] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return {**entry, "messages": list(entry["messages"])}
+        items, cursor = fetch_history_page(user_id)
+        entry = {"messages": history_to_messages(items), "cursor": cursor, "loaded_at": time.monotonic()}
+        with self._lock:
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+            return {**entry, "messages": list(entry["messages"])}
+
+    def append(self, user_id, messages):
+        """送信して返ってきた往復をキャッシュの後ろに足す"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                entry["messages"].extend(messages)
+
+    def prepend(self, user_id, messages, before, cursor):
+        """before のページより古いページを前に足す（別のセッションが先に足していたら何もしない）"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and entry["cursor"] == before:
+                entry["messages"][:0] = messages
+                entry["cursor"] = cursor
+
+@st.cache_resource
+def get_history_cache():
+    return HistoryCache()
+
+# --- 履歴の表示（古い方は窓の分だけ描く） ---
+RECENT_MESSAGES = 4
+HISTORY_WINDOW = HISTORY_PAGE_SIZE * 2  # 1ページ分（1往復 = 2メッセージ）
+
+def render_messages(messages):
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+# --- コーチの返答をストリーミングで受け取る ---
+def stream_coach_reply(payload):
+    """/chat/stream の Server-Sent Events を読み、届いたテキストを順に返すジェネレーター"""
+    with http.post(f"{BACKEND_BASE_URL}/chat/stream", json=payload, stream=True, timeout=CHAT_TIMEOUT) as response:
+        if response.status_code != 200:
+            # 空・長すぎるメッセージはバックエンドが理由を返してくる
+            try:
+                detail = response.json().get("detail")
+            except ValueError:
+                detail = None
+            st.error(detail if isinstance(detail, str) else "コーチが一時的に席を外しているようです。")
+            return
+
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                event = None
+                continue
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event == "error":
+                    st.error(data.get("detail", "コーチが一時的に席を外しているようです。"))
+                    return
+                if event == "done":
+                    return
+                if event == "assessment":
+                    # 🌟 判定テストの進行状態はバックエンドが数えて返してくる
+                    st.session_state.assessment = data
+                    continue
+                yield data.get("text", "")
+
+# --- 判定テストの進行状態（何往復答えたか・判定結果）はバックエンドが持つ ---
+def fetch_assessment_state(user_id):
+    resp = http.get(f"{BACKEND_BASE_URL}/assessment/{user_id}", timeout=HTTP_TIMEOUT)
+    resp.raise_for_status()
+    return resp.json()
+
+# --- 長い文章はまとめて並行に添削してもらう ---
+BATCH_MIN_CHARS = 400
+BATCH_MODES = ("diary", "default")
+
+def request_batch_correction(payload):
+    """/chat/batch に長い文章を送り、つなげた添削結果を返す"""
+    resp = http.post(f"{BACKEND_BASE_URL}/chat/batch", json=payload, timeout=CHAT_TIMEOUT)
+    if resp.status_code != 200:
+        st.error(resp.json().get("detail", "コーチが一時的に席を外しているようです。"))
+        return None
+    return resp.json().get("ai_response")
+
+# --- 送信ごとの冪等キー ---
+def submission_key(prompt, mode):
+    """
+    送信ごとに冪等キーを作る。返答を受け取る前に同じ内容が送られた場合（ボタンの連打や再実行）は
+    同じキーを返すので、バックエンドでは1回の送信として扱われる。2つ目の戻り値は再送かどうか。
+    """
+    pending = st.session_state.get("pending_submission")
+    if pending and pending["prompt"] == prompt and pending["mode"] == mode:
+        return pending["key"], True
+    key = uuid.uuid4().hex
+    st.session_state.pending_submission = {"prompt": prompt, "mode": mode, "key": key}
+    return key, False
+
 # --- 状態管理 ---
 if "user" not in st.session_state:
     st.session_state.user = None
@@ -201,32 +376,43 @@ else:
     display_main_header()
     display_fixed_ad()
 
-    # --- 履歴の読み込み（初回のみ） ---
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
+    # --- 履歴の読み込み（ユーザーごとのキャッシュ。初回は最新の1ページだけ） ---
+    if st.session_state.get("history_user") != st.session_state.user.id:
         try:
-            resp = requests.get(f"{BACKEND_BASE_URL}/history/{st.session_state.user.id}")
-            if resp.status_code == 200:
-                past_data = resp.json()
-                for item in past_data:
-                    st.session_state.messages.append({"role": "user", "content": item["user_message"]})
-                    st.session_state.messages.append({"role": "assistant", "content": item["ai_response"]})
+            st.session_state.history = get_history_cache().load(st.session_state.user.id)
         except Exception as e:
             st.error(f"履歴の読み込みエラー: {e}")
+            st.session_state.history = {"messages": [], "cursor": None, "loaded_at": time.monotonic()}
+        try:
+            st.session_state.assessment = fetch_assessment_state(st.session_state.user.id)
+        except Exception:
+            st.session_state.assessment = None
+        # キャッシュの中身は他のセッションと共有なので、このセッション用に写してから書き足す
+        st.session_state.messages = list(st.session_state.history["messages"])
+        st.session_state.history_user = st.session_state.user.id
+        st.session_state.history_window = HISTORY_WINDOW
+    history = st.session_state.history
 
     # --- 履歴の表示 ---
-    if len(st.session_state.messages) > 4:
+    older = st.session_state.messages[:-RECENT_MESSAGES]
+    if older or history["cursor"]:
         with st.expander("📜 過去のコーチング履歴を表示", expanded=False):
-            for message in st.session_state.messages[:-4]:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
-        for message in st.session_state.messages[-4:]:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-    else:
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
+            # 🌟 古い方は窓の分だけ描き、ボタンで窓を広げる（足りなければ次のページを取りに行く）
+            if (len(older) > st.session_state.history_window or history["cursor"]) \
+                    and st.button("⏪ さらに古い履歴を表示", use_container_width=True):
+                if len(older) <= st.session_state.history_window:
+                    try:
+                        before = history["cursor"]
+                        items, history["cursor"] = fetch_history_page(st.session_state.user.id, before=before)
+                        page = history_to_messages(items)
+                        st.session_state.messages[:0] = page
+                        get_history_cache().prepend(st.session_state.user.id, page, before, history["cursor"])
+                        older = st.session_state.messages[:-RECENT_MESSAGES]
+                    except Exception as e:
+                        st.error(f"履歴の読み込みエラー: {e}")
+                st.session_state.history_window += HISTORY_WINDOW
+            render_messages(older[-st.session_state.history_window:])
+    render_messages(st.session_state.messages[-RECENT_MESSAGES:])
 
     # --- モード選択とプログレスバー ---
     if "current_mode" not in st.session_state:
@@ -243,7 +429,6 @@ else:
     with row1_col1:
         if st.button("📏 実力判定テスト", use_container_width=True):
             st.session_state.current_mode = "assessment"
-            st.session_state.assessment_count = 0
             quick_prompt = "現在の英語力を測るための簡単なテストを開始してください。"
 
     with row1_col2:
@@ -266,49 +451,58 @@ else:
             st.session_state.current_mode = "default"
             quick_prompt = "英文を添削してください。"
 
-    # 📊 実力判定時のみプログレスバーを表示
-    if st.session_state.current_mode == "assessment":
-        progress = min(st.session_state.assessment_count / MAX_ASSESSMENT_QUESTIONS, 1.0)
-        st.write(f"📊 **実力判定の進捗: {st.session_state.assessment_count} / {MAX_ASSESSMENT_QUESTIONS}**")
-        st.progress(progress)
-        if st.session_state.assessment_count >= MAX_ASSESSMENT_QUESTIONS:
+    # 📊 実力判定時のみプログレスバーを表示（回数はバックエンドが数えたもの）
+    assessment = st.session_state.get("assessment")
+    if st.session_state.current_mode == "assessment" and assessment and assessment["status"] == "in_progress":
+        turns, max_turns = assessment["turns"], assessment["max_turns"]
+        st.write(f"📊 **実力判定の進捗: {turns} / {max_turns}**")
+        st.progress(min(turns / max_turns, 1.0))
+        if turns + 1 >= max_turns:
             st.info("💡 十分な情報が集まりました。次の送信で判定結果が出ます！")
+        elif turns >= assessment["min_turns"]:
+            st.info("💡 「判定してください」と送ると、ここで判定結果を出せます。")
 
 # ==========================================
     # チャット入力と送信処理
     # ==========================================
     if prompt := (st.chat_input("メッセージを入力...") or quick_prompt):
-        
-        # 🌟 送信前にカウントアップ（手動入力の時だけ）
-        if st.session_state.current_mode == "assessment" and not quick_prompt:
-            st.session_state.assessment_count += 1
+        # 🌟 返答前の同じ送信（連打など）は同じキーで送り、二重に表示しない
+        idempotency_key, resent = submission_key(prompt, st.session_state.current_mode)
 
         # 1. ユーザーのメッセージを画面に追加
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        # 2. 5回目なら判定を促す指示を追加
-        final_prompt = prompt
-        if st.session_state.current_mode == "assessment" and st.session_state.assessment_count >= MAX_ASSESSMENT_QUESTIONS:
-            final_prompt += "\n(This is my final reply. Please provide my CEFR assessment now.)"
-
-        # 3. AIの思考中スピナーを表示
+        if not resent:
+            st.session_state.messages.append({"role": "user", "content": prompt})
+            with st.chat_message("user"):
+                st.markdown(prompt)
+
+        # 2. AIの返答をストリーミングで少しずつ表示（判定テストの回数・採点はバックエンドが管理する）
+        payload = {
+            "message": prompt,
+            "user_id": st.session_state.user.id,
+            "level": target_level,
+            "mode": st.session_state.current_mode, # 🌟 モードを送信
+            "idempotency_key": idempotency_key,
+        }
         try:
-            with st.spinner("Coach is thinking..."):
-                payload = {
-                    "message": final_prompt, 
-                    "user_id": st.session_state.user.id,
-                    "level": target_level,
-                    "mode": st.session_state.current_mode # 🌟 モードを送信
-                }
-                response = requests.post(f"{BACKEND_BASE_URL}/chat", json=payload)
-                
-                if response.status_code == 200:
-                    ai_response = response.json().get("ai_response")
-                    st.session_state.messages.append({"role": "assistant", "content": ai_response})
-                    st.rerun() # 🌟 ここで画面を更新
+            with st.chat_message("assistant"):
+                if st.session_state.current_mode in BATCH_MODES and len(prompt) >= BATCH_MIN_CHARS:
+                    # 🌟 日記・添削の長文は文ごとに分けて並行に添削する（待ち時間が短くなる）
+                    with st.spinner("文章を分けて添削しています..."):
+                        ai_response = request_batch_correction(payload)
+                    if ai_response:
+                        st.markdown(ai_response)
                 else:
-                    st.error("コーチが一時的に席を外しているようです。")
+                    ai_response = st.write_stream(stream_coach_reply(payload))
+            if ai_response:
+                st.session_state.pending_submission = None
+                st.session_state.messages.append({"role": "assistant", "content": ai_response})
+                get_history_cache().append(st.session_state.user.id, [
+                    {"role": "user", "content": prompt}, {"role": "assistant", "content": ai_response},
+                ])
+                # 🌟 判定が出たら通常の会話に戻す（判定モードのままだと同じ結果が返るだけになる）
+                assessment = st.session_state.get("assessment")
+                if st.session_state.current_mode == "assessment" and assessment and assessment["status"] == "completed":
+                    st.session_state.current_mode = "default"
+                st.rerun() # 🌟 ここで画面を更新
         except Exception as e:
-            st.error(f"接続に失敗しました：{e}")
\ No newline at end of file
+            st.error(f"接続に失敗しました：{e}")
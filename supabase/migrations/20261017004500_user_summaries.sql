@@ -0,0 +1,9 @@
+-- 会話の要約（履歴の窓から外れた古い会話を畳み込んだもの）。ユーザーごとに1行
+-- バックエンドは SUPABASE_SERVICE_ROLE_KEY（RLS を通らない）で読み書きするので、ポリシーは作らずクライアントからは見えなくする
+create table if not exists public.user_summaries (
+    user_id text primary key,
+    summary text not null default '',
+    updated_at timestamptz not null default now()
+);
+
+alter table public.user_summaries enable row level security;
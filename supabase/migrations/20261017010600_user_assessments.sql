@@ -0,0 +1,10 @@
+-- 実力判定の進行状態（何往復答えたか・採点用のやりとり・判定結果）。ユーザーごとに1行
+-- state の中身は app/assessment.py の AssessmentTracker が決める（バックエンドからは丸ごと読み書きするだけ）
+create table if not exists public.user_assessments (
+    user_id text primary key,
+    state jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+-- バックエンドは SUPABASE_SERVICE_ROLE_KEY（RLS を通らない）で読み書きするので、ポリシーは作らない
+alter table public.user_assessments enable row level security;
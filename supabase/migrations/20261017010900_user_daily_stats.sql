@@ -0,0 +1,36 @@
+-- ユーザーごと・日本時間の日ごと・モード／レベルごとの利用集計（app/learning_stats.py が増分をまとめて足し込む）
+create table if not exists public.user_daily_stats (
+    user_id text not null,
+    day date not null,
+    mode text not null,
+    level text not null default '',
+    turns integer not null default 0,
+    user_chars bigint not null default 0,
+    ai_chars bigint not null default 0,
+    primary key (user_id, day, mode, level)
+);
+
+-- バックエンドは SUPABASE_SERVICE_ROLE_KEY（RLS を通らない）で読み書きするので、ポリシーは作らない
+alter table public.user_daily_stats enable row level security;
+
+-- 増分の行（[{user_id, day, mode, level, turns, user_chars, ai_chars}, ...]）を1回の呼び出しで足し込む
+-- PostgREST の upsert は列を置き換えることしかできないので、加算はこの関数で行う
+create or replace function public.add_daily_stats(rows jsonb)
+returns void
+language sql
+as $$
+    insert into public.user_daily_stats as s (user_id, day, mode, level, turns, user_chars, ai_chars)
+    select r.user_id, r.day, r.mode, coalesce(r.level, ''), sum(r.turns), sum(r.user_chars), sum(r.ai_chars)
+    from jsonb_to_recordset(add_daily_stats.rows)
+        as r(user_id text, day date, mode text, level text, turns integer, user_chars bigint, ai_chars bigint)
+    -- 同じキーが1回の呼び出しに2行あると ON CONFLICT が失敗するので、先にまとめる
+    group by r.user_id, r.day, r.mode, coalesce(r.level, '')
+    on conflict (user_id, day, mode, level) do update set
+        turns = s.turns + excluded.turns,
+        user_chars = s.user_chars + excluded.user_chars,
+        ai_chars = s.ai_chars + excluded.ai_chars;
+$$;
+
+-- 集計を水増しできないよう、クライアントからは呼べなくする
+revoke execute on function public.add_daily_stats(jsonb) from public, anon, authenticated;
+grant execute on function public.add_daily_stats(jsonb) to service_role;
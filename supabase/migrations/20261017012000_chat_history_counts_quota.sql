@@ -0,0 +1,4 @@
+-- 定型文の返答（Fast Path。LLM を呼ばない）は履歴には残すが、1日の利用回数には数えない
+-- クォータの数え直し（SupabaseRepository.count_since）は counts_quota = true の行だけを数える
+alter table public.chat_history
+    add column if not exists counts_quota boolean not null default true;
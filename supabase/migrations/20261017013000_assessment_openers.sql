@@ -0,0 +1,11 @@
+-- 実力判定の書き出し（最初の質問）の作り置き。指示書の指紋（version）ごとに1行
+-- openers は {"A2": ["質問", ...], "B2": [...], "C1": [...]}。どのコンテナも同じものを読むので、コールドスタートで作り直さない
+-- 指紋が変わると新しい行になる（古い行は読まれないので、残っていても害はない）
+create table if not exists public.assessment_openers (
+    version text primary key,
+    openers jsonb not null,
+    updated_at timestamptz not null default now()
+);
+
+-- バックエンドは SUPABASE_SERVICE_ROLE_KEY（RLS を通らない）で読み書きするので、ポリシーは作らない
+alter table public.assessment_openers enable row level security;